@@ -0,0 +1,378 @@
+"""
+Author       : noeru_desu
+Date         : 2022-08-02 13:05:47
+LastEditors  : noeru_desu
+LastEditTime : 2022-08-02 21:40:12
+Description  : 无需MCDR的备份/合并/回档性能测试, 用法: python benchmark.py --help
+"""
+import json
+import logging
+import sys
+from argparse import ArgumentParser
+from os import makedirs, utime
+from os.path import abspath, dirname, getsize, join
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread, Timer
+from time import perf_counter, time
+from tracemalloc import get_traced_memory, start as start_tracemalloc, stop as stop_tracemalloc
+from types import ModuleType, SimpleNamespace
+from typing import Any, Optional
+
+sys.path.insert(0, dirname(abspath(__file__)))
+
+
+def install_fake_mcdreforged():
+    """未安装MCDR时提供插件导入所需的最小替代, 仅用于本测试"""
+    try:
+        import mcdreforged.api.all  # noqa: F401
+        return
+    except ImportError:
+        pass
+
+    class FakeRText(object):
+        def __init__(self, *args, **kwargs):
+            self.text = ''.join(str(i) for i in args[:1])
+
+        def __str__(self):
+            return self.text
+
+        def copy(self):
+            return self
+
+        def _chain(self, *args, **kwargs):
+            return self
+
+        h = c = set_hover_text = set_click_event = _chain
+
+    class FakeRTextList(FakeRText):
+        def __init__(self, *args):
+            super().__init__()
+            self.text = ''.join(str(i) for i in args)
+
+    class FakeNamespace(object):
+        def __getattr__(self, item):
+            return item
+
+    class Placeholder(object):
+        def __init__(self, *args, **kwargs):
+            pass
+
+    def new_thread(name=None):
+        def decorator(func):
+            def wrapper(*args, **kwargs):
+                thread = Thread(target=func, args=args, kwargs=kwargs, name=name, daemon=True)
+                thread.start()
+                return thread
+            return wrapper
+        return decorator
+
+    api_all = ModuleType('mcdreforged.api.all')
+    api_all.__dict__.update(
+        RText=FakeRText, RTextBase=FakeRText, RTextList=FakeRTextList, RAction=FakeNamespace(), RColor=FakeNamespace(),
+        Serializable=object, Literal=Placeholder, Integer=Placeholder, Text=Placeholder, QuotableText=Placeholder, RequirementNotMet=Exception, UnknownArgument=Exception,
+        CommandSource=Placeholder, new_thread=new_thread
+    )
+    api_types = ModuleType('mcdreforged.api.types')
+    api_types.__dict__.update(PluginServerInterface=Placeholder, Metadata=Placeholder, CommandSource=Placeholder)
+    for name, module in (('mcdreforged', ModuleType('mcdreforged')), ('mcdreforged.api', ModuleType('mcdreforged.api')), ('mcdreforged.api.all', api_all), ('mcdreforged.api.types', api_types)):
+        sys.modules[name] = module
+
+
+install_fake_mcdreforged()
+
+from differential_auto_backup import Config, stored  # noqa: E402
+from differential_auto_backup.core import DifferentialBackupper, SlotsManager, format_file_size  # noqa: E402
+from differential_auto_backup.region import CHUNK_COUNT, HEADER_SIZE, SECTOR_SIZE, RegionHeader  # noqa: E402
+
+
+class FakeServer(object):
+    """代替PluginServerInterface, 收到save-all后在save_delay秒后报告存档已保存"""
+    def __init__(self, save_delay: float):
+        self.logger = logging.getLogger('DAB-Benchmark')
+        self.save_delay = save_delay
+        self.running = True
+        self.stop_time: Optional[float] = None
+        self.start_time: Optional[float] = None
+
+    def execute(self, command: str):
+        if command.startswith('save-all'):
+            Timer(self.save_delay, stored.core_inst.saved_game).start()
+
+    def say(self, message):
+        self.logger.debug(str(message))
+
+    broadcast = say
+
+    def is_server_startup(self) -> bool:
+        return self.running
+
+    def stop(self):
+        self.running = False
+        self.stop_time = perf_counter()
+
+    def wait_for_start(self):
+        pass
+
+    def start(self):
+        self.running = True
+        self.start_time = perf_counter()
+
+    def get_plugin_command_source(self):
+        return FakeSource(self)
+
+
+class FakeSource(object):
+    is_player = False
+    is_console = True
+
+    def __init__(self, server: FakeServer):
+        self.server = server
+
+    def reply(self, message):
+        self.server.logger.debug(str(message))
+
+    def get_server(self) -> FakeServer:
+        return self.server
+
+
+class FakeClock(object):
+    def reset_timer(self):
+        pass
+
+    def on_backup_created(self):
+        pass
+
+
+class SyntheticWorld(object):
+    """
+    生成具有有效文件头的区域文件与玩家数据文件, 并按比例修改其中一部分以模拟游戏运行
+    区块数据一半为随机字节一半为零, 使压缩率接近真实存档
+    """
+    def __init__(self, root: str, regions: int, chunks: int, players: int, player_size: int, seed: int):
+        self.root = root
+        self.regions = regions
+        self.chunks = min(chunks, CHUNK_COUNT)
+        self.players = players
+        self.player_size = player_size
+        self.random = Random(seed)
+        self.mtime = time()
+
+    def generate(self):
+        makedirs(join(self.root, 'region'), exist_ok=True)
+        makedirs(join(self.root, 'playerdata'), exist_ok=True)
+        self.write_file('level.dat', 4096)
+        for i in range(self.regions):
+            self.write_region(self.region_name(i))
+        for i in range(self.players):
+            self.write_file(self.player_name(i), self.player_size)
+
+    @staticmethod
+    def region_name(i: int) -> str:
+        return join('region', f'r.{i % 32}.{i // 32}.mca')
+
+    @staticmethod
+    def player_name(i: int) -> str:
+        return join('playerdata', f'00000000-0000-0000-0000-{i:012x}.dat')
+
+    def random_bytes(self, size: int) -> bytes:
+        return self.random.randbytes(size // 2).ljust(size, b'\0')
+
+    def touch(self, path: str):
+        # 保证每次修改后mtime都不同, 不受文件系统时间精度影响
+        self.mtime += 1
+        utime(path, (self.mtime, self.mtime))
+
+    def write_file(self, file: str, size: int):
+        path = join(self.root, file)
+        with open(path, 'wb') as f:
+            f.write(self.random_bytes(size))
+        self.touch(path)
+
+    def write_region(self, file: str):
+        locations = [(0, 0)] * CHUNK_COUNT
+        timestamps = [0] * CHUNK_COUNT
+        sector = HEADER_SIZE // SECTOR_SIZE
+        data = []
+        for i in self.random.sample(range(CHUNK_COUNT), self.chunks):
+            count = self.random.randint(1, 4)
+            locations[i] = (sector, count)
+            timestamps[i] = int(self.mtime)
+            sector += count
+            data.append(self.random_bytes(count * SECTOR_SIZE))
+        path = join(self.root, file)
+        with open(path, 'wb') as f:
+            f.write(RegionHeader(locations, timestamps).to_bytes())
+            f.write(b''.join(data))
+        self.touch(path)
+
+    def modify_region(self, file: str, change_rate: float):
+        """原地重写一部分区块并更新其时间戳, 与服务端写入区域文件的方式相同"""
+        path = join(self.root, file)
+        with open(path, 'r+b') as f:
+            header = RegionHeader.from_bytes(f.read(HEADER_SIZE))
+            present = [i for i in range(CHUNK_COUNT) if header.is_present(i)]
+            for i in self.random.sample(present, max(int(len(present) * change_rate), 1)):
+                offset, count = header.locations[i]
+                f.seek(offset * SECTOR_SIZE)
+                f.write(self.random_bytes(count * SECTOR_SIZE))
+                header.timestamps[i] = int(self.mtime) + 1
+            f.seek(0)
+            f.write(header.to_bytes())
+        self.touch(path)
+
+    def mutate(self, change_rate: float):
+        for i in self.random.sample(range(self.regions), max(int(self.regions * change_rate), 1)):
+            self.modify_region(self.region_name(i), change_rate)
+        for i in self.random.sample(range(self.players), int(self.players * change_rate)):
+            self.write_file(self.player_name(i), self.player_size)
+        self.write_file('level.dat', 4096)
+
+
+def timed(func, *args, **kwargs) -> tuple[float, Any]:
+    start = perf_counter()
+    result = func(*args, **kwargs)
+    return perf_counter() - start, result
+
+
+def measure_metadata_memory() -> dict[str, int]:
+    """重新读取全部位次信息, 分别统计仅读取文件头与读取全部文件集合后的内存占用"""
+    start_tracemalloc()
+    try:
+        slots = SlotsManager()
+        lazy = get_traced_memory()[0]
+        for _, slot_info in slots.all_slot_generator:
+            for key in ('file_timestamps', 'included_files', 'region_deltas', 'objects', 'compressed_files'):
+                slot_info.get(key)
+        loaded = get_traced_memory()[0]
+        slots.get_holder_index()
+        indexed = get_traced_memory()[0]
+    finally:
+        stop_tracemalloc()
+    return {'header_only': lazy, 'all_sets': loaded, 'with_holder_index': indexed}
+
+
+def run(args) -> dict[str, Any]:
+    work_path = args.path or mkdtemp(prefix='dab-benchmark-')
+    server_path = join(work_path, 'server')
+    config = Config()
+    config.server_path = server_path
+    config.backup_path = join(work_path, 'backup')
+    config.auto_merge_backup = True
+    config.auto_merge_rules = {'normal': args.backups + 1}
+    for item in args.config:
+        key, value = item.split('=', 1)
+        setattr(config, key, json.loads(value))
+    stored.config = config
+    stored.server = server = FakeServer(args.save_delay)
+    stored.clock_inst = FakeClock()
+    stored.online_player_api = SimpleNamespace(get_player_list=list, have_player=lambda: False)
+    source = FakeSource(server)
+    world = SyntheticWorld(join(server_path, config.world_name), args.regions, args.chunks, args.players, args.player_size, args.seed)
+    report: dict[str, Any] = {'config': {k: v for k, v in vars(args).items() if k != 'path'}}
+    try:
+        elapsed, _ = timed(world.generate)
+        report['world'] = {'generate_seconds': elapsed}
+        stored.core_inst = core = DifferentialBackupper()
+
+        scan_cold, files = timed(core.get_all_file_mod_times)
+        scan_warm, _ = timed(core.get_all_file_mod_times)
+        report['world']['files'] = len(files)
+        report['world']['bytes'] = sum(getsize(join(server_path, f)) for f, _ in files)
+        report['scan'] = {'cold_seconds': scan_cold, 'warm_seconds': scan_warm}
+
+        backups = []
+        for i in range(args.backups):
+            if i:
+                world.mutate(args.change_rate)
+            elapsed, thread = timed(lambda: core.make_back_up(source).join())
+            record = core.metrics.get_records('backup')[-1]
+            if not record['success']:
+                raise RuntimeError(f'backup {i + 1} failed')
+            backups.append({'seconds': elapsed, 'phases': record['phases'], **record['values']})
+        report['backups'] = backups
+        report['metadata_memory'] = measure_metadata_memory()
+
+        if args.restore_slot:
+            world.mutate(args.change_rate)
+            core.restoring_backup_event.clear()
+            elapsed, _ = timed(core._do_restore_backup, source, args.restore_slot)
+            record = core.metrics.get_records('restore')[-1]
+            report['restore'] = {
+                'seconds': elapsed,
+                'server_downtime_seconds': server.start_time - server.stop_time if server.start_time and server.stop_time else None,
+                'phases': record['phases'],
+                **record['values']
+            }
+
+        if args.merge:
+            core.merging_backup_event.set()
+            elapsed, _ = timed(core._merge_slots, source, 1, args.backups)
+            record = core.metrics.get_records('merge')[-1]
+            report['merge'] = {'seconds': elapsed, 'success': record['success'], 'phases': record['phases'], **record['values']}
+        core.unload()
+    finally:
+        if not (args.keep or args.path):
+            rmtree(work_path, ignore_errors=True)
+    return report
+
+
+def print_report(report: dict[str, Any]):
+    world = report['world']
+    print(f'world: {world["files"]} files, {format_file_size(world["bytes"])}, generated in {world["generate_seconds"]:.2f}s')
+    print(f'scan: cold {report["scan"]["cold_seconds"]:.3f}s, warm {report["scan"]["warm_seconds"]:.3f}s')
+    for n, i in enumerate(report['backups'], 1):
+        print(
+            f'backup {n}: {i["seconds"]:.2f}s (save-off {i["save_off_seconds"]:.2f}s), {i["changed_files"]} files, '
+            f'{format_file_size(i["logical_bytes"])} -> {format_file_size(i["stored_bytes"])}, copy {i["copy_mb_per_second"]:.1f} MB/s'
+        )
+        print(f'    {format_phases(i["phases"])}')
+    memory = report['metadata_memory']
+    print(
+        f'slot metadata memory: header only {memory["header_only"] / 1024:.1f} KiB, '
+        f'all sets {memory["all_sets"] / 1024:.1f} KiB, with holder index {memory["with_holder_index"] / 1024:.1f} KiB'
+    )
+    if 'restore' in report:
+        restore = report['restore']
+        downtime = f'{restore["server_downtime_seconds"]:.2f}s' if restore['server_downtime_seconds'] is not None else 'unknown'
+        print(f'restore: {restore["seconds"]:.2f}s in total (including the 10s countdown), server down for {downtime}, {restore.get("restored_files", 0)} files')
+        print(f'    {format_phases(restore["phases"])}')
+    if 'merge' in report:
+        merge = report['merge']
+        print(f'merge: {merge["seconds"]:.2f}s{"" if merge["success"] else " (failed)"}')
+        print(f'    {format_phases(merge["phases"])}')
+
+
+def format_phases(phases: dict[str, float]) -> str:
+    return ', '.join(f'{k} {v:.3f}s' for k, v in phases.items())
+
+
+def main():
+    parser = ArgumentParser(description='Differential Auto Backup benchmark, no MCDR required')
+    parser.add_argument('--path', help='work directory, a temporary directory is used and removed by default')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary work directory')
+    parser.add_argument('--regions', type=int, default=64)
+    parser.add_argument('--chunks', type=int, default=256, help='chunks per region file')
+    parser.add_argument('--players', type=int, default=100)
+    parser.add_argument('--player-size', type=int, default=16 * 1024)
+    parser.add_argument('--backups', type=int, default=5)
+    parser.add_argument('--change-rate', type=float, default=0.2, help='fraction of files (and chunks in them) changed between backups')
+    parser.add_argument('--save-delay', type=float, default=0.1, help='seconds before the fake server reports the world saved')
+    parser.add_argument('--restore-slot', type=int, default=0, help='restore to this slot after the backups, 0 to skip')
+    parser.add_argument('--merge', action='store_true', help='merge all created slots after the backups')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--config', action='append', default=[], metavar='KEY=JSON', help='override a config field, e.g. region_chunk_backup=true')
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format='[%(levelname)s] %(message)s')
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,20 +5,27 @@ LastEditors  : noeru_desu
 LastEditTime : 2022-07-08 08:32:43
 Description  : 
 """
+import re
 from math import inf
 from time import sleep
 from typing import TYPE_CHECKING
 
 from . import stored
 from .core import DifferentialBackupper
-from .clock import DifferentialAutoBackupTimer
+from .clock import DifferentialAutoBackupTimer, PlayerDataBackupTimer
+from .playerdata import PlayerDataBackupper
+from .partial import PartialRestorer
+from .export import SlotExporter
+from .verify import SlotVerifier
 
-from mcdreforged.api.all import Serializable, Literal, RequirementNotMet, Integer, RTextList, RText, RAction, UnknownArgument, RTextBase, new_thread
+from mcdreforged.api.all import Serializable, Literal, RequirementNotMet, Integer, Text, QuotableText, RTextList, RText, RAction, UnknownArgument, RTextBase, new_thread
 
 if TYPE_CHECKING:
     from mcdreforged.api.types import PluginServerInterface, CommandSource
     import differential_auto_backup
 
+LAG_PATTERN = re.compile(r'Running (\d+)ms or \d+ ticks behind')
+
 
 def print_message(source: 'CommandSource', msg, tell=True, prefix='[DAB] ', force_tell=False):
     msg = RTextList(prefix, msg)
@@ -38,26 +45,78 @@ class Config(Serializable):
     ]
     backup_path: str = './differential_backup'
     overwrite_backup_folder: str = 'overwrite'
+    object_folder: str = 'objects'
     server_path: str = './server'
     world_name: str = 'world'
+    extra_worlds: list[str] = []  # 与world_name一同备份与回档的其他存档文件夹, 如Bukkit的world_nether与world_the_end
+    region_chunk_backup: bool = False  # 仅备份区域文件中有所更改的区块
+    content_addressed_storage: bool = False  # 相同内容的文件在所有位次中只储存一次
+    hardlink_backup_files: bool = False  # 合并位次时以硬链接代替复制未更改的备份文件
+    compression: str = ''  # 留空时不压缩, 可选lzma或zstd(需安装zstandard), 启用region_chunk_backup时区域文件不会被压缩
+    compression_level: int = 3
+    backup_checksums: bool = False  # 备份时计算sha256并写入位次信息以供!!dab verify校验, 启用后普通文件改为用户态复制
     interval: float = 30.0  # minutes
+    adaptive_interval: bool = False  # 根据存档的更改速度在以下范围内调整备份间隔, 启用时代替interval
+    adaptive_min_interval: float = 5.0  # minutes
+    adaptive_max_interval: float = 120.0  # minutes, 无玩家在线时使用
+    adaptive_target_size: float = 256.0  # MB, 期望每个位次包含的更改量, 更改越快间隔越短
+    playerdata_backup: bool = False  # 以独立的计时器与位次备份玩家数据, 仅扫描playerdata_folders且只需save-all
+    playerdata_folders: list[str] = [
+        'playerdata',
+        'stats',
+        'advancements'
+    ]
+    playerdata_interval: float = 2.0  # minutes
+    playerdata_slots: int = 30
     saving_timeout: int = 60     # second
+    copy_workers: int = 4
+    scan_workers: int = 4
+    copy_rate_limit: float = 0  # MB/s, 服务器运行时进行的复制的速度上限, 0为不限制
+    idle_io_priority: bool = False  # 以idle I/O优先级进行上述复制 (仅Linux的CFQ/BFQ调度器)
+    lag_backoff: bool = True  # 服务器出现"Can't keep up"时暂停复制并降低速度上限
+    inotify_watcher: bool = False  # 持续记录被更改的文件, 备份时无需扫描存档 (仅Linux)
+    two_phase_backup: bool = False  # 先将更改的文件暂存后立即恢复自动保存, 再写入位次
+    staging_path: str = ''  # 留空时为backup_path/staging, 可设置为tmpfs
+    restore_skip_identical: bool = True  # 回档时跳过仅mtime不同而内容与备份相同的文件
+    restore_compare_content: bool = False  # 对区域文件以外的文件比较大小与哈希值, 未启用时这些文件总是被恢复
+    prestage_restore: bool = True  # 回档倒计时期间预先在服务端文件夹中准备好需恢复的文件, 关闭服务器后仅需移动
+    export_format: str = 'tar.zst'  # 可选tar.zst(需安装zstandard), tar.xz, tar.gz, tar或zip, 压缩等级使用compression_level
+    export_path: str = ''  # 留空时为backup_path/exports
+    metrics_file: str = 'metrics.jsonl'  # 位于backup_path中, 每行为一次操作的JSON记录
+    metrics_history: int = 50  # 内存中保留并用于!!dab stats统计的记录数
     minimum_permission_level: dict[str, int] = {
         'make': 1,
         'back': 2,
+        'partial': 2,
         'merge': 2,
+        'export': 2,
+        'verify': 2,
         'del': 2,
         'confirm': 1,
         'abort': 1,
         'reload': 2,
         'list': 0,
+        'stats': 0,
         'debug': 4
     }
     auto_merge_backup: bool = False
     auto_merge_rules: dict[str, int] = {
         'normal': 5
     }
-    slots: int = 5
+    retention_policy: bool = False  # 按时间保留备份, 启用时代替auto_merge_backup, 分区由retention_rules决定
+    retention_rules: dict[str, int] = {  # 各分区的位次数, 分区已满时其中最旧的位次被移入下一分区
+        'recent': 6,
+        'hourly': 24,
+        'daily': 7,
+        'weekly': 4
+    }
+    retention_periods: dict[str, float] = {  # 小时, 移入该分区的位次与其中最新的位次处于同一周期时两者合并, 未设置或为0时不合并
+        'hourly': 1,
+        'daily': 24,
+        'weekly': 168
+    }
+    max_backup_size: float = 0  # GB, 备份文件夹的占用空间上限, 超出时由最旧的分区开始删除位次, 0为不限制
+    slots: int = 5  # 未启用auto_merge_backup与retention_policy时的位次数
 
 
 command_prefix = '!!dab'
@@ -74,13 +133,19 @@ def print_help_message(source: 'CommandSource'):
 §7{stored.cmd_prefix}§r 显示帮助信息
 §7{stored.cmd_prefix} make§r 创建一个储存至位次§61§r的§a备份§r
 §7{stored.cmd_prefix} back §6[<slot>]§r §c回档§r为位次§6<slot>§r的备份
+§7{stored.cmd_prefix} partial §6[<slot>]§r file §6<pattern>§r 仅§c回档§r路径(相对于服务端文件夹)匹配§6<pattern>§r的文件
+§7{stored.cmd_prefix} partial §6[<slot>]§r region §6<x> <z>§r §6[<dimension>]§r 仅§c回档§r该区域文件
+§7{stored.cmd_prefix} partial §6[<slot>]§r player §6<name|uuid>§r 仅§c回档§r该玩家的数据, 只需踢出该玩家
 §7{stored.cmd_prefix} merge §6<starting_slot>§r §6[<ending_slot>]§r §c合并§r位次§6<starting_slot>~<ending_slot>§r的备份§7(包括端点)§r
-§7{stored.cmd_prefix} del §6<starting_slot>§r §c删除§r位次§6<starting_slot>~§4最后一个位次§r的备份§7(包括端点)§r
+§7{stored.cmd_prefix} export §6<slot>§r 将位次§6<slot>§r时的完整存档§a导出§r为单个归档文件
+§7{stored.cmd_prefix} verify §6[<slot>]§r §a校验§r位次§6<slot>§r中的备份文件, 未指定时校验全部位次
+§7{stored.cmd_prefix} del §6<starting_slot>§r §c删除§r位次§6<starting_slot>~§4最后一个位次§r的备份§7(包括端点, 其中此后未被更改的文件并入更新的位次)§r
 §7{stored.cmd_prefix} confirm§r 再次确认是否进行§c回档§r
 §7{stored.cmd_prefix} abort§r 在任何时候键入此指令可中断§c回档§r
 §7{stored.cmd_prefix} list§r 显示全部位次的备份信息
+§7{stored.cmd_prefix} stats§r 显示最近的备份/回档/合并各阶段的耗时与速度
 §7{stored.cmd_prefix} reload§r 重新加载配置文件与槽位信息
-当 §6<slot>§r 未被指定时默认选择位次§61§r
+当 §6<slot>§r 未被指定时默认选择位次§61§r, 部分回档时为最新的备份
 当 §6<ending_slot>§r 未被指定时默认选择最后一个位次''',
         prefix=''
     )
@@ -105,11 +170,19 @@ def load_config(source=None):
     stored.config = stored.server.load_config_simple('./config/differential_backup.json', target_class=Config, in_data_folder=False, source_to_reply=source)
     if hasattr(stored, 'core_inst'):
         stored.core_inst.slots.build_slots()
+        stored.core_inst.reload_copy_engine()
+        stored.core_inst.metrics.resize(stored.config.metrics_history)
+        stored.playerdata_inst.load_slots_info()
 
 
 def on_info(server, info):
-    if not info.is_user and info.content in ['Saved the game', 'Saved the world']:
+    if info.is_user:
+        return
+    if info.content in ['Saved the game', 'Saved the world']:
         stored.core_inst.saved_game()
+    elif info.content.startswith("Can't keep up!"):
+        match = LAG_PATTERN.search(info.content)
+        stored.core_inst.on_server_lag(int(match.group(1)) if match else 0)
 
 
 def get_literal_node(literal):
@@ -121,6 +194,26 @@ def get_slot_node(name='slot'):
         return Integer(name).requires(lambda src, ctx: (1 <= ctx[name] and stored.core_inst.slots.get_slot_data(ctx[name])[1]['time_stamp'] != -inf) or (stored.core_inst.slots.overwrite_backup_info is not None and ctx[name] == 0)).on_error(RequirementNotMet, lambda src: src.reply('位次输入错误'), handled=True)
 
 
+def get_partial_restore_targets(node):
+    """位次节点存在时ctx中包含slot, 否则恢复至最新的备份"""
+    return node.then(
+        Literal('file').then(
+            QuotableText('pattern').runs(lambda src, ctx: stored.partial_restore_inst.request_files(src, ctx.get('slot'), ctx['pattern']))
+        )
+    ).then(
+        Literal('region').then(
+            Integer('x').then(
+                Integer('z').runs(lambda src, ctx: stored.partial_restore_inst.request_region(src, ctx.get('slot'), ctx['x'], ctx['z'])).
+                then(Text('dimension').runs(lambda src, ctx: stored.partial_restore_inst.request_region(src, ctx.get('slot'), ctx['x'], ctx['z'], ctx['dimension'])))
+            )
+        )
+    ).then(
+        Literal('player').then(
+            Text('player').runs(lambda src, ctx: stored.partial_restore_inst.request_player(src, ctx.get('slot'), ctx['player']))
+        )
+    )
+
+
 def command_run(message, text, command: str) -> RTextBase:
     fancy_text = message.copy() if isinstance(message, RTextBase) else RText(message)
     return fancy_text.set_hover_text(text).set_click_event(RAction.run_command, command)
@@ -134,10 +227,6 @@ def print_unknown_argument_message(source: 'CommandSource', error: UnknownArgume
     ))
 
 
-def print_not_implemented_error(source: 'CommandSource'):
-    print_message(source, '此功能正在开发')
-
-
 def on_load(server: 'PluginServerInterface', old: 'differential_auto_backup'):
     stored.server = server
     stored.online_player_api = server.get_plugin_instance('online_player_api')
@@ -148,6 +237,12 @@ def on_load(server: 'PluginServerInterface', old: 'differential_auto_backup'):
     stored.core_inst = DifferentialBackupper()
     stored.clock_inst = DifferentialAutoBackupTimer()
     stored.clock_inst.start()
+    stored.playerdata_inst = PlayerDataBackupper(stored.core_inst)
+    stored.playerdata_clock_inst = PlayerDataBackupTimer()
+    stored.playerdata_clock_inst.start()
+    stored.partial_restore_inst = PartialRestorer(stored.core_inst)
+    stored.export_inst = SlotExporter(stored.core_inst)
+    stored.verify_inst = SlotVerifier(stored.core_inst)
     if stored.online_player_api.have_player():
         stored.clock_inst.player_joined = True
 
@@ -165,9 +260,24 @@ def on_load(server: 'PluginServerInterface', old: 'differential_auto_backup'):
             then(get_slot_node().runs(lambda src, ctx: stored.core_inst.restore_backup(src, ctx['slot'])))
         ).
         then(
-            get_literal_node('merge').runs(print_not_implemented_error)
-            # then(get_slot_node('starting_slot').runs(lambda src, ctx: stored.core_inst.del_backup(src, ctx['starting_slot']))).
-            # then(get_slot_node('ending_slot').runs(lambda src, ctx: stored.core_inst.del_backup(src, ctx['starting_slot'], ctx['ending_slot'])))
+            get_partial_restore_targets(get_literal_node('partial')).
+            then(get_partial_restore_targets(get_slot_node()))
+        ).
+        then(
+            get_literal_node('merge').
+            then(
+                get_slot_node('starting_slot').runs(lambda src, ctx: stored.core_inst.merge_slots(src, ctx['starting_slot'])).
+                then(get_slot_node('ending_slot').runs(lambda src, ctx: stored.core_inst.merge_slots(src, ctx['starting_slot'], ctx['ending_slot'])))
+            )
+        ).
+        then(
+            get_literal_node('export').
+            then(get_slot_node().runs(lambda src, ctx: stored.export_inst.export(src, ctx['slot'])))
+        ).
+        then(
+            get_literal_node('verify').
+            runs(lambda src: stored.verify_inst.verify(src)).
+            then(get_slot_node().runs(lambda src, ctx: stored.verify_inst.verify(src, ctx['slot'])))
         ).
         then(
             get_literal_node('del').
@@ -179,6 +289,7 @@ def on_load(server: 'PluginServerInterface', old: 'differential_auto_backup'):
         then(get_literal_node('confirm').runs(stored.core_inst.confirm_restore)).
         then(get_literal_node('abort').runs(stored.core_inst.trigger_abort)).
         then(get_literal_node('list').runs(stored.core_inst.print_slots_info_rtext)).
+        then(get_literal_node('stats').runs(stored.core_inst.print_stats)).
         then(get_literal_node('reload').runs(load_config))
     )
 
@@ -187,11 +298,13 @@ def on_unload(server):
     stored.core_inst.unload()
     server.logger.info('插件卸载，停止时钟')
     stored.clock_inst.stop()
+    stored.playerdata_clock_inst.stop()
 
 
 def on_remove(server):
     server.logger.info('插件被移除，停止时钟')
     stored.clock_inst.stop()
+    stored.playerdata_clock_inst.stop()
 
 
 @new_thread('DAB-Player-Join-Backup')
@@ -200,10 +313,20 @@ def on_player_joined(server: 'PluginServerInterface', player, info):
     if stored.clock_inst.schedule_skipped:
         stored.clock_inst.schedule_skipped = False
         sleep(3)
-        stored.clock_inst.broadcast(f'§6{stored.config.interval}§r分钟内无玩家加入后的玩家进入备份触发')
+        stored.clock_inst.broadcast(f'§6{stored.clock_inst.get_interval_minutes()}§r分钟内无玩家加入后的玩家进入备份触发')
         stored.core_inst.make_back_up(server.get_plugin_command_source())
 
 
 def on_player_left(server: 'PluginServerInterface', player):
+    stored.partial_restore_inst.on_player_left(player)
     if not stored.online_player_api.have_player():
         stored.clock_inst.player_joined = False
+    if stored.config.playerdata_backup:
+        backup_player_data_on_left()
+
+
+@new_thread('DAB-PlayerData-Backup')
+def backup_player_data_on_left():
+    """玩家退出时服务端会写入其数据, 备份此时的状态"""
+    if stored.core_inst.creating_backup_event.is_set() and stored.core_inst.restoring_backup_event.is_set():
+        stored.playerdata_inst.make_back_up()
@@ -2,7 +2,7 @@
 Author       : noeru_desu
 Date         : 2022-06-14 21:16:31
 LastEditors  : noeru_desu
-LastEditTime : 2022-07-10 08:42:07
+LastEditTime : 2022-07-28 10:16:42
 Description  : 
 """
 '''
@@ -14,28 +14,73 @@ Description  :
 '''
 from threading import Thread, Event
 from time import time, strftime, localtime
+from typing import Optional
 
 from mcdreforged.api.all import RTextList
 
 from . import stored
 
+ADAPTIVE_CHECK_PERIOD = 60  # seconds, 自适应模式下重新估计间隔的周期
+RECENT_SLOTS = 3    # 用于估计近期更改速度的位次数
+
 
 class DifferentialAutoBackupTimer(Thread):
     def __init__(self):
         super().__init__(name=self.__class__.__name__, daemon=True)
         self.time_since_backup = time()
         self.stop_event = Event()
+        self.wake_event = Event()   # 计时器被重置或停止时唤醒
         self.is_enabled = stored.config.enabled
         self.player_joined = False
         self.schedule_skipped = False
+        self.adaptive_interval: Optional[float] = None  # 自适应模式下最近一次估计的间隔(秒)
+
+    def get_backup_interval(self) -> float:
+        if stored.config.adaptive_interval and self.adaptive_interval is not None:
+            return self.adaptive_interval
+        return stored.config.interval * 60
+
+    def get_interval_minutes(self) -> float:
+        return round(self.get_backup_interval() / 60, 1)
+
+    def update_interval(self):
+        if not stored.config.adaptive_interval:
+            self.adaptive_interval = None
+            return
+        try:
+            self.adaptive_interval = self.estimate_interval()
+        except Exception:
+            stored.server.logger.exception('Failed to estimate the backup interval')
+
+    def estimate_interval(self) -> float:
+        """
+        以adaptive_target_size除以估计的更改速度(字节/秒)作为间隔, 并限制在adaptive_min_interval~adaptive_max_interval之间
+        当前速度为上次备份后被修改的区域文件的总大小除以经过的时间, 近期速度为最近几个位次的占用空间除以其时间跨度
+        取两者中 max(当前, (当前 + 近期) / 2), 大量建造时立即缩短间隔, 存档空闲时逐渐延长; 无玩家在线时使用最大间隔
+        """
+        config = stored.config
+        min_interval = config.adaptive_min_interval * 60
+        max_interval = max(config.adaptive_max_interval * 60, min_interval)
+        if not stored.online_player_api.have_player():
+            return max_interval
+        elapsed = max(time() - self.time_since_backup, ADAPTIVE_CHECK_PERIOD)
+        current_rate = stored.core_inst.get_changed_region_size(self.time_since_backup) / elapsed
+        recent_rate = self.get_recent_change_rate()
+        rate = current_rate if recent_rate is None else max(current_rate, (current_rate + recent_rate) / 2)
+        if rate <= 0:
+            return max_interval
+        return min(max(config.adaptive_target_size * 2 ** 20 / rate, min_interval), max_interval)
 
     @staticmethod
-    def __get_interval() -> float:
-        return stored.config.interval
-
-    @classmethod
-    def get_backup_interval(cls):
-        return cls.__get_interval() * 60
+    def get_recent_change_rate() -> Optional[float]:
+        """位次不足两个时返回None"""
+        slot_chain = stored.core_inst.slots.get_slot_chain()[:RECENT_SLOTS + 1]
+        if len(slot_chain) < 2:
+            return None
+        span = slot_chain[0][1]['time_stamp'] - slot_chain[-1][1]['time_stamp']
+        if span <= 0:
+            return None
+        return sum(i['backup_size'] for _, i in slot_chain[:-1]) / span
 
     def broadcast(self, message):
         rtext = RTextList('[DAB] ', message)
@@ -50,6 +95,7 @@ class DifferentialAutoBackupTimer(Thread):
 
     def reset_timer(self):
         self.time_since_backup = time()
+        self.wake_event.set()
 
     def get_next_backup_message(self):
         return f'下次自动备份时间: §3{strftime("%Y/%m/%d %H:%M:%S", localtime(self.time_since_backup + self.get_backup_interval()))}§r'
@@ -59,37 +105,61 @@ class DifferentialAutoBackupTimer(Thread):
 
     def on_backup_created(self):
         self.reset_timer()
+        self.update_interval()
         self.broadcast_next_backup_time()
 
     def run(self):
-        saving_time = 0
         while True:  # loop until stop
-            while True:  # loop for backup interval
-                if self.stop_event.wait(1):
-                    return
-                if not stored.core_inst.creating_backup_event.is_set():
-                    saving_time += 1
-                    if saving_time > stored.config.saving_timeout:
-                        force_restart_server()
-                        stored.core_inst.stop_backup = True
-                        stored.core_inst.game_saved = True
-                        saving_time = 0
-                        self.reset_timer()
-                    continue
-                if time() - self.time_since_backup > self.get_backup_interval():
+            while True:  # wait for backup interval
+                self.update_interval()
+                remaining = self.time_since_backup + self.get_backup_interval() - time()
+                if remaining <= 0:
                     break
+                # 自适应模式下间隔会随存档的更改速度变化, 需定期重新估计
+                self.wake_event.wait(min(remaining, ADAPTIVE_CHECK_PERIOD) if stored.config.adaptive_interval else remaining)
+                self.wake_event.clear()
+                if self.stop_event.is_set():
+                    return
+            # 保存超时由备份线程处理, 此处仅需避免在备份进行时重复触发
+            stored.core_inst.creating_backup_event.wait()
+            if self.stop_event.is_set():
+                return
             if self.is_enabled and stored.server.is_server_startup():
                 if self.player_joined:
                     if not stored.online_player_api.have_player():
                         self.player_joined = False
-                    self.broadcast(f'每§6{self.__get_interval()}§r分钟一次的定时备份触发')
-                    saving_time = 0
-                    stored.core_inst.stop_backup = False
+                    self.broadcast(f'每§6{self.get_interval_minutes()}§r分钟一次的定时备份触发')
+                    self.time_since_backup = time()     # 备份完成时会再次重置, 避免备份失败时反复触发
                     stored.core_inst.make_back_up(stored.server.get_plugin_command_source(), wait=True)    # 非堵塞
                 else:
                     self.reset_timer()
                     stored.server.logger.info(f'[DAB] 自上次备份后没有玩家上线, 跳过此次备份, {self.get_next_backup_message()}')
                     self.schedule_skipped = True
+            else:
+                self.reset_timer()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake_event.set()
+
+
+class PlayerDataBackupTimer(Thread):
+    """玩家数据备份的独立计时器, 仅在有玩家在线时进行备份"""
+    def __init__(self):
+        super().__init__(name=self.__class__.__name__, daemon=True)
+        self.stop_event = Event()
+
+    @staticmethod
+    def get_backup_interval() -> float:
+        return stored.config.playerdata_interval * 60
+
+    def run(self):
+        while not self.stop_event.wait(self.get_backup_interval()):
+            if not (stored.config.playerdata_backup and stored.server.is_server_startup() and stored.online_player_api.have_player()):
+                continue
+            # 存档备份同样包含玩家数据, 进行存档备份或回档时跳过
+            if stored.core_inst.creating_backup_event.is_set() and stored.core_inst.restoring_backup_event.is_set():
+                stored.playerdata_inst.make_back_up()
 
     def stop(self):
         self.stop_event.set()
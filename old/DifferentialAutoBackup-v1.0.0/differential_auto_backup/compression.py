@@ -0,0 +1,138 @@
+"""
+Author       : noeru_desu
+Date         : 2022-07-31 09:12:40
+LastEditors  : noeru_desu
+LastEditTime : 2022-07-31 16:27:03
+Description  : 逐文件分帧的流式压缩储存
+"""
+import lzma
+from hashlib import sha256
+from os import remove
+from os.path import exists
+from shutil import copystat
+from struct import Struct
+from typing import TYPE_CHECKING, Any, Callable, Iterator, NamedTuple, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+if TYPE_CHECKING:
+    from os import PathLike
+
+COMPRESSED_SUFFIX = '.dabz'
+MAGIC = b'DABZ'
+BUFFER_SIZE = 2 ** 20
+_frame_header = Struct('<4sBQ')    # (MAGIC, 编码id, 原始大小)
+
+
+class Codec(NamedTuple):
+    name: str
+    id: int
+    compressor: Callable[[int], Any]     # 参数为压缩等级, 返回具有compress与flush方法的对象
+    decompressor: Callable[[], Any]      # 返回具有decompress方法的对象
+
+
+CODECS: dict[str, Codec] = {
+    'lzma': Codec('lzma', 1, lambda level: lzma.LZMACompressor(preset=min(max(level, 0), 9)), lzma.LZMADecompressor)
+}
+if zstandard is not None:
+    CODECS['zstd'] = Codec(
+        'zstd', 2,
+        lambda level: zstandard.ZstdCompressor(level=level).compressobj(),
+        lambda: zstandard.ZstdDecompressor().decompressobj()
+    )
+_codecs_by_id = {i.id: i for i in CODECS.values()}
+
+
+class FrameHeader(NamedTuple):
+    codec: Codec
+    size: int   # 原始文件大小
+
+
+def get_codec(name: str) -> Optional[Codec]:
+    """name为空时返回None, 编码不存在或所需的库未安装时抛出ValueError"""
+    if not name:
+        return None
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError(f'compression codec {name} is unavailable, available codecs: {", ".join(CODECS)}')
+    return codec
+
+
+def compress_file(src: 'PathLike[str]', dst: 'PathLike[str]', codec: Codec, level: int, hasher=None) -> int:
+    """将src压缩为单个帧写入dst并保留其文件属性, 返回写入的字节数. hasher不为None时以读取的原始数据更新它"""
+    compressor = codec.compressor(level)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = 0
+        fdst.write(bytes(_frame_header.size))
+        while data := fsrc.read(BUFFER_SIZE):
+            size += len(data)
+            if hasher is not None:
+                hasher.update(data)
+            fdst.write(compressor.compress(data))
+        fdst.write(compressor.flush())
+        stored_size = fdst.tell()
+        fdst.seek(0)
+        # 原始大小在压缩完成后写入, 避免读取过程中文件被修改导致记录不一致
+        fdst.write(_frame_header.pack(MAGIC, codec.id, size))
+    copystat(src, dst)
+    return stored_size
+
+
+def read_frame_header(path: 'PathLike[str]') -> FrameHeader:
+    with open(path, 'rb') as f:
+        return _parse_frame_header(f.read(_frame_header.size), path)
+
+
+def _parse_frame_header(data: bytes, path) -> FrameHeader:
+    if len(data) != _frame_header.size:
+        raise ValueError(f'{path} is truncated')
+    magic, codec_id, size = _frame_header.unpack(data)
+    if magic != MAGIC:
+        raise ValueError(f'{path} is not a compressed backup file')
+    codec = _codecs_by_id.get(codec_id)
+    if codec is None:
+        raise ValueError(f'{path} is compressed with an unavailable codec (id {codec_id})')
+    return FrameHeader(codec, size)
+
+
+def iter_decompressed(path: 'PathLike[str]', limit: Optional[int] = None) -> Iterator[bytes]:
+    """逐块产出解压后的数据, 内存占用与文件大小无关. limit不为None时至少读取limit字节后即停止"""
+    with open(path, 'rb') as f:
+        header = _parse_frame_header(f.read(_frame_header.size), path)
+        decompressor = header.codec.decompressor()
+        read_size = 0
+        while data := f.read(BUFFER_SIZE):
+            if data := decompressor.decompress(data):
+                read_size += len(data)
+                yield data
+                if limit is not None and read_size >= limit:
+                    return
+
+
+def read_head(path: 'PathLike[str]', length: int) -> bytes:
+    """仅解压文件开头的length字节(用于读取区域文件头)"""
+    return b''.join(iter_decompressed(path, length))[:length]
+
+
+def decompress_file(src: 'PathLike[str]', dst: 'PathLike[str]') -> int:
+    """解压src至dst并保留其文件属性, 返回原始大小"""
+    if exists(dst):
+        remove(dst)
+    size = 0
+    with open(dst, 'wb') as fdst:
+        for data in iter_decompressed(src):
+            size += len(data)
+            fdst.write(data)
+    copystat(src, dst)
+    return size
+
+
+def compressed_digest(path: 'PathLike[str]') -> str:
+    """返回原始内容的sha256, 与objects.file_digest一致"""
+    hasher = sha256()
+    for data in iter_decompressed(path):
+        hasher.update(data)
+    return hasher.hexdigest()
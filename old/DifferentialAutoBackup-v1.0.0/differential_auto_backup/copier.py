@@ -0,0 +1,74 @@
+"""
+Author       : noeru_desu
+Date         : 2022-07-24 08:55:10
+LastEditors  : noeru_desu
+LastEditTime : 2022-07-24 11:27:31
+Description  : 备份/合并/回档共用的多线程复制
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Event
+from typing import Callable, Iterable, Optional
+
+from .throttle import IDLE_IO_PRIORITY, Pacer, get_io_priority, set_io_priority
+
+CopyTask = tuple[int, Callable[[], int]]    # (预估大小, 执行复制并返回字节数的函数)
+
+
+class CopyEngine(object):
+    def __init__(self, workers: int, pacer: Optional[Pacer] = None):
+        self.workers = max(workers, 1)
+        self.pacer = pacer or Pacer()
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='DAB-Copy') if self.workers > 1 else None
+
+    def run(self, tasks: Iterable[CopyTask], cancel_event: Optional[Event] = None, paced=False) -> int:
+        """
+        按预估大小由大到小执行全部任务并返回字节数总和, 任一任务出错时取消剩余任务并抛出该异常
+        cancel_event被设置后尚未开始的任务将被跳过
+        paced为True时受pacer的速度限制, 用于服务器运行时在后台进行的复制
+        """
+        tasks = sorted(tasks, key=lambda t: t[0], reverse=True)
+        if paced:
+            tasks = [(size, partial(self._paced, func, size)) for size, func in tasks]
+        if cancel_event is not None:
+            tasks = [(size, self._cancellable(func, cancel_event)) for size, func in tasks]
+        if self.executor is None:
+            return sum(func() for _, func in tasks)
+        futures = [self.executor.submit(func) for _, func in tasks]
+        total_size = 0
+        error = None
+        for future in futures:
+            if error is not None:
+                future.cancel()
+                continue
+            try:
+                total_size += future.result()
+            except Exception as e:
+                error = e
+        if error is not None:
+            # 等待已开始的任务结束, 避免其在调用者清理文件时继续写入
+            for future in futures:
+                if not future.cancelled():
+                    future.exception()
+            raise error
+        return total_size
+
+    def _paced(self, func: Callable[[], int], size: int) -> int:
+        self.pacer.acquire(size)
+        if not self.pacer.idle_io:
+            return func()
+        last_priority = get_io_priority()
+        set_io_priority(IDLE_IO_PRIORITY)
+        try:
+            return func()
+        finally:
+            if last_priority is not None:
+                set_io_priority(last_priority)
+
+    @staticmethod
+    def _cancellable(func: Callable[[], int], cancel_event: Event) -> Callable[[], int]:
+        return lambda: 0 if cancel_event.is_set() else func()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
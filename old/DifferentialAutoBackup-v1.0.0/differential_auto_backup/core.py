@@ -6,17 +6,34 @@ LastEditTime : 2022-07-21 17:49:22
 Description  : 
 """
 from collections import deque
-from pickle import load, dump
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hashlib import sha256
+from itertools import islice
 from math import inf
-from os import makedirs, mkdir, remove, walk
-from os.path import getmtime, join, exists, split, abspath, getsize, sep
-from shutil import copy2, rmtree
-from threading import Event
+from os import makedirs, mkdir, remove, replace, rmdir, stat, utime, walk
+from os.path import join, exists, split, abspath, getsize, relpath, sep
+from shutil import rmtree
+from stat import S_ISREG
+from threading import Condition, Event, Lock, RLock, Thread
 from traceback import print_exc
 from typing import TYPE_CHECKING, Iterable, Literal, Optional, Union
-from time import sleep, time, strftime, localtime
+from time import perf_counter, time, strftime, localtime
 
 from . import stored
+from .clock import force_restart_server
+from .compression import COMPRESSED_SUFFIX, CODECS, Codec, compress_file, compressed_digest, decompress_file, get_codec, read_frame_header
+from .copier import CopyEngine, CopyTask
+from .holders import FileHolderIndex
+from .metrics import MetricsRecorder, OperationRecord
+from .metadata import SlotInfo, dump_slot_info, load_slot_info
+from .objects import ObjectStore, file_digest
+from .scanner import ScanIndex
+from .throttle import Pacer
+from .watcher import WorldWatcher
+from .transfer import get_allocated_size, transfer_file
+from .retention import CompactionQueue, get_disk_usage, get_period_index
+from .region import RegionDelta, RegionVersion, delta_file_name, get_changed_chunks, is_region_file, read_region_header, rebuild_region
 
 from mcdreforged.api.all import RTextList, CommandSource, new_thread, RText, RColor, RAction, RTextBase
 
@@ -25,9 +42,57 @@ if TYPE_CHECKING:
 
     TimeSet = set[tuple[PathLike[str], float]]
     ChangedTimeSet = set[tuple[PathLike[str], float]]
-    SlotInfo = dict[Literal['time', 'time_stamp', 'file_timestamps', 'included_files', 'backup_size'], Union[str, float, list, int, TimeSet]]
+    SlotInfoDict = dict[Literal['time', 'time_stamp', 'file_timestamps', 'included_files', 'region_deltas', 'objects', 'compressed_files', 'checksums', 'backup_size', 'logical_size'], Union[str, float, list, int, dict, TimeSet]]
     SlotData = tuple(PathLike[str], SlotInfo)
 
+RESTORE_STAGING_FOLDER = '.dab_restore'
+MERGE_FOLDER = 'merging'
+MERGE_TRASH_FOLDER = 'merged'
+OPERATION_NAMES = {'backup': '备份', 'restore': '回档', 'partial_restore': '部分回档', 'merge': '合并', 'export': '导出', 'verify': '校验'}
+PHASE_NAMES = {
+    'wait_save': '等待保存',
+    'scan': '扫描',
+    'stage': '暂存',
+    'clear_slot': '清空位次',
+    'copy': '复制',
+    'write_info': '写入信息',
+    'prestage': '预备文件',
+    'countdown': '倒计时',
+    'stop_server': '关闭服务器',
+    'kick': '踢出玩家',
+    'plan': '计算计划',
+    'overwrite_backup': '覆盖备份',
+    'restore': '恢复',
+    'link': '链接',
+    'swap': '替换索引',
+    'archive': '写入归档',
+    'verify': '校验',
+    'cleanup': '清理'
+}
+VALUE_NAMES = {
+    'changed_files': '更改的文件',
+    'logical_bytes': '原始大小',
+    'stored_bytes': '占用空间',
+    'copy_mb_per_second': '复制速度',
+    'save_off_seconds': '关闭自动保存',
+    'downtime_seconds': '停服时间',
+    'restored_files': '恢复的文件',
+    'prestaged_files': '预备的文件',
+    'deleted_files': '删除的文件',
+    'restored_bytes': '恢复大小',
+    'overwrite_backup_bytes': '覆盖备份大小',
+    'merged_slots': '合并的位次',
+    'merged_files': '合并的文件',
+    'exported_files': '导出的文件',
+    'archive_bytes': '归档大小',
+    'export_mb_per_second': '导出速度',
+    'verified_files': '校验的文件',
+    'unchecked_files': '无校验值的文件',
+    'missing_files': '缺失的文件',
+    'corrupt_files': '损坏的文件',
+    'read_bytes': '读取大小',
+    'verify_mb_per_second': '校验速度'
+}
 
 def print_message(source: 'CommandSource', msg, tell=True, prefix='[DAB] ', force_tell=False):
     msg = RTextList(prefix, msg)
@@ -49,22 +114,32 @@ empty_info = {
     'time_stamp': -inf,
     'included_files': set(),
     'backup_size': 0,
-    'file_timestamps': set()
+    'file_timestamps': set(),
+    'region_deltas': set(),
+    'objects': {},
+    'compressed_files': set(),
+    'checksums': {}
 }
 
 
+def get_worlds() -> list[str]:
+    """全部需要备份的存档文件夹, 位次中的文件路径均相对于服务端文件夹"""
+    return [stored.config.world_name, *(i for i in stored.config.extra_worlds if i != stored.config.world_name)]
+
+
 def pi(*msg):
     stored.server.logger.warning(msg)
 
 
 class Slots(object):
-    def __init__(self, start: int, end: int, slot_index: int):
-        """start与end均包含"""
+    def __init__(self, start: int, end: int, slot_index: int, period: float = 0):
+        """start与end均包含, period为按时间保留时此分区中每个位次对应的周期(小时)"""
         self.starting_slot = start
         self.ending_slot = end
         self.slot_index = slot_index
+        self.period = period
         self.slots = end - start    # 等同于len(self.slots_deque) - 1, 即self.slots_deque的最大下标
-        self.slots_deque: deque[tuple['PathLike[str]', 'SlotInfo']] = None
+        self.slots_deque: deque[tuple['PathLike[str]', 'SlotInfoDict']] = None
         self.used_slots_count: int = -1
         self.load_slots_info()
 
@@ -80,7 +155,7 @@ class Slots(object):
             return -1   # 此时index-self.slots-1为前一分区的下标负偏移量. 尚未使用, 故直接返回-1作为标识
         return index
 
-    def get_slot_data(self, slot_index: int) -> tuple['PathLike[str]', 'SlotInfo']:
+    def get_slot_data(self, slot_index: int) -> tuple['PathLike[str]', 'SlotInfoDict']:
         return self.slots_deque[slot_index]
 
     def load_slots_info(self):
@@ -91,13 +166,8 @@ class Slots(object):
                 makedirs(slot_path)
                 slots_list.append((slot_path, empty_info))
                 continue
-            info_file = join(slot_path, 'info.pickle')
-            if not exists(info_file):
-                slots_list.append((slot_path, empty_info))
-                continue
-            with open(info_file, 'rb') as f:
-                info: 'SlotInfo' = load(f)
-                slots_list.append((slot_path, info))
+            info = load_slot_info(slot_path, stored.config.world_name)
+            slots_list.append((slot_path, empty_info if info is None else info))
         self.sort_slots_deque(slots_list)
 
     def sort_slots_deque(self, slots_iter: Iterable = ...):
@@ -105,12 +175,26 @@ class Slots(object):
             slots_iter = self.slots_deque
         self.slots_deque = deque(sorted(slots_iter, key=lambda v: v[1]['time_stamp']), maxlen=self.slots + 1)
 
-    def add_slot_data(self, data: tuple['PathLike[str]', 'SlotInfo']):
-        self.used_slots_count += 1
+    def add_slot_data(self, data: tuple['PathLike[str]', 'SlotInfoDict']):
+        # 写入的位次已被清空, 将其原记录移除后再添加至右端, 以免maxlen挤出其他位次
+        for n, (p, _) in enumerate(self.slots_deque):
+            if p == data[0]:
+                del self.slots_deque[n]
+                break
         self.slots_deque.append(data)
-        if stored.config.auto_merge_backup and self.used_slots_count > self.slots and self.slot_index + 1 < len(stored.core_inst.slots.slots_list):
-            stored.core_inst._merge_slots(stored.server.get_plugin_command_source(), self.starting_slot, self.ending_slot, self.slot_index + 1)
-            self.used_slots_count = 0
+        self.count_used_slots()
+        stored.core_inst.slots.index_slot(*data)
+
+    def count_used_slots(self):
+        self.used_slots_count = sum(si['time_stamp'] != -inf for p, si in self.slots_deque)
+
+    def is_full(self) -> bool:
+        return self.get_used_slots_count() > self.slots
+
+    def replace_slot_data(self, index: int, data: tuple['PathLike[str]', 'SlotInfoDict']):
+        self.slots_deque[index] = data
+        self.sort_slots_deque()
+        self.count_used_slots()
 
     def get_oldest_slot(self):  # 即最左端
         return self.slots_deque[0]
@@ -124,11 +208,9 @@ class SlotsManager(object):
         self.overwrite_backup_info = None
         self.slots_count_list = []
         self.slots_list: list['Slots'] = []
+        self.holder_index: Optional[FileHolderIndex] = None
         self.build_slots()
-        overwrite_backup_info_file = join(stored.config.backup_path, stored.config.overwrite_backup_folder, 'info.pickle')
-        if exists(overwrite_backup_info_file):
-            with open(overwrite_backup_info_file, 'rb') as f:
-                self.overwrite_backup_info = load(f)
+        self.overwrite_backup_info = load_slot_info(join(stored.config.backup_path, stored.config.overwrite_backup_folder), stored.config.world_name)
 
     @property
     def all_slot_generator(self):
@@ -138,7 +220,7 @@ class SlotsManager(object):
     def get_used_slots_count(self):
         return sum(i.get_used_slots_count() for i in self.slots_list)
 
-    def get_slot_data(self, displayed_slot_id: int) -> tuple['PathLike[str]', 'SlotInfo']:
+    def get_slot_data(self, displayed_slot_id: int) -> tuple['PathLike[str]', 'SlotInfoDict']:
         for i in self.slots_list:
             index = i.get_slot_index(displayed_slot_id)
             if index >= 0:
@@ -147,25 +229,32 @@ class SlotsManager(object):
 
     def build_slots(self):
         self.slots_list.clear()
-        if stored.config.auto_merge_backup:
-            starting = 1
-            ending = 0
-            for i, v in enumerate(stored.config.auto_merge_rules.values()):
-                ending += v
-                self.slots_list.append(Slots(starting, ending, i))
-                starting += v
-
-    def add_slot_data(self, data: tuple['PathLike[str]', 'SlotInfo']):
+        self.holder_index = None
+        if stored.config.retention_policy:
+            rules = stored.config.retention_rules
+        elif stored.config.auto_merge_backup:
+            rules = stored.config.auto_merge_rules
+        else:
+            rules = {'normal': stored.config.slots}
+        starting = 1
+        ending = 0
+        for i, (k, v) in enumerate(rules.items()):
+            ending += v
+            self.slots_list.append(Slots(starting, ending, i, stored.config.retention_periods.get(k, 0) if stored.config.retention_policy else 0))
+            starting += v
+
+    def add_slot_data(self, data: tuple['PathLike[str]', 'SlotInfoDict']):
         self.slots_list[0].add_slot_data(data)
 
     def clear_slot_data(self, displayed_slot_id: int, del_files=False):
         for i in self.slots_list:
             index = i.get_slot_index(displayed_slot_id)
             if index >= 0:
-                slot_path = i.slots_deque[index][0]
+                slot_path, slot_info = i.slots_deque[index]
+                if slot_info['time_stamp'] == -inf:
+                    return
                 if del_files:
-                    rmtree(slot_path)
-                    mkdir(slot_path)
+                    stored.core_inst.clear_slot_files(slot_path, slot_info)
                 del i.slots_deque[index]
                 i.slots_deque.appendleft((slot_path, empty_info))
                 i.used_slots_count -= 1
@@ -177,10 +266,11 @@ class SlotsManager(object):
             for i in self.slots_list:
                 index = i.get_slot_index(displayed_slot_id)
                 if index >= 0:
-                    slot_path = i.slots_deque[index][0]
+                    slot_path, slot_info = i.slots_deque[index]
+                    if slot_info['time_stamp'] == -inf:
+                        break
                     if del_files:
-                        rmtree(slot_path)
-                        mkdir(slot_path)
+                        stored.core_inst.clear_slot_files(slot_path, slot_info)
                     index_list.append((i, index, slot_path))
                     i.used_slots_count -= 1
                     break
@@ -191,6 +281,9 @@ class SlotsManager(object):
     def get_oldest_slot(self):
         return self.slots_list[0].get_oldest_slot()
 
+    def get_last_displayed_slot_id(self) -> int:
+        return self.slots_list[-1].ending_slot
+
     def get_latest_slot(self):
         for i in self.slots_list:
             l = i.get_latest_slot()
@@ -198,14 +291,73 @@ class SlotsManager(object):
                 return l
         return self.slots_list[0].get_latest_slot()
 
+    def get_holder_index(self) -> FileHolderIndex:
+        """首次使用时根据全部位次建立, 此后随位次的添加与清空更新"""
+        if self.holder_index is None:
+            holder_index = FileHolderIndex()
+            holder_index.rebuild(self.get_slot_chain())
+            self.holder_index = holder_index
+        return self.holder_index
+
+    def index_slot(self, slot_path: 'PathLike[str]', slot_info: 'SlotInfoDict'):
+        if self.holder_index is not None:
+            self.holder_index.add_slot(slot_path, slot_info)
+
+    def unindex_slot(self, slot_path: 'PathLike[str]', slot_info: 'SlotInfoDict'):
+        if self.holder_index is not None and slot_info['time_stamp'] != -inf:
+            self.holder_index.remove_slot(slot_path, slot_info)
+
+    def get_displayed_slot_id(self, slot_path: 'PathLike[str]') -> int:
+        slots, index = self.find_slot(slot_path)
+        return slots.ending_slot - index
+
+    def find_slot(self, slot_path: 'PathLike[str]') -> tuple['Slots', int]:
+        for i in self.slots_list:
+            for n, (p, _) in enumerate(i.slots_deque):
+                if p == slot_path:
+                    return i, n
+        raise ValueError('nonexistent slot_path')
+
+    def replace_slot_data(self, slot_path: 'PathLike[str]', slot_info: 'SlotInfoDict'):
+        """替换位次信息, 不改变文件与文件索引"""
+        slots, index = self.find_slot(slot_path)
+        slots.replace_slot_data(index, (slot_path, slot_info))
+
+    def get_slot_by_path(self, slot_path: 'PathLike[str]') -> 'SlotInfoDict':
+        for p, i in self.all_slot_generator:
+            if p == slot_path:
+                return i
+        raise ValueError('nonexistent slot_path')
+
+    def release_file_timestamps(self):
+        """释放除最新位次外已读取的完整文件时间戳集合"""
+        latest_slot_info = self.get_latest_slot()[1]
+        for slot_path, slot_info in self.all_slot_generator:
+            if isinstance(slot_info, SlotInfo) and slot_info is not latest_slot_info:
+                slot_info.release('file_timestamps')
+
+    def get_slot_chain(self, displayed_slot_id: int = 1) -> list[tuple['PathLike[str]', 'SlotInfoDict']]:
+        """由新到旧返回从指定位次开始的全部已使用位次"""
+        return [i for i in islice(self.all_slot_generator, displayed_slot_id - 1, None) if i[1]['time_stamp'] != -inf]
+
+
 class DifferentialBackupper(object):
     def __init__(self) -> None:
         self.slots = SlotsManager()
+        self.object_store = ObjectStore(join(stored.config.backup_path, stored.config.object_folder))
+        self.pacer = Pacer(stored.config.copy_rate_limit * 2 ** 20, stored.config.idle_io_priority)
+        self.copy_engine = CopyEngine(stored.config.copy_workers, self.pacer)
+        self.scan_index = ScanIndex(join(stored.config.backup_path, 'scan_index.pickle'))
+        self.metrics = MetricsRecorder(join(stored.config.backup_path, stored.config.metrics_file), stored.config.metrics_history)
+        self.watcher: Optional[WorldWatcher] = None
         self.game_saved = False
         self.unloaded = False
-        self.stop_backup = False
-        self.restore_slot_selected: Optional[tuple[int, tuple['PathLike[str]', 'SlotInfo']]] = None
-        self.abort_restore = False
+        self.state_condition = Condition()     # game_saved与unloaded变化时通知
+        self.save_lock = Lock()    # 存档备份, 玩家数据备份与部分回档的保存指令依次执行, 保存完成的消息只属于持有者发出的指令
+        self.restore_slot_selected: Optional[tuple[int, tuple['PathLike[str]', 'SlotInfoDict']]] = None
+        self.abort_restore_event = Event()
+        self.save_off_time: Optional[float] = None
+        self.save_off_duration = 0.0
         self.restoring_backup_event = Event()
         self.creating_backup_event = Event()
         self.merging_backup_event = Event()
@@ -213,7 +365,12 @@ class DifferentialBackupper(object):
         self.creating_backup_event.set()
         self.merging_backup_event.set()
         self.abs_server_path = abspath(stored.config.server_path)
-        self.used_slots_count = self.get_used_slots_count()
+        self.slots_lock = RLock()     # 修改位次队列与文件索引时持有
+        self.merge_lock = RLock()     # 同一时间只进行一次合并, 自动合并时可能需要先合并下一分区
+        self.merging_slots: set['PathLike[str]'] = set()     # 进行中的合并所使用的位次, 备份不能覆盖它们
+        self.compaction_queue = CompactionQueue(self.on_compaction_error)
+        self.compaction_queue.start()
+        self.start_watcher()
 
     def get_used_slots_count(self):
         return self.slots.get_used_slots_count()
@@ -227,18 +384,19 @@ class DifferentialBackupper(object):
 
     def print_slots_info_rtext(self, source):
         print_message(source, '§d[备份位次]§r', prefix='')
-        backup_size = 0
+        backup_size = logical_size = 0
         for num, (path, slot_info) in enumerate(self.slots.all_slot_generator):
             if slot_info['time_stamp'] == -inf:
                 continue
             num += 1
             backup_size += slot_info['backup_size']
+            logical_size += slot_info.get('logical_size', slot_info['backup_size'])
             print_message(source, RTextList(
                 f'[位次§6{num}§r]',
                 ' ',
                 RText('[▷] ', color=RColor.green).h(f'点击回档至位次§6{num}§r').c(RAction.run_command, f'{stored.cmd_prefix} back {num}'),
                 RText('[×] ', color=RColor.red).h(f'点击删除位次§6{num}§r').c(RAction.suggest_command, f'{stored.cmd_prefix} del {num}'),
-                f'§2{format_file_size(slot_info["backup_size"])}§r '
+                f'{format_backup_size(slot_info)} '
                 f'时间: {slot_info["time"]}'
             ), prefix='')
         if self.slots.overwrite_backup_info is not None:
@@ -247,39 +405,167 @@ class DifferentialBackupper(object):
                 ' ',
                 RText('[▷] ', color=RColor.green), #.h(f'点击回档至备份§6{num}§r').c(RAction.run_command, f'{stored.cmd_prefix} back {num}'),
                 RText('[×] ', color=RColor.red).h('点击删除此备份').c(RAction.suggest_command, f'{stored.cmd_prefix} del 0'),
-                f'§2{format_file_size(self.slots.overwrite_backup_info["backup_size"])}§r '
+                f'{format_backup_size(self.slots.overwrite_backup_info)} '
                 f'时间: {self.slots.overwrite_backup_info["time"]} ',
                 '§6(最近一次回档时的备份)§r'
             ), prefix='')
             backup_size += self.slots.overwrite_backup_info["backup_size"]
-        print_message(source, f'备份总占用空间: §a{format_file_size(backup_size)}§r', prefix='')
-
-    def get_all_file_mod_times(self, world) -> 'TimeSet':
-        world = join(self.abs_server_path, world)
-        offset = len(world) + 1
-        modification_time_set = set()
-        for top, dirs, files in walk(world):
-            relative_path = top[offset:]
-            modification_time_set.update((join(relative_path, file), getmtime(join(top, file))) for file in files if file not in stored.config.ignored_files)
+            logical_size += self.slots.overwrite_backup_info.get('logical_size', self.slots.overwrite_backup_info['backup_size'])
+        compressed_message = f' (原始大小§a{format_file_size(logical_size)}§r)' if logical_size != backup_size else ''
+        print_message(source, f'备份总占用空间: §a{format_file_size(backup_size)}§r{compressed_message}', prefix='')
+        if stored.config.playerdata_backup:
+            slot_chain = stored.playerdata_inst.get_slot_chain()
+            latest_message = f', 最近一次: {slot_chain[0][1]["time"]}' if slot_chain else ''
+            print_message(
+                source,
+                f'玩家数据备份: §6{len(slot_chain)}§r个位次, 占用空间§a{format_file_size(stored.playerdata_inst.get_backup_size())}§r{latest_message}',
+                prefix=''
+            )
+
+    def print_stats(self, source):
+        print_message(source, '§d[性能统计]§r', prefix='')
+        for operation, operation_name in OPERATION_NAMES.items():
+            records = self.metrics.get_records(operation)
+            if not records:
+                continue
+            latest = records[-1]
+            summary = self.metrics.summarize(operation)
+            result = '§a成功§r' if latest['success'] else '§c失败§r'
+            print_message(source, f'§6{operation_name}§r 最近一次: {latest["time"]} {result}, 用时§6{round(latest["duration"], 2)}§r秒', prefix='')
+            print_message(source, '  ' + format_metrics(latest['phases'], latest['values']), prefix='')
+            if summary is not None and summary['count'] > 1:
+                print_message(source, f'  近{summary["count"]}次成功操作平均用时§6{round(summary["duration"], 2)}§r秒: ' + format_metrics(summary['phases'], summary['values']), prefix='')
+        print_message(source, f'完整记录位于§7{self.metrics.history_file}§r', prefix='')
+
+    def get_all_file_mod_times(self, worlds: Iterable[str] = None) -> 'TimeSet':
+        """并行扫描各存档文件夹, 返回的路径相对于服务端文件夹"""
+        worlds = get_worlds() if worlds is None else list(worlds)
+
+        def scan(world):
+            return {(join(world, f), t) for f, t in self.scan_index.scan(join(self.abs_server_path, world), stored.config.ignored_files, stored.config.scan_workers)}
+
+        if len(worlds) > 1:
+            with ThreadPoolExecutor(len(worlds), thread_name_prefix='DAB-Scan-World') as executor:
+                modification_time_set = set().union(*executor.map(scan, worlds))
+        else:
+            modification_time_set = set().union(*map(scan, worlds))
+        self.scan_index.save()
         return modification_time_set
 
-    def get_all_file(self, world) -> set['PathLike[str]']:
-        world = join(self.abs_server_path, world)
-        offset = len(world) + 1
-        files: set['PathLike[str]'] = set()
-        for top, dirs, file_list in walk(world):
-            relative_path = top[offset:]
-            files.update(join(relative_path, file) for file in file_list if file not in stored.config.ignored_files)
-        return files
+    def get_all_file(self, worlds: Iterable[str] = None) -> set['PathLike[str]']:
+        return {f for f, t in self.get_all_file_mod_times(worlds)}
+
+    def get_changed_region_size(self, since: float) -> int:
+        """
+        返回自since以来被修改的区域文件的总大小, 用于估计存档的更改速度, 不会更新扫描索引
+        监视器可靠时仅stat其记录的被更改的区域文件, 否则由扫描索引记录的文件夹列表得到区域文件, 两者均不可用时才遍历存档文件夹
+        """
+        files = None
+        if self.watcher is not None:
+            dirty = self.watcher.peek_dirty(self.slots.get_latest_slot()[1]['time_stamp'])
+            if dirty is not None:
+                files = [f for f in dirty if is_region_file(f)]
+        if files is None:
+            files = []
+            for world in get_worlds():
+                root = join(self.abs_server_path, world)
+                indexed = self.scan_index.list_files(root, is_region_file)
+                if indexed is None:
+                    indexed = [relpath(join(d, f), root) for d, _, fs in walk(root) for f in fs if is_region_file(f)]
+                files.extend(join(world, f) for f in indexed)
+        size = 0
+        for file in files:
+            try:
+                st = stat(join(self.abs_server_path, file))
+            except FileNotFoundError:
+                continue
+            if st.st_mtime > since:
+                size += st.st_size
+        return size
+
+    def start_watcher(self):
+        if not stored.config.inotify_watcher or self.watcher is not None:
+            return
+        if not WorldWatcher.is_supported():
+            stored.server.logger.warning('inotify is not supported on this platform, world watcher disabled')
+            return
+        watcher = WorldWatcher(self.abs_server_path, get_worlds())
+        try:
+            watcher.start()
+        except OSError as e:
+            stored.server.logger.warning(f'Failed to start world watcher: {e}')
+        else:
+            self.watcher = watcher
+
+    def get_world_file_mod_times(self, latest_slot_info: 'SlotInfoDict') -> 'TimeSet':
+        """监视器自最新位次被创建以来一直可靠时, 仅将其记录的变化应用于最新位次的文件时间戳而不扫描存档"""
+        if self.watcher is not None:
+            dirty = self.watcher.take_dirty(latest_slot_info['time_stamp'])
+            if dirty is not None:
+                return self.apply_dirty_files(latest_slot_info['file_timestamps'], dirty)
+            stored.server.logger.info('World watcher has no reliable record since the latest backup, fall back to full scan')
+        else:
+            self.start_watcher()    # 须在扫描前启动, 以免遗漏扫描期间发生的变化
+        return self.get_all_file_mod_times()
+
+    def apply_dirty_files(self, last_time_set: 'TimeSet', dirty_files: set['PathLike[str]']) -> 'TimeSet':
+        file_mod_times = {f: t for f, t in last_time_set if f not in dirty_files}
+        for file in dirty_files:
+            if split(file)[1] in stored.config.ignored_files:
+                continue
+            try:
+                st = stat(join(self.abs_server_path, file))
+            except FileNotFoundError:
+                continue
+            if S_ISREG(st.st_mode):
+                file_mod_times[file] = st.st_mtime
+        return set(file_mod_times.items())
 
     def get_changed_file_set(self, last_time_set: 'TimeSet', latest_time_set: 'TimeSet') -> 'ChangedTimeSet':
         return latest_time_set - last_time_set
 
     def saved_game(self):
-        self.game_saved = True
+        with self.state_condition:
+            self.game_saved = True
+            self.state_condition.notify_all()
+
+    def save_game(self, command='save-all flush') -> bool:
+        """
+        执行保存指令并等待服务端输出保存完成, 超时或插件被卸载时返回False
+        在save_lock内进行, 其他线程的保存指令不会提前唤醒等待, 也不会在保存完成后将game_saved重置
+        """
+        with self.save_lock:
+            with self.state_condition:
+                self.game_saved = False
+            stored.server.execute(command)
+            with self.state_condition:
+                return self.state_condition.wait_for(lambda: self.game_saved or self.unloaded, stored.config.saving_timeout) and not self.unloaded
 
     def unload(self):
-        self.unloaded = True
+        with self.state_condition:
+            self.unloaded = True
+            self.state_condition.notify_all()
+        self.abort_restore_event.set()
+        self.compaction_queue.stop()
+        self.copy_engine.shutdown()
+        if self.watcher is not None:
+            self.watcher.stop()
+
+    def reload_copy_engine(self):
+        self.pacer.configure(stored.config.copy_rate_limit * 2 ** 20, stored.config.idle_io_priority)
+        if self.copy_engine.workers != max(stored.config.copy_workers, 1):
+            self.copy_engine.shutdown()
+            self.copy_engine = CopyEngine(stored.config.copy_workers, self.pacer)
+
+    def on_server_lag(self, behind_ms: float):
+        """服务器报告卡顿时降低后台复制的速度"""
+        if not stored.config.lag_backoff:
+            return
+        self.pacer.on_lag(behind_ms)
+        if not (self.creating_backup_event.is_set() and self.merging_backup_event.is_set()):
+            rate = self.pacer.get_rate()
+            rate_message = f', copy rate limited to {format_file_size(rate)}/s' if rate > 0 else ''
+            stored.server.logger.info(f'Server is {behind_ms}ms behind, pause copying{rate_message}')
 
     @new_thread('DAB-Backup')
     def make_back_up(self, source: 'CommandSource', *, wait=False):
@@ -287,136 +573,449 @@ class DifferentialBackupper(object):
             if not self.restoring_backup_event.is_set():
                 print_message(source, '正在§c回档§r中, 请不要尝试备份', tell=False)
                 return
-            if not self.merging_backup_event.is_set():
-                print_message(source, '正在§a合并§r中, 请不要尝试备份', tell=False)
-                return
             if not self.creating_backup_event.is_set():
                 print_message(source, '正在§a备份§r中, 请不要重复输入', tell=False)
                 return
         else:
             self.restoring_backup_event.wait()
             self.creating_backup_event.wait()
-            self.merging_backup_event.wait()
         self.creating_backup_event.clear()
+        record = self.metrics.begin('backup')
+        success = False
         try:
-            slot_path, slot_data = self.slots.get_oldest_slot()
             start_time = time()
-            self.game_saved = False
             print_message(source, '正在进行§a自动备份§r...', tell=True)
+            self.save_off_duration = 0.0
             if stored.config.turn_off_auto_save:
                 stored.server.execute('save-off')
-            stored.server.execute('save-all flush')
-            while True:
-                sleep(0.1)
-                if self.game_saved:
-                    if self.stop_backup:
-                        self.stop_backup = False
-                        print_message(source, '内部标志位已设置, §a备份§r中断!', tell=False)
-                        return
-                    break
-                if self.unloaded:
-                    print_message(source, '插件被重载, §a备份§r中断!', tell=False)
-                    return
+                self.save_off_time = time()
+            with record.phase('wait_save'):
+                saved = self.save_game('save-all flush')
+            if self.unloaded:
+                print_message(source, '插件被重载, §a备份§r中断!', tell=False)
+                return
+            if not saved:
+                print_message(source, f'保存存档超过§6{stored.config.saving_timeout}§r秒, 强制关闭服务器, §a备份§r中断!', force_tell=True)
+                force_restart_server()
+                stored.clock_inst.reset_timer()
+                return
             print_message(source, '存档已保存, 正在备份有所更改的文件', tell=True)
-            all_file_mod_times = self.get_all_file_mod_times(stored.config.world_name)
-            changed_file_set = self.get_changed_file_set(self.slots.get_latest_slot()[1]['file_timestamps'], all_file_mod_times)
-            backup_size = self.copy_worlds(
-                stored.config.server_path, slot_path,
-                changed_file_set
-            )
+            latest_slot_info = self.slots.get_latest_slot()[1]
+            with record.phase('scan'):
+                all_file_mod_times = self.get_world_file_mod_times(latest_slot_info)
+                changed_file_set = self.get_changed_file_set(latest_slot_info['file_timestamps'], all_file_mod_times)
+            staged_checksums = {} if stored.config.backup_checksums else None
+            if stored.config.two_phase_backup:
+                # 第一阶段: 将更改的文件快速复制至暂存文件夹后立即恢复自动保存, 第二阶段再由暂存文件夹写入位次
+                with record.phase('stage'):
+                    src_path = self.stage_files(changed_file_set, staged_checksums)
+                self.resume_auto_save()
+            else:
+                src_path = stored.config.server_path
+            with record.phase('clear_slot'):
+                slot_path = self.recycle_oldest_slot()
+            region_deltas = set() if stored.config.region_chunk_backup else None
+            objects = {} if stored.config.content_addressed_storage else None
+            codec = self.get_compression_codec()
+            compressed = set() if codec is not None else None
+            checksums = {} if stored.config.backup_checksums else None
+            with record.phase('copy'), self.slots_lock:
+                backup_size, logical_size = self.copy_worlds(
+                    src_path, slot_path,
+                    changed_file_set, region_deltas, objects, compressed, codec,
+                    move=stored.config.two_phase_backup, checksums=checksums, staged_checksums=staged_checksums
+                )
+            self.resume_auto_save()
             info = {
                     'time': strftime("%Y/%m/%d %H:%M:%S", localtime()),
                     'time_stamp': time(),
                     'backup_size': backup_size,
+                    'logical_size': logical_size,
+                    'worlds': get_worlds(),
                     'included_files': {i for i, _ in changed_file_set},
-                    'file_timestamps': all_file_mod_times
+                    'file_timestamps': all_file_mod_times,
+                    'region_deltas': region_deltas or set(),
+                    'objects': objects or {},
+                    'compressed_files': compressed or set(),
+                    'checksums': checksums or {}
                 }
-            with open(join(slot_path, 'info.pickle'), 'wb') as f:
-                dump(info, f)
+            with record.phase('write_info'):
+                dump_slot_info(slot_path, info)
+                self.object_store.collect_garbage()
             end_time = time()
-            print_message(source, f'备份完成, 用时{round(end_time - start_time, 2)}秒, 备份大小: {format_file_size(backup_size)}', force_tell=True)
-            self.slots.add_slot_data((slot_path, info))
+            record['changed_files'] = len(changed_file_set)
+            record['logical_bytes'] = logical_size
+            record['stored_bytes'] = backup_size
+            record['copy_mb_per_second'] = logical_size / 2 ** 20 / record.phases['copy'] if record.phases['copy'] > 0 else 0.0
+            record.stop()
+            success = True
+            save_off_message = f', 其中关闭自动保存{round(self.save_off_duration, 2)}秒' if stored.config.turn_off_auto_save else ''
+            print_message(source, f'备份完成, 用时{round(end_time - start_time, 2)}秒{save_off_message}, 备份大小: {format_backup_size(info)}', force_tell=True)
+            with self.slots_lock:
+                self.slots.add_slot_data((slot_path, info))
+            self.schedule_compaction()
+            self.slots.release_file_timestamps()
+            if self.watcher is not None:
+                self.watcher.set_baseline(info['time_stamp'])
             stored.clock_inst.on_backup_created()
         except Exception as e:
             print_exc()
             print_message(source, f'§a备份§r失败, 错误代码{e}', force_tell=True)
         finally:
-            if self.used_slots_count < stored.config.slots:
-                self.used_slots_count += 1
             self.creating_backup_event.set()
-            if stored.config.turn_off_auto_save:
-                stored.server.execute('save-on')
+            self.resume_auto_save()
+            if stored.config.two_phase_backup:
+                rmtree(self.get_staging_path(), ignore_errors=True)
+            record['save_off_seconds'] = self.save_off_duration
+            self.metrics.finish(record, success)
+
+    def recycle_oldest_slot(self) -> 'PathLike[str]':
+        """
+        清空第一分区中最旧的位次并返回其路径
+        该位次参与进行中的合并(或为其中区域差异文件的基础版本)时须等待合并完成
+        该位次仍在使用且有整理任务尚未完成时先等待其完成, 以免覆盖即将被合并至下一分区的位次
+        """
+        while True:
+            with self.slots_lock:
+                slot_path, slot_info = self.slots.get_oldest_slot()
+                compacting = slot_info['time_stamp'] != -inf and self.compaction_queue.is_busy()
+                if not compacting and slot_path not in self.merging_slots:
+                    self.clear_slot_files(slot_path, slot_info)
+                    self.slots.replace_slot_data(slot_path, empty_info)
+                    return slot_path
+            if compacting:
+                self.compaction_queue.wait_idle()
+            else:
+                self.merging_backup_event.wait()
+
+    def resume_auto_save(self):
+        if self.save_off_time is not None:
+            stored.server.execute('save-on')
+            self.save_off_duration = time() - self.save_off_time
+            self.save_off_time = None
+
+    @staticmethod
+    def get_staging_path() -> 'PathLike[str]':
+        return stored.config.staging_path or join(stored.config.backup_path, 'staging')
+
+    def stage_files(self, file_list: 'TimeSet', checksums: Optional[dict['PathLike[str]', str]] = None) -> 'PathLike[str]':
+        """
+        将文件复制至暂存文件夹并返回其路径, 暂存文件夹与存档位于支持reflink的同一文件系统时几乎不占用时间与空间
+        区域文件会被服务端原地写入, 故不能使用硬链接
+        checksums不为None时在暂存的同时计算sha256并记录于其中, 文件被移动至位次时无需再次读取
+        """
+        staging_path = self.get_staging_path()
+        if exists(staging_path):
+            rmtree(staging_path)
+        files = [f for f, _ in file_list if split(f)[1] not in stored.config.ignored_files]
+        if checksums is None:
+            self.copy_files([join(stored.config.server_path, f) for f in files], [join(staging_path, f) for f in files])
+        else:
+            tasks: list['CopyTask'] = []
+            for file in files:
+                src_file = join(stored.config.server_path, file)
+                tasks.append((get_allocated_size(src_file), partial(self.stage_file, file, src_file, join(staging_path, file), checksums)))
+            self.copy_engine.run(tasks)
+        return staging_path
+
+    @staticmethod
+    def stage_file(file, src, dst, checksums: dict['PathLike[str]', str]) -> int:
+        makedirs(split(dst)[0], exist_ok=True)
+        hasher = sha256()
+        transfer_file(src, dst, hasher=hasher)
+        checksums[file] = hasher.hexdigest()
+        return get_allocated_size(dst)
 
-    def copy_worlds(self, src_path, dst_path, file_list: 'TimeSet') -> int:
+    def copy_worlds(self, src_path, dst_path, file_list: 'TimeSet', region_deltas: Optional[set['PathLike[str]']] = None, objects: Optional[dict['PathLike[str]', str]] = None,
+                    compressed: Optional[set['PathLike[str]']] = None, codec: Optional[Codec] = None, move=False,
+                    checksums: Optional[dict['PathLike[str]', str]] = None, staged_checksums: Optional[dict['PathLike[str]', str]] = None) -> tuple[int, int]:
+        """
+        region_deltas不为None时对区域文件进行区块级别的差异备份, 并将以差异文件储存的区域文件加入其中
+        objects不为None时将其余文件存入对象储存, 并在其中记录文件到哈希值的映射
+        compressed不为None时以codec压缩其余文件, 并将被压缩的文件加入其中. 作为差异备份基础的区域文件不会被压缩
+        move为True时源文件可被直接移动至位次中(用于暂存文件夹)
+        checksums不为None时在复制的同时计算sha256并记录于其中(对象储存的文件以其哈希值校验, 不再记录), 被移动的文件使用staged_checksums中暂存时计算的值
+        全部存档文件夹的文件在同一次复制中并行进行, 返回(占用空间, 原始大小)
+        """
         rmtree(dst_path)
         makedirs(dst_path)
-        total_file_size = 0
-        _src_path = join(src_path, stored.config.world_name)
-        _dst_path = join(dst_path, stored.config.world_name)
-        stored.server.logger.info(f'copying {_src_path} -> {_dst_path}')
+        stored.server.logger.info(f'copying {", ".join(join(src_path, i) for i in get_worlds())} -> {dst_path}')
+        tasks: list['CopyTask'] = []
         for file, time in file_list:
-            src_file = join(_src_path, file)
+            src_file = join(src_path, file)
             if split(src_file)[1] in stored.config.ignored_files:
                 continue
-            dst_file = join(_dst_path, file)
-            makedirs(split(dst_file)[0], exist_ok=True)
-            total_file_size += getsize(src_file)
-            copy2(src_file, dst_file)
-        return total_file_size
+            size = getsize(src_file)
+            tasks.append((size, partial(self.backup_file, file, src_file, join(dst_path, file), dst_path, size, region_deltas, objects, compressed, codec, move, checksums, staged_checksums)))
+        return self.copy_engine.run(tasks, paced=True), sum(size for size, _ in tasks)
+
+    def backup_file(self, file, src_file, dst_file, slot_path, size: int, region_deltas: Optional[set['PathLike[str]']], objects: Optional[dict['PathLike[str]', str]],
+                    compressed: Optional[set['PathLike[str]']] = None, codec: Optional[Codec] = None, move=False,
+                    checksums: Optional[dict['PathLike[str]', str]] = None, staged_checksums: Optional[dict['PathLike[str]', str]] = None) -> int:
+        makedirs(split(dst_file)[0], exist_ok=True)
+        hasher = sha256() if checksums is not None else None
+        if region_deltas is not None and is_region_file(file):
+            last_version = self.get_latest_region_version(file, exclude=slot_path)
+            if last_version is not None and not last_version.compressed:
+                header = read_region_header(src_file)
+                size = RegionDelta.write(src_file, delta_file_name(dst_file), header, get_changed_chunks(last_version.header, header), hasher)
+                region_deltas.add(file)
+                if hasher is not None:
+                    checksums[file] = hasher.hexdigest()
+                return size
+        if objects is not None:
+            objects[file], size = self.object_store.put_file(src_file)
+            return size
+        if compressed is not None and not (region_deltas is not None and is_region_file(file)):
+            size = compress_file(src_file, dst_file + COMPRESSED_SUFFIX, codec, stored.config.compression_level, hasher)
+            compressed.add(file)
+        elif move and self.move_into_slot(src_file, dst_file):
+            if checksums is not None:
+                checksums[file] = staged_checksums[file]
+            return get_allocated_size(dst_file)
+        else:
+            transfer_file(src_file, dst_file, hasher=hasher)
+            size = get_allocated_size(dst_file)
+        if hasher is not None:
+            checksums[file] = hasher.hexdigest()
+        return size
+
+    @staticmethod
+    def move_into_slot(src_file, dst_file) -> bool:
+        try:
+            replace(src_file, dst_file)
+            return True
+        except OSError:
+            return False
+
+    def get_backup_file(self, slot_path: 'PathLike[str]', slot_info: 'SlotInfoDict', file: 'PathLike[str]') -> 'PathLike[str]':
+        """返回位次中储存该文件完整内容的路径"""
+        digest = slot_info.get('objects', {}).get(file)
+        if digest is not None:
+            return self.object_store.get_object_path(digest)
+        if file in slot_info.get('compressed_files', ()):
+            return join(slot_path, file + COMPRESSED_SUFFIX)
+        return join(slot_path, file)
+
+    def clear_slot_files(self, slot_path: 'PathLike[str]', slot_info: 'SlotInfoDict'):
+        """清空位次文件夹并释放其引用的对象, 计数归零的对象需调用collect_garbage删除"""
+        self.fold_region_deltas(slot_path)
+        self.slots.unindex_slot(slot_path, slot_info)
+        self.object_store.release(slot_info.get('objects', {}).values())
+        rmtree(slot_path)
+        mkdir(slot_path)
+
+    def get_region_version(self, slot_path: 'PathLike[str]', slot_info: 'SlotInfoDict', file: 'PathLike[str]') -> RegionVersion:
+        if file in slot_info.get('region_deltas', ()):
+            return RegionVersion(join(slot_path, delta_file_name(file)), True)
+        return RegionVersion(self.get_backup_file(slot_path, slot_info, file), False, file in slot_info.get('compressed_files', ()))
+
+    def get_latest_region_version(self, file: 'PathLike[str]', exclude: 'PathLike[str]' = None) -> Optional[RegionVersion]:
+        slot_path = self.slots.get_holder_index().get_latest_holder(file)
+        if slot_path is None or slot_path == exclude:
+            return None
+        return self.get_region_version(slot_path, self.slots.get_slot_by_path(slot_path), file)
+
+    def get_region_chain(self, slot_chain: list[tuple['PathLike[str]', 'SlotInfoDict']], file: 'PathLike[str]') -> list[RegionVersion]:
+        """slot_chain须由新到旧排列, 返回从最新版本到第一个完整版本的区域文件版本链"""
+        chain = []
+        for slot_path, slot_info in slot_chain:
+            if file not in slot_info['included_files']:
+                continue
+            version = self.get_region_version(slot_path, slot_info, file)
+            chain.append(version)
+            if not version.is_delta:
+                return chain
+        raise FileNotFoundError(f'No complete version of {file} found in the backup chain')
+
+    def fold_region_deltas(self, slot_path: 'PathLike[str]'):
+        """位次被覆盖或清空前, 将依赖其中区域文件的较新差异文件重建为完整文件"""
+        slot_chain = self.slots.get_slot_chain()
+        index = next((n for n, (p, _) in enumerate(slot_chain) if p == slot_path), None)
+        if index is None:
+            return
+        changed_slots = {}
+        for file in slot_chain[index][1]['included_files']:
+            if not is_region_file(file):
+                continue
+            for n in range(index - 1, -1, -1):
+                newer_slot_path, newer_slot_info = slot_chain[n]
+                if file not in newer_slot_info['included_files']:
+                    continue
+                if file in newer_slot_info.get('region_deltas', ()):
+                    dst_file = join(newer_slot_path, file)
+                    checksums = newer_slot_info.get('checksums', {})
+                    hasher = sha256() if file in checksums else None
+                    rebuild_region(self.get_region_chain(slot_chain[n:], file), dst_file, hasher)
+                    remove(delta_file_name(dst_file))
+                    newer_slot_info['region_deltas'].discard(file)
+                    if hasher is not None:
+                        checksums[file] = hasher.hexdigest()
+                    changed_slots[newer_slot_path] = newer_slot_info
+                break
+        for p, i in changed_slots.items():
+            dump_slot_info(p, i)
+
+    def restore_files(self, slot_chain: list[tuple['PathLike[str]', 'SlotInfoDict']], restore_plan: dict['PathLike[str]', int], dst_path, objects: Optional[dict['PathLike[str]', str]] = None,
+                      compressed: Optional[set['PathLike[str]']] = None, hardlink=False, cancel_event: Optional[Event] = None, paced=False) -> int:
+        """
+        restore_plan为文件到slot_chain下标的映射, 区域差异文件将被重建为完整文件
+        objects不为None时已存入对象储存的文件仅增加引用并记录于其中, 不进行复制
+        compressed不为None时被压缩的文件将保持压缩状态复制并记录于其中, 否则将被解压
+        hardlink为True时尽可能以硬链接代替复制, 仅可用于目标位于备份文件夹内的情况
+        cancel_event被设置后尚未开始的复制将被跳过, paced为True时受复制速度限制
+        """
+        tasks: list['CopyTask'] = []
+        for file, n in restore_plan.items():
+            slot_path, slot_info = slot_chain[n]
+            dst_file = join(dst_path, file)
+            if file in slot_info.get('region_deltas', ()):
+                delta_file = join(slot_path, delta_file_name(file))
+                tasks.append((getsize(delta_file), partial(self.rebuild_region_file, slot_chain[n:], file, dst_file)))
+            elif objects is not None and file in slot_info.get('objects', {}):
+                objects[file] = slot_info['objects'][file]
+                self.object_store.acquire((objects[file],))
+            elif file in slot_info.get('compressed_files', ()):
+                backup_file = self.get_backup_file(slot_path, slot_info, file)
+                if compressed is not None:
+                    compressed.add(file)
+                    tasks.append(self.get_copy_task(backup_file, dst_file + COMPRESSED_SUFFIX, hardlink))
+                else:
+                    tasks.append((getsize(backup_file), partial(self.decompress_file, backup_file, dst_file)))
+            else:
+                tasks.append(self.get_copy_task(self.get_backup_file(slot_path, slot_info, file), dst_file, hardlink))
+        return self.copy_engine.run(tasks, cancel_event, paced)
+
+    def rebuild_region_file(self, slot_chain: list[tuple['PathLike[str]', 'SlotInfoDict']], file, dst_file, checksums: Optional[dict['PathLike[str]', str]] = None) -> int:
+        """checksums不为None时将重建的文件的sha256记录于其中"""
+        if exists(dst_file):
+            remove(dst_file)
+        makedirs(split(dst_file)[0], exist_ok=True)
+        hasher = sha256() if checksums is not None else None
+        size = rebuild_region(self.get_region_chain(slot_chain, file), dst_file, hasher)
+        if hasher is not None:
+            checksums[file] = hasher.hexdigest()
+        return size
+
+    def get_copy_task(self, src, dst, hardlink=False) -> 'CopyTask':
+        """以实际分配的字节数作为大小, 稀疏文件的空洞不会被复制"""
+        size = get_allocated_size(src)
+        return size, partial(self.copy_file, src, dst, size, hardlink)
+
+    @staticmethod
+    def copy_file(src, dst, size: int, hardlink=False) -> int:
+        if exists(dst):
+            remove(dst)
+        makedirs(split(dst)[0], exist_ok=True)
+        transfer_file(src, dst, hardlink)
+        return size
+
+    @staticmethod
+    def decompress_file(src, dst) -> int:
+        makedirs(split(dst)[0], exist_ok=True)
+        return decompress_file(src, dst)
+
+    @staticmethod
+    def get_compression_codec() -> Optional[Codec]:
+        try:
+            return get_codec(stored.config.compression)
+        except ValueError as e:
+            stored.server.logger.warning(f'{e}, lzma will be used instead')
+            return CODECS['lzma']
 
     def copy_files(self, src_file_list, dst_file_list) -> int:
-        total_file_size = 0
-        for src, dst in zip(src_file_list, dst_file_list, strict=True):
+        return self.copy_engine.run(self.get_copy_task(src, dst) for src, dst in zip(src_file_list, dst_file_list, strict=True))
+
+    @staticmethod
+    def move_file(src, dst) -> int:
+        """位于同一文件系统时直接重命名, 否则复制后删除源文件"""
+        size = get_allocated_size(src)
+        makedirs(split(dst)[0], exist_ok=True)
+        try:
+            replace(src, dst)
+        except OSError:
             if exists(dst):
                 remove(dst)
-            makedirs(split(dst)[0], exist_ok=True)
-            total_file_size += getsize(src)
-            copy2(src, dst)
-        return total_file_size
+            transfer_file(src, dst)
+            remove(src)
+        return size
+
+    def move_files(self, src_file_list, dst_file_list) -> int:
+        return sum(self.move_file(src, dst) for src, dst in zip(src_file_list, dst_file_list, strict=True))
 
     @new_thread('DAB-Backup')
     def del_backup(self, source: 'CommandSource', slot: int):
-        if not (self.creating_backup_event.is_set() and self.restoring_backup_event.is_set()):
+        def busy() -> bool:
+            return not (self.creating_backup_event.is_set() and self.restoring_backup_event.is_set() and self.merging_backup_event.is_set())
+
+        if busy():
             print_message(source, '正在执行其他操作, 请不要尝试删除备份', tell=False)
             return
         try:
-            if slot == 0:
-                rmtree(join(stored.config.backup_path, stored.config.overwrite_backup_folder))
-                self.slots.overwrite_backup_info = None
-            else:
-                print_message(source, '§c已关闭删除位次功能', tell=False)
-                return
-                slot_index = self.slots.get_slot_index(slot)
-                slot_path, slot_info = self.slots.slots_deque[self.slots.get_slot_index(slot)]
-                rmtree(slot_path)
-                mkdir(slot_path)
-                del self.slots.slots_deque[slot_index]
-                self.slots.slots_deque.appendleft((slot_path, empty_info))
-                if self.used_slot_number > 0:
-                    self.used_slot_number -= 1
+            # 与整理任务相同, 先取得merge_lock, 删除期间其他合并不能开始
+            with self.merge_lock:
+                with self.slots_lock:
+                    if busy():
+                        print_message(source, '正在执行其他操作, 请不要尝试删除备份', tell=False)
+                        return
+                    last_slot = self.slots.get_last_displayed_slot_id()
+                    used = [i for i in range(1, last_slot + 1) if self.slots.get_slot_data(i)[1]['time_stamp'] != -inf]
+                    if slot != 0 and not any(i >= slot for i in used):
+                        print_message(source, f'位次§6{slot}§r及更早的位次中没有备份', tell=False)
+                        return
+                    # 比被删除的位次新的位次中最旧的一个, 被删除的位次将并入其中
+                    newer_slot = max((i for i in used if i < slot), default=None)
+                    if slot == 0:
+                        rmtree(join(stored.config.backup_path, stored.config.overwrite_backup_folder))
+                        self.slots.overwrite_backup_info = None
+                    elif newer_slot is None:
+                        # 没有更新的位次可以并入, 全部备份均被删除
+                        for i in range(last_slot, 0, -1):
+                            self.slots.clear_slot_data(i, del_files=True)
+                        self.object_store.collect_garbage(i.get('objects', {}) for _, i in self.slots.get_slot_chain())
+                if slot != 0 and newer_slot is not None:
+                    # 各位次只包含更改的文件, 与prune_oldest_slot相同, 将被删除的位次并入比它们新的一个位次, 仅保留较新的文件版本
+                    stored.server.logger.info(f'Delete slots {slot}~{last_slot} by merging them into slot {newer_slot}')
+                    if not self._merge_slots(source, newer_slot, last_slot):
+                        raise RuntimeError('合并失败')
         except Exception as e:
             print_message(source, f'§4删除位次§6{slot}§r失败§r, 错误代码: {e}', tell=False)
         else:
-            print_message(source, f'§a删除位次§6{slot}§r完成§r', tell=False)
+            if slot != 0 and newer_slot is not None:
+                print_message(source, f'§a删除位次§6{slot}§r完成§r, 此后未被更改的文件已并入位次§6{newer_slot}§r', tell=False)
+            else:
+                print_message(source, f'§a删除位次§6{slot}§r完成§r', tell=False)
 
-    @new_thread('DAB-Restore')
-    def restore_backup(self, source: CommandSource, slot: int):
+    def check_restore_available(self, source: 'CommandSource', requesting=False) -> bool:
+        """检查当前能否进行回档, 不能时向source说明原因. requesting为True时还需没有尚未确认的回档请求"""
         if not self.creating_backup_event.is_set():
             print_message(source, '正在§c备份§r中, 请不要尝试回档', tell=False)
-            return
+            return False
         if not self.merging_backup_event.is_set():
             print_message(source, '正在§a合并§r中, 请不要尝试回档', tell=False)
-            return
+            return False
         if not self.restoring_backup_event.is_set():
             print_message(source, '正在§a回档§r中, 请不要重复输入', tell=False)
-            return
-        if self.restore_slot_selected is not None:
+            return False
+        if requesting and (self.restore_slot_selected is not None or stored.partial_restore_inst.selected is not None):
             print_message(source, f'已有一个§a回档§r请求, 请使用§7{stored.cmd_prefix} confirm§r确认回档', tell=False)
+            return False
+        return True
+
+    @new_thread('DAB-Restore')
+    def restore_backup(self, source: CommandSource, slot: int):
+        if not self.check_restore_available(source, requesting=True):
             return
         self.restore_slot_selected = (slot, self.slots.get_slot_data(slot))
-        self.abort_restore = False
+        self.abort_restore_event.clear()
         slot_info = self.restore_slot_selected[1][1]
         print_message(source, f'准备将存档恢复至位次§6{slot}§r, 存档时间: {slot_info["time"]}', force_tell=True)
+        try:
+            slot_chain, restore_plan, non_overwriteable_files, _ = self.get_restore_plan(slot)
+            restore_size = sum(self.get_restore_file_size(*slot_chain[n], f) for f, n in restore_plan.items())
+            print_message(source, f'需要恢复§6{len(restore_plan)}§r个文件(§2{format_file_size(restore_size)}§r), 删除§6{len(non_overwriteable_files)}§r个文件', force_tell=True)
+        except Exception:
+            stored.server.logger.exception('Failed to calculate restore plan')
         print_message(
             source,
             RTextList(
@@ -426,159 +1025,508 @@ class DifferentialBackupper(object):
             ), force_tell=True
         )
 
+    def get_restore_plan(self, displayed_slot_id: int, executing=False) -> tuple[list[tuple['PathLike[str]', 'SlotInfoDict']], dict['PathLike[str]', int], set['PathLike[str]'], set['PathLike[str]']]:
+        """
+        返回(目标位次及更早的位次, 需恢复的文件到其所在位次下标的映射, 需删除的文件, 当前存档中的全部文件)
+        仅mtime与目标位次记录不同的文件需要恢复, 其在目标位次时的版本位于不晚于目标位次的最新一个包含它的位次
+        executing为True时代表即将进行回档, 将记录无法恢复的文件并修正与备份相同的文件的mtime
+        """
+        slot_chain = self.slots.get_slot_chain(displayed_slot_id)
+        chain_index = {p: n for n, (p, _) in enumerate(slot_chain)}
+        target_slot_info = slot_chain[0][1]
+        target_file_timestamps = target_slot_info['file_timestamps']
+        # 仅处理目标位次备份过的存档文件夹, 此后才加入配置的存档不会被删除
+        current_file_timestamps = self.get_all_file_mod_times(target_slot_info.get('worlds') or get_worlds())
+        current_files = {f for f, t in current_file_timestamps}
+        non_overwriteable_files = current_files - {f for f, t in target_file_timestamps}
+        holder_index = self.slots.get_holder_index()
+        restore_plan: dict['PathLike[str]', int] = {}
+        for file, _ in target_file_timestamps - current_file_timestamps:
+            n = chain_index.get(holder_index.get_holder(file, target_slot_info['time_stamp']))
+            if n is not None:
+                restore_plan[file] = n
+            elif executing:
+                stored.server.logger.warning(f'{file} is not included in any backup before slot {displayed_slot_id}, skipped')
+        if stored.config.restore_skip_identical:
+            self.skip_identical_files(slot_chain, restore_plan, executing)
+        return slot_chain, restore_plan, non_overwriteable_files, current_files
+
+    def skip_identical_files(self, slot_chain: list[tuple['PathLike[str]', 'SlotInfoDict']], restore_plan: dict['PathLike[str]', int], touch=False):
+        """
+        从restore_plan中移除仅mtime不同而内容与备份相同的文件, touch为True时将其mtime修改为目标位次中的记录
+        区域文件比较各区块的时间戳与扇区数, 其余文件仅在启用restore_compare_content时比较大小与哈希值
+        """
+        identical_files = set()
+
+        def compare(file, n) -> int:
+            live_file = join(stored.config.server_path, file)
+            if not exists(live_file):
+                return 0
+            slot_path, slot_info = slot_chain[n]
+            if is_region_file(file):
+                if self.get_region_version(slot_path, slot_info, file).header.is_same_chunks(read_region_header(live_file)):
+                    identical_files.add(file)
+                return 0
+            if not stored.config.restore_compare_content:
+                return 0
+            backup_file = self.get_backup_file(slot_path, slot_info, file)
+            is_compressed = file in slot_info.get('compressed_files', ())
+            if (read_frame_header(backup_file).size if is_compressed else getsize(backup_file)) != getsize(live_file):
+                return 0
+            digest = slot_info.get('objects', {}).get(file) or (compressed_digest(backup_file) if is_compressed else file_digest(backup_file))
+            if digest == file_digest(live_file):
+                identical_files.add(file)
+            return 0
+
+        self.copy_engine.run((0, partial(compare, f, n)) for f, n in restore_plan.items())
+        if not identical_files:
+            return
+        for file in identical_files:
+            del restore_plan[file]
+        if touch:
+            for file, mtime in slot_chain[0][1]['file_timestamps']:
+                if file in identical_files:
+                    try:
+                        utime(join(stored.config.server_path, file), (mtime, mtime))
+                    except OSError:
+                        pass
+            stored.server.logger.info(f'Skipped {len(identical_files)} files identical to the backup')
+
+    def get_restore_file_size(self, slot_path: 'PathLike[str]', slot_info: 'SlotInfoDict', file: 'PathLike[str]') -> int:
+        if file in slot_info.get('region_deltas', ()):
+            return RegionDelta(join(slot_path, delta_file_name(file))).header.get_file_size()
+        if file in slot_info.get('compressed_files', ()):
+            return read_frame_header(self.get_backup_file(slot_path, slot_info, file)).size
+        return getsize(self.get_backup_file(slot_path, slot_info, file))
+
     def trigger_abort(self, source):
-        self.abort_restore = True
-        self.slot_selected = None
+        self.abort_restore_event.set()
+        if self.restoring_backup_event.is_set():
+            self.restore_slot_selected = None
+            stored.partial_restore_inst.selected = None
         print_message(source, '已终止操作', tell=False)
 
     @new_thread('DAB-Restore')
     def confirm_restore(self, source: CommandSource):
-        if self.restore_slot_selected is None:
+        if self.restore_slot_selected is None and stored.partial_restore_inst.selected is None:
             print_message(source, '没有回档请求需要确认', tell=False)
         else:
-            if not self.creating_backup_event.is_set():
-                print_message(source, '正在§c备份§r中, 请不要尝试回档', tell=False)
-                return
-            if not self.merging_backup_event.is_set():
-                print_message(source, '正在§a合并§r中, 请不要尝试回档', tell=False)
-                return
-            if not self.restoring_backup_event.is_set():
-                print_message(source, '正在§a回档§r中, 请不要重复输入', tell=False)
+            if not self.check_restore_available(source):
                 return
             self.restoring_backup_event.clear()
-            self._do_restore_backup(source, self.restore_slot_selected[0])
+            self.abort_restore_event.clear()    # 忽略未在回档时输入的abort
+            if self.restore_slot_selected is not None:
+                self._do_restore_backup(source, self.restore_slot_selected[0])
+            else:
+                stored.partial_restore_inst.execute(source)
+
+    def countdown(self, source: CommandSource, seconds=10) -> bool:
+        """每秒广播一次关闭服务器的倒计时, 期间输入abort时返回False"""
+        deadline = time() + seconds
+        for countdown in range(seconds, 0, -1):
+            print_message(source, command_run(
+                f'{countdown}秒后关闭服务器',
+                '点击终止回档',
+                f'{stored.cmd_prefix} abort'
+            ), force_tell=True)
+            if self.abort_restore_event.wait(max(deadline - countdown + 1 - time(), 0)):
+                return False
+        return True
+
+    @staticmethod
+    def stop_server():
+        for i in stored.online_player_api.get_player_list():
+            stored.server.execute(f'kick {i}')
+        stored.server.stop()
+        stored.server.logger.info('Wait for server to stop')
+        stored.server.wait_for_start()
+
+    @staticmethod
+    def get_restore_staging_path() -> 'PathLike[str]':
+        """须与存档位于同一文件系统, 以便关闭服务器后直接重命名"""
+        return join(stored.config.server_path, RESTORE_STAGING_FOLDER)
+
+    def prestage_restore(self, displayed_slot_id: int, staging_path, staged_files: dict['PathLike[str]', 'PathLike[str]'], done_event: Event, record: OperationRecord):
+        """
+        在服务器仍在运行时按当前的回档计划将需恢复的文件准备至staging_path, 并在staged_files中记录文件来自的位次路径
+        回档被中断时尚未开始的复制将被跳过
+        """
+        try:
+            with record.phase('prestage'):
+                slot_chain, restore_plan, _, _ = self.get_restore_plan(displayed_slot_id)
+                if exists(staging_path):
+                    rmtree(staging_path)
+                size = self.restore_files(slot_chain, restore_plan, staging_path, cancel_event=self.abort_restore_event, paced=True)
+            if not self.abort_restore_event.is_set():
+                staged_files.update((file, slot_chain[n][0]) for file, n in restore_plan.items())
+                stored.server.logger.info(f'Prestaged {len(restore_plan)} files ({format_file_size(size)}) for restoring')
+        except Exception:
+            stored.server.logger.exception('Failed to prestage files for restoring, they will be copied after the server stops')
+        finally:
+            done_event.set()
 
     def _do_restore_backup(self, source: CommandSource, displayed_slot_id: int):
+        staging_path = self.get_restore_staging_path() if stored.config.prestage_restore else None
+        staged_files: dict['PathLike[str]', 'PathLike[str]'] = {}
+        record = self.metrics.begin('restore')
+        success = False
         try:
+            if staging_path is not None:
+                prestaged_event = Event()
+                Thread(
+                    target=self.prestage_restore, args=(displayed_slot_id, staging_path, staged_files, prestaged_event, record),
+                    name='DAB-Restore-Stage', daemon=True
+                ).start()
+            countdown_start = perf_counter()
             print_message(source, '10秒后将关闭服务器进行§c回档§r', force_tell=True)
-            for countdown in range(10, 0, -1):
-                print_message(source, command_run(
-                    f'{countdown}秒后关闭服务器',
-                    '点击终止回档',
-                    f'{stored.cmd_prefix} abort'
-                ), force_tell=True)
-                for _ in range(10):
-                    sleep(0.1)
-                    if self.abort_restore:
-                        print_message(source, '已中断§c回档§r', force_tell=True)
-                        return
+            self.countdown(source)
+            if staging_path is not None:
+                if not (prestaged_event.is_set() or self.abort_restore_event.is_set()):
+                    print_message(source, '正在准备回档所需的文件, 完成后将关闭服务器', force_tell=True)
+                # 中断回档时尚未开始的复制会被跳过, 故等待时间不超过单个文件的复制时间
+                prestaged_event.wait()
+            record.add_phase('countdown', perf_counter() - countdown_start)
+            if self.abort_restore_event.is_set():
+                print_message(source, '已中断§c回档§r', force_tell=True)
+                return
 
-            for i in stored.online_player_api.get_player_list():
-                stored.server.execute('kick')
-            stored.server.stop()
-            stored.server.logger.info('Wait for server to stop')
-            stored.server.wait_for_start()
+            downtime_start = perf_counter()
+            with record.phase('stop_server'):
+                self.stop_server()
 
             stored.server.logger.info('Backup current world to avoid idiot')
+            server_path = stored.config.server_path
             overwrite_backup_path = join(stored.config.backup_path, stored.config.overwrite_backup_folder)
             if exists(overwrite_backup_path):
                 rmtree(overwrite_backup_path)
-            else:
-                mkdir(overwrite_backup_path)
-
-            overwritten_files = set()
-            range_iter = range(displayed_slot_id, 0, -1).__iter__()
-            _slot_path, _slot_info = self.slots.get_slot_data(next(range_iter))
-            non_overwriteable_files = self.get_all_file(stored.config.world_name) - {f for f, t in _slot_info['file_timestamps']}
-            _included_files: set['PathLike[str]'] = _slot_info['included_files'] - non_overwriteable_files
-            source_files = {join(_slot_path, stored.config.world_name, i) for i in _included_files}
-            overwritten_files |= _included_files
-            for i in range_iter:
-                slot_path, slot_info = self.slots.get_slot_data(i)
-                included_files: set['PathLike[str]'] = slot_info['included_files'] - non_overwriteable_files
-                source_files.update(join(slot_path, stored.config.world_name, i) for i in (included_files - overwritten_files))
-                overwritten_files |= included_files
-
-            src_file_list = [join(stored.config.server_path, stored.config.world_name, i) for i in overwritten_files]
-            backup_size = self.copy_files(
-                src_file_list,
-                [join(overwrite_backup_path, stored.config.world_name, i) for i in overwritten_files]
-            )
+            mkdir(overwrite_backup_path)
+
+            # 倒计时期间存档可能发生变化, 关闭服务器后重新计算回档计划, 仅来自相同位次的预备文件可被直接使用
+            with record.phase('plan'):
+                slot_chain, restore_plan, non_overwriteable_files, current_files = self.get_restore_plan(displayed_slot_id, executing=True)
+                overwritten_files = restore_plan.keys() & current_files
+                prestaged_files = {f for f, n in restore_plan.items() if staged_files.get(f) == slot_chain[n][0]}
+
+            with record.phase('overwrite_backup'):
+                # 将被预备文件替换的文件直接移入覆盖备份
+                backup_size = self.move_files(
+                    [join(server_path, i) for i in overwritten_files & prestaged_files],
+                    [join(overwrite_backup_path, i) for i in overwritten_files & prestaged_files]
+                )
+                backup_size += self.copy_files(
+                    [join(server_path, i) for i in overwritten_files - prestaged_files],
+                    [join(overwrite_backup_path, i) for i in overwritten_files - prestaged_files]
+                )
             info = {
                     'time': strftime("%Y/%m/%d %H:%M:%S", localtime()),
                     'time_stamp': time(),
                     'backup_size': backup_size,
+                    'worlds': get_worlds(),
                     'included_files': overwritten_files,
                     'file_timestamps': set()
                 }
-            with open(join(overwrite_backup_path, 'info.pickle'), 'wb') as f:
-                dump(info, f)
+            dump_slot_info(overwrite_backup_path, info)
             self.slots.overwrite_backup_info = info
 
             stored.server.logger.info('Delete new files since the selected archive was backed up')
             for i in non_overwriteable_files:
-                remove(join(stored.config.server_path, stored.config.world_name, i))
+                remove(join(server_path, i))
             stored.server.logger.info('Restore backup')
-            restore_size = self.copy_files(source_files, src_file_list)
+            with record.phase('restore'):
+                restore_size = self.move_files([join(staging_path, i) for i in prestaged_files], [join(server_path, i) for i in prestaged_files]) if prestaged_files else 0
+                restore_size += self.restore_files(slot_chain, {f: n for f, n in restore_plan.items() if f not in prestaged_files}, server_path)
 
-            stored.server.logger.info(f'Done, the size of all restored files is {format_file_size(restore_size)}')
+            self.slots.release_file_timestamps()
+            stored.server.logger.info(f'Done, the size of all restored files is {format_file_size(restore_size)}, {len(prestaged_files)} of {len(restore_plan)} files were prestaged')
             source.get_server().start()
+            record['downtime_seconds'] = perf_counter() - downtime_start
+            record['restored_files'] = len(restore_plan)
+            record['prestaged_files'] = len(prestaged_files)
+            record['deleted_files'] = len(non_overwriteable_files)
+            record['restored_bytes'] = restore_size
+            record['overwrite_backup_bytes'] = backup_size
+            record.stop()
+            success = True
         except Exception:
             stored.server.logger.exception(f'Fail to restore backup to precedence {displayed_slot_id}, triggered by {source}')
         finally:
-            self.abort_restore = False
+            self.metrics.finish(record, success)
+            if staging_path is not None:
+                rmtree(staging_path, ignore_errors=True)
+            self.abort_restore_event.clear()
             self.restore_slot_selected = None
             self.restoring_backup_event.set()
 
-    @new_thread('DAB-merge')
-    def merge_slots(self, source, starting: int, ending: int, target: int):
-        if not self.creating_backup_event.is_set():
-            print_message(source, '正在§c备份§r中, 请不要尝试合并', tell=False)
-            return
+    @new_thread('DAB-Merge')
+    def merge_slots(self, source: 'CommandSource', starting: int, ending: Optional[int] = None):
         if not self.restoring_backup_event.is_set():
             print_message(source, '正在§a回档§r中, 请不要尝试合并', tell=False)
             return
         if not self.merging_backup_event.is_set():
             print_message(source, '正在§a合并§r中, 请不要重复输入', tell=False)
             return
-        self._merge_slots(starting, ending, target, wait=False)
+        if ending is None:
+            ending = self.slots.get_last_displayed_slot_id()
+        if starting < 1 or ending <= starting:
+            print_message(source, '位次输入错误, 需要合并至少两个位次', tell=False)
+            return
+        self._merge_slots(source, starting, ending)
 
-    def _merge_slots(self, source, starting: int, ending: int, target_slots_index: int,* ,  wait=True):
-        if wait:
-            self.restoring_backup_event.wait()
-        try:
-            self.merging_backup_event.clear()
-            start_time = time()
-            print_message(source, '正在进行§a合并§r...')
-            overwritten_files: set['PathLike[str]'] = set()
-            source_files = set()
-            starting_slot_info = None
-            for n in range(starting, ending + 1):
-                slot_path, slot_info = self.slots.get_slot_data(n)
-                for i in (slot_info['included_files'] - overwritten_files):
-                    source_files.add(join(slot_path, stored.config.world_name, i))
-                overwritten_files |= slot_info['included_files']
-                if starting_slot_info is None:
-                    starting_slot_info = slot_info
-            slot_path, slot_info = self.slots.slots_list[target_slots_index].get_oldest_slot()
-            merge_size = self.copy_files(
-                source_files,
-                [join(slot_path, stored.config.world_name, i) for i in overwritten_files]
-            )
-            info = {
-                    'time': starting_slot_info['time'],
-                    'time_stamp': starting_slot_info['time_stamp'],
-                    'backup_size': merge_size,
-                    'included_files': overwritten_files,
-                    'file_timestamps': starting_slot_info['file_timestamps']
-                }
-            with open(join(slot_path, 'info.pickle'), 'wb') as f:
-                dump(info, f)
-            self.slots.slots_list[target_slots_index].add_slot_data((slot_path, info))
-            s_deque = self.slots.slots_list[target_slots_index - 1].slots_deque
-            for i, v in enumerate(s_deque):
-                slot_path = v[0]
-                rmtree(slot_path)
-                mkdir(slot_path)
-                s_deque[i] = (slot_path, empty_info)
-            self.used_slots_count -= starting - ending
-            end_time = time()
-            print_message(source, f'合并完成, 用时{round(end_time - start_time, 2)}秒, 合并大小: {format_file_size(merge_size)}', force_tell=True)
-        except Exception as e:
-            print_exc()
-            print_message(source, f'§a合并§r失败, 错误代码{e}', force_tell=True)
-        finally:
-            self.merging_backup_event.set()
+    def schedule_compaction(self):
+        """备份完成后将需要的合并与清理加入后台整理队列"""
+        self.compaction_queue.submit(('compact', 0), partial(self.run_compaction_job, self.make_room, 0))
+        if stored.config.max_backup_size > 0:
+            self.compaction_queue.submit(('prune',), partial(self.run_compaction_job, self.prune_backups))
+
+    def run_compaction_job(self, func, *args):
+        self.restoring_backup_event.wait()
+        with self.merge_lock:
+            func(*args)
+
+    def on_compaction_error(self, key):
+        stored.server.logger.exception(f'Compaction job {key} failed')
+
+    def make_room(self, slots_index: int):
+        """
+        分区已满时移出其中的位次, 使下次写入无需覆盖已使用的位次
+        按时间保留时将最旧的位次移入下一分区, 否则将整个分区合并为下一分区中的一个位次. 最后一个分区已满时清理最旧的位次
+        """
+        slots = self.slots.slots_list[slots_index]
+        if not slots.is_full():
+            return
+        if slots_index + 1 >= len(self.slots.slots_list):
+            self.prune_oldest_slot()
+        elif stored.config.retention_policy:
+            self.promote_oldest_slot(slots_index)
+        else:
+            self._merge_slots(stored.server.get_plugin_command_source(), slots.starting_slot, slots.ending_slot, slots_index + 1)
+
+    def promote_oldest_slot(self, slots_index: int):
+        """
+        将分区中最旧的位次移入下一分区, 若与下一分区中最新的位次处于同一周期则与其合并
+        即下一分区的每个周期仅保留最新的一个备份
+        """
+        slot_path, slot_info = self.slots.slots_list[slots_index].get_oldest_slot()
+        if slot_info['time_stamp'] == -inf:
+            return
+        next_slots = self.slots.slots_list[slots_index + 1]
+        displayed_slot_id = self.slots.get_displayed_slot_id(slot_path)
+        ending = displayed_slot_id
+        latest_path, latest_info = next_slots.get_latest_slot()
+        if latest_info['time_stamp'] != -inf:
+            period_index = get_period_index(slot_info['time_stamp'], next_slots.period)
+            if period_index is not None and period_index == get_period_index(latest_info['time_stamp'], next_slots.period):
+                ending = self.slots.get_displayed_slot_id(latest_path)
+        self._merge_slots(stored.server.get_plugin_command_source(), displayed_slot_id, ending, slots_index + 1)
+
+    def prune_oldest_slot(self) -> bool:
+        """
+        将最旧的位次合并至比它新的一个位次, 仅保留两者中较新的文件版本
+        各位次只包含更改的文件, 直接清空最旧的位次会丢失此后未被更改的文件
+        """
+        slot_chain = self.slots.get_slot_chain()
+        if len(slot_chain) < 2:
+            return False
+        (newer_path, _), (oldest_path, oldest_info) = slot_chain[-2:]
+        stored.server.logger.info(f'Prune backup {oldest_path} ({oldest_info["time"]})')
+        return self._merge_slots(
+            stored.server.get_plugin_command_source(), self.slots.get_displayed_slot_id(newer_path), self.slots.get_displayed_slot_id(oldest_path)
+        )
+
+    def prune_backups(self):
+        """备份文件夹超过max_backup_size时由最旧的分区开始清理位次, 最新的位次总会被保留"""
+        limit = stored.config.max_backup_size * 2 ** 30
+        while (usage := get_disk_usage(stored.config.backup_path)) > limit:
+            if not self.prune_oldest_slot():
+                stored.server.logger.warning(f'Backup size {format_file_size(usage)} exceeds the limit, but no more backup can be pruned')
+                return
+
+    def _merge_slots(self, source, starting: int, ending: int, target_slots_index: Optional[int] = None) -> bool:
+        """
+        将位次starting~ending(包括端点)合并为一个位次, 合并后的位次包含其中每个文件的最新版本, 时间与其中最新的位次相同
+        target_slots_index为None时合并后的位次替换其中最新的位次, 否则写入该分区:
+        源位次中有属于该分区的位次时替换其中最新的一个, 否则写入该分区最旧的位次(该分区已满时先调用make_room)
+        文件在合并文件夹中组成新位次(启用hardlink_backup_files时以硬链接代替复制), 仅基础版本将被合并的区域差异文件需要重建,
+        完成后在slots_lock内将源位次移出并重命名合并文件夹, 备份仅在需要覆盖参与合并的位次时等待
+        """
+        with self.merge_lock:
+            record = self.metrics.begin('merge')
+            success = False
+            merged_objects: Optional[dict['PathLike[str]', str]] = None
+            temp_path = join(stored.config.backup_path, MERGE_FOLDER)
+            trash_path = join(stored.config.backup_path, MERGE_TRASH_FOLDER)
+            try:
+                start_time = time()
+                target_path = None
+                if target_slots_index is not None:
+                    target_slots = self.slots.slots_list[target_slots_index]
+                    target_path = next((
+                        p for p in (self.slots.get_slot_data(n)[0] for n in range(starting, ending + 1))
+                        if p in {i for i, _ in target_slots.slots_deque} and self.slots.get_slot_by_path(p)['time_stamp'] != -inf
+                    ), None)
+                if target_slots_index is not None and target_path is None:
+                    self.make_room(target_slots_index)
+                    with record.phase('clear_slot'), self.slots_lock:
+                        target_path, target_info = target_slots.get_oldest_slot()
+                        self.clear_slot_files(target_path, target_info)
+                        self.slots.replace_slot_data(target_path, empty_info)
+                with record.phase('plan'), self.slots_lock:
+                    sources = [self.slots.get_slot_data(n) for n in range(starting, ending + 1)]
+                    sources = [i for i in sources if i[1]['time_stamp'] != -inf]
+                    if not sources or (target_path is None and len(sources) < 2):
+                        print_message(source, '没有需要§a合并§r的位次', tell=False)
+                        return False
+                    if target_path is None:
+                        target_path = sources[0][0]
+                    slot_chain = self.slots.get_slot_chain()
+                    chain_index = {p: n for n, (p, _) in enumerate(slot_chain)}
+                    first, last = chain_index[sources[0][0]], chain_index[sources[-1][0]]
+                    merge_plan: dict['PathLike[str]', int] = {}
+                    for n in range(first, last + 1):
+                        for file in slot_chain[n][1]['included_files']:
+                            merge_plan.setdefault(file, n)
+                    # 区域差异文件的基础版本位于更早的位次时保留差异文件, 此时其版本链上的位次也不能被覆盖
+                    delta_bases: dict['PathLike[str]', int] = {}
+                    self.merging_slots = {p for p, _ in sources} | {target_path}
+                    for file, n in merge_plan.items():
+                        if file in slot_chain[n][1].get('region_deltas', ()):
+                            region_chain = self.get_region_chain_indexes(slot_chain, file, n)
+                            delta_bases[file] = region_chain[1]
+                            self.merging_slots.update(slot_chain[m][0] for m in region_chain if m > last)
+                    self.merging_backup_event.clear()
+                print_message(source, f'正在§a合并§r{len(sources)}个位次...', tell=False)
+
+                with record.phase('link'):
+                    if exists(temp_path):
+                        rmtree(temp_path)
+                    mkdir(temp_path)
+                    merged_objects = {}
+                    info = {
+                        'time': sources[0][1]['time'],
+                        'time_stamp': sources[0][1]['time_stamp'],
+                        'worlds': sorted(set().union(*(i['worlds'] for _, i in sources))),
+                        'included_files': set(merge_plan),
+                        'file_timestamps': sources[0][1]['file_timestamps'],
+                        'region_deltas': set(),
+                        'objects': merged_objects,
+                        'compressed_files': set(),
+                        'checksums': {}
+                    }
+                    tasks: list['CopyTask'] = []
+                    for file, n in merge_plan.items():
+                        slot_path, slot_info = slot_chain[n]
+                        digest = slot_info.get('objects', {}).get(file)
+                        if digest is not None:
+                            merged_objects[file] = digest
+                            continue
+                        if file in delta_bases:
+                            if delta_bases[file] > last:
+                                info['region_deltas'].add(file)
+                            else:
+                                # 基础版本也将被合并, 须重建为完整文件
+                                tasks.append((0, partial(
+                                    self.rebuild_region_file, slot_chain[n:], file, join(temp_path, file),
+                                    info['checksums'] if stored.config.backup_checksums else None
+                                )))
+                                continue
+                        elif file in slot_info.get('compressed_files', ()):
+                            info['compressed_files'].add(file)
+                        if file in slot_info.get('checksums', {}):
+                            # 链接或复制的文件内容不变, 沿用源位次的校验值
+                            info['checksums'][file] = slot_info['checksums'][file]
+                        src = join(slot_path, delta_file_name(file)) if file in info['region_deltas'] else self.get_backup_file(slot_path, slot_info, file)
+                        dst = join(temp_path, relpath(src, slot_path))
+                        tasks.append(self.get_copy_task(src, dst, hardlink=stored.config.hardlink_backup_files))
+                    self.object_store.acquire(merged_objects.values())
+                    info['backup_size'] = self.copy_engine.run(tasks)
+                    info['logical_size'] = sum(self.get_restore_file_size(temp_path, info, f) for f in merge_plan)
+                    dump_slot_info(temp_path, info)
+
+                with record.phase('swap'), self.slots_lock:
+                    for slot_path, slot_info in sources:
+                        if self.slots.get_slot_by_path(slot_path) is not slot_info:
+                            raise RuntimeError(f'{slot_path} was changed during merging')
+                    released_objects = [list(i.get('objects', {}).values()) for _, i in sources]
+                    for slot_path, slot_info in sources:
+                        self.slots.unindex_slot(slot_path, slot_info)
+                    if exists(trash_path):
+                        rmtree(trash_path)
+                    mkdir(trash_path)
+                    for n, (slot_path, slot_info) in enumerate(sources):
+                        replace(slot_path, join(trash_path, str(n)))
+                        self.slots.replace_slot_data(slot_path, empty_info)
+                        if slot_path != target_path:
+                            mkdir(slot_path)
+                    if exists(target_path):
+                        rmdir(target_path)
+                    replace(temp_path, target_path)
+                    merged_info = load_slot_info(target_path)
+                    self.slots.replace_slot_data(target_path, merged_info)
+                    self.slots.index_slot(target_path, merged_info)
+                    for i in released_objects:
+                        self.object_store.release(i)
+                    merged_objects = None
+
+                with record.phase('cleanup'):
+                    rmtree(trash_path, ignore_errors=True)
+                    self.object_store.collect_garbage()
+                    self.slots.release_file_timestamps()
+                end_time = time()
+                record['merged_slots'] = len(sources)
+                record['merged_files'] = len(merge_plan)
+                record['stored_bytes'] = info['backup_size']
+                record['logical_bytes'] = info['logical_size']
+                record.stop()
+                success = True
+                print_message(source, f'合并完成, 用时{round(end_time - start_time, 2)}秒, 合并大小: {format_backup_size(info)}', force_tell=True)
+            except Exception as e:
+                print_exc()
+                print_message(source, f'§a合并§r失败, 错误代码{e}', force_tell=True)
+                if merged_objects is not None:
+                    self.object_store.release(merged_objects.values())
+                rmtree(temp_path, ignore_errors=True)
+            finally:
+                with self.slots_lock:
+                    self.merging_slots = set()
+                    self.merging_backup_event.set()
+                self.metrics.finish(record, success)
+            return success
+
+    @staticmethod
+    def get_region_chain_indexes(slot_chain: list[tuple['PathLike[str]', 'SlotInfoDict']], file: 'PathLike[str]', index: int) -> list[int]:
+        """与get_region_chain相同, 但返回从slot_chain[index]开始的版本链中各版本所在位次的下标"""
+        indexes = []
+        for n in range(index, len(slot_chain)):
+            slot_info = slot_chain[n][1]
+            if file not in slot_info['included_files']:
+                continue
+            indexes.append(n)
+            if file not in slot_info.get('region_deltas', ()):
+                return indexes
+        raise FileNotFoundError(f'No complete version of {file} found in the backup chain')
+
+
+def format_metrics(phases: dict[str, float], values: dict[str, Union[int, float]]) -> str:
+    items = [f'{PHASE_NAMES.get(k, k)}§6{round(v, 2)}§r秒' for k, v in phases.items()]
+    for k, v in values.items():
+        if k.endswith('_bytes'):
+            items.append(f'{VALUE_NAMES.get(k, k)}§2{format_file_size(v)}§r')
+        elif k.endswith('_seconds'):
+            items.append(f'{VALUE_NAMES.get(k, k)}§6{round(v, 2)}§r秒')
+        elif k.endswith('_per_second'):
+            items.append(f'{VALUE_NAMES.get(k, k)}§6{round(v, 1)}§r MB/s')
+        else:
+            items.append(f'{VALUE_NAMES.get(k, k)}§6{round(v)}§r')
+    return ', '.join(items)
+
+
+def format_backup_size(slot_info: 'SlotInfoDict') -> str:
+    """压缩后的占用空间与原始大小不同时同时显示两者"""
+    backup_size = slot_info['backup_size']
+    logical_size = slot_info.get('logical_size', backup_size)
+    if logical_size == backup_size:
+        return f'§2{format_file_size(backup_size)}§r'
+    return f'§2{format_file_size(backup_size)}§r(原始大小{format_file_size(logical_size)})'
 
 
 def format_file_size(size: int) -> str:
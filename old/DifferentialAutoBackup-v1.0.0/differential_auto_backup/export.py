@@ -0,0 +1,245 @@
+"""
+Author       : noeru_desu
+Date         : 2022-08-08 09:47:15
+LastEditors  : noeru_desu
+LastEditTime : 2022-08-08 16:02:38
+Description  : 将某一位次时的完整存档流式导出为单个归档文件
+"""
+import gzip
+import lzma
+import tarfile
+from os import makedirs, mkdir, remove, replace
+from os.path import exists, getsize, join, sep
+from shutil import rmtree
+from threading import Lock
+from time import localtime, strftime, time
+from typing import TYPE_CHECKING, BinaryIO, Iterator, NamedTuple
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import stored
+from .compression import iter_decompressed, read_frame_header
+from .core import format_file_size, print_message
+from .region import RegionVersion, iter_region
+from .transfer import transfer_file
+
+from mcdreforged.api.all import new_thread
+
+if TYPE_CHECKING:
+    from os import PathLike
+
+    from mcdreforged.api.types import CommandSource
+
+    from .core import DifferentialBackupper
+
+EXPORT_FOLDER = 'exporting'     # 位于backup_path中, 导出期间存放指向所需备份文件的硬链接
+ARCHIVE_FORMATS = ('tar.zst', 'tar.xz', 'tar.gz', 'tar', 'zip')
+BUFFER_SIZE = 2 ** 20
+ZIP_MIN_DATE = (1980, 1, 1, 0, 0, 0)
+
+
+class ExportEntry(NamedTuple):
+    file: str   # 相对于服务端文件夹的路径
+    mtime: float
+    size: int   # 原始大小
+    kind: str   # plain, compressed或region
+    paths: list[tuple[str, bool, bool]]     # (硬链接路径, 是否为区域差异文件, 是否被压缩), 仅region有多项
+
+
+def iter_plain(path: 'PathLike[str]') -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        while data := f.read(BUFFER_SIZE):
+            yield data
+
+
+def iter_entry(entry: ExportEntry) -> Iterator[bytes]:
+    """逐块产出文件的原始内容, 内存占用不超过BUFFER_SIZE或单个区块"""
+    if entry.kind == 'region':
+        return iter_region([RegionVersion(*i) for i in entry.paths])
+    if entry.kind == 'compressed':
+        return iter_decompressed(entry.paths[0][0])
+    return iter_plain(entry.paths[0][0])
+
+
+class IteratorReader(object):
+    """将产出bytes的迭代器包装为tarfile所需的只读文件对象"""
+    def __init__(self, iterator: Iterator[bytes]):
+        self.iterator = iterator
+        self.buffer = b''
+        self.offset = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            data = self.buffer[self.offset:] + b''.join(self.iterator)
+            self.buffer = b''
+            self.offset = 0
+            return data
+        result = []
+        while size > 0:
+            if self.offset >= len(self.buffer):
+                self.buffer = next(self.iterator, b'')
+                self.offset = 0
+                if not self.buffer:
+                    break
+            data = self.buffer[self.offset:self.offset + size]
+            self.offset += len(data)
+            size -= len(data)
+            result.append(data)
+        return b''.join(result)
+
+
+def get_archive_format(name: str) -> str:
+    """格式不存在或所需的库未安装时抛出ValueError"""
+    if name not in ARCHIVE_FORMATS:
+        raise ValueError(f'archive format {name} is unavailable, available formats: {", ".join(ARCHIVE_FORMATS)}')
+    if name == 'tar.zst' and zstandard is None:
+        raise ValueError('archive format tar.zst requires zstandard')
+    return name
+
+
+def open_tar_stream(f: BinaryIO, archive_format: str, level: int) -> BinaryIO:
+    """返回写入时压缩至f的流, 关闭它不会关闭f"""
+    if archive_format == 'tar.zst':
+        return zstandard.ZstdCompressor(level=level).stream_writer(f, closefd=False)
+    if archive_format == 'tar.xz':
+        return lzma.LZMAFile(f, 'wb', preset=min(max(level, 0), 9))
+    if archive_format == 'tar.gz':
+        return gzip.GzipFile(fileobj=f, mode='wb', compresslevel=min(max(level, 0), 9))
+    return f
+
+
+class SlotExporter(object):
+    """
+    导出开始时在slots_lock内将所需的备份文件硬链接至EXPORT_FOLDER, 此后位次可被正常覆盖或合并, 备份无需等待导出
+    区域差异文件与压缩文件在写入归档时重建/解压, 不经过中间文件
+    """
+    def __init__(self, core: 'DifferentialBackupper'):
+        self.core = core
+        self.lock = Lock()
+
+    @staticmethod
+    def get_archive_format() -> str:
+        try:
+            return get_archive_format(stored.config.export_format)
+        except ValueError as e:
+            stored.server.logger.warning(f'{e}, tar.xz will be used instead')
+            return 'tar.xz'
+
+    def link_slot_files(self, displayed_slot_id: int, link_path: 'PathLike[str]') -> tuple[dict, list[ExportEntry]]:
+        """返回目标位次的信息与全部需导出的文件"""
+        core = self.core
+        linked: dict[str, str] = {}
+
+        def link(path) -> str:
+            if path not in linked:
+                linked[path] = join(link_path, str(len(linked)))
+                transfer_file(path, linked[path], hardlink=True)
+            return linked[path]
+
+        entries = []
+        with core.slots_lock:
+            slot_chain = core.slots.get_slot_chain(displayed_slot_id)
+            target_info = slot_chain[0][1]
+            chain_index = {p: n for n, (p, _) in enumerate(slot_chain)}
+            holder_index = core.slots.get_holder_index()
+            for file, mtime in target_info['file_timestamps']:
+                n = chain_index.get(holder_index.get_holder(file, target_info['time_stamp']))
+                if n is None:
+                    stored.server.logger.warning(f'{file} is not included in any backup before slot {displayed_slot_id}, skipped')
+                    continue
+                slot_path, slot_info = slot_chain[n]
+                if file in slot_info.get('region_deltas', ()):
+                    versions = core.get_region_chain(slot_chain[n:], file)
+                    paths = [(link(v.path), v.is_delta, v.compressed) for v in versions]
+                    entries.append(ExportEntry(file, mtime, versions[0].header.get_file_size(), 'region', paths))
+                    continue
+                backup_file = core.get_backup_file(slot_path, slot_info, file)
+                if file in slot_info.get('compressed_files', ()) and file not in slot_info.get('objects', {}):
+                    entries.append(ExportEntry(file, mtime, read_frame_header(backup_file).size, 'compressed', [(link(backup_file), False, True)]))
+                else:
+                    entries.append(ExportEntry(file, mtime, getsize(backup_file), 'plain', [(link(backup_file), False, False)]))
+        return target_info, entries
+
+    def write_archive(self, archive_file: 'PathLike[str]', archive_format: str, entries: list[ExportEntry]):
+        pacer = self.core.pacer
+        level = stored.config.compression_level
+        with open(archive_file, 'wb') as f:
+            if archive_format == 'zip':
+                with ZipFile(f, 'w', ZIP_DEFLATED, compresslevel=min(max(level, 0), 9)) as archive:
+                    for entry in entries:
+                        info = ZipInfo(entry.file.replace(sep, '/'), max(localtime(entry.mtime)[:6], ZIP_MIN_DATE))
+                        info.compress_type = ZIP_DEFLATED
+                        info.external_attr = 0o644 << 16
+                        info.file_size = entry.size
+                        pacer.acquire(entry.size)
+                        with archive.open(info, 'w', force_zip64=entry.size > 0x7FFFFFFF) as dst:
+                            for data in iter_entry(entry):
+                                dst.write(data)
+                return
+            stream = open_tar_stream(f, archive_format, level)
+            try:
+                with tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT) as archive:
+                    for entry in entries:
+                        info = tarfile.TarInfo(entry.file.replace(sep, '/'))
+                        info.size = entry.size
+                        info.mtime = entry.mtime
+                        pacer.acquire(entry.size)
+                        archive.addfile(info, IteratorReader(iter_entry(entry)))
+            finally:
+                if stream is not f:
+                    stream.close()
+
+    @new_thread('DAB-Export')
+    def export(self, source: 'CommandSource', displayed_slot_id: int):
+        if displayed_slot_id < 1:
+            print_message(source, '覆盖备份不能被导出', tell=False)
+            return
+        if not self.lock.acquire(blocking=False):
+            print_message(source, '正在§a导出§r中, 请等待其完成', tell=False)
+            return
+        record = self.core.metrics.begin('export')
+        success = False
+        link_path = join(stored.config.backup_path, EXPORT_FOLDER)
+        archive_file = None
+        try:
+            start_time = time()
+            archive_format = self.get_archive_format()
+            with record.phase('link'):
+                if exists(link_path):
+                    rmtree(link_path)
+                mkdir(link_path)
+                slot_info, entries = self.link_slot_files(displayed_slot_id, link_path)
+            export_path = stored.config.export_path or join(stored.config.backup_path, 'exports')
+            makedirs(export_path, exist_ok=True)
+            archive_file = join(export_path, f'{stored.config.world_name}-{strftime("%Y%m%d-%H%M%S", localtime(slot_info["time_stamp"]))}.{archive_format}')
+            print_message(source, f'正在将位次§6{displayed_slot_id}§r({slot_info["time"]})的§6{len(entries)}§r个文件导出为§6{archive_format}§r...', tell=False)
+            with record.phase('archive'):
+                self.write_archive(archive_file + '.part', archive_format, entries)
+                replace(archive_file + '.part', archive_file)
+            logical_size = sum(i.size for i in entries)
+            record['exported_files'] = len(entries)
+            record['logical_bytes'] = logical_size
+            record['archive_bytes'] = getsize(archive_file)
+            record['export_mb_per_second'] = logical_size / 2 ** 20 / record.phases['archive'] if record.phases['archive'] > 0 else 0.0
+            record.stop()
+            success = True
+            print_message(
+                source,
+                f'§a导出完成§r, 用时{round(time() - start_time, 2)}秒, 原始大小§a{format_file_size(logical_size)}§r, '
+                f'归档大小§a{format_file_size(record.values["archive_bytes"])}§r, 位于§7{archive_file}§r',
+                tell=False
+            )
+        except Exception as e:
+            stored.server.logger.exception(f'Failed to export slot {displayed_slot_id}')
+            print_message(source, f'§4导出位次§6{displayed_slot_id}§r失败§r, 错误代码: {e}', tell=False)
+            if archive_file is not None and exists(archive_file + '.part'):
+                remove(archive_file + '.part')
+        finally:
+            with record.phase('cleanup'):
+                rmtree(link_path, ignore_errors=True)
+            self.core.metrics.finish(record, success)
+            self.lock.release()
@@ -0,0 +1,62 @@
+"""
+Author       : noeru_desu
+Date         : 2022-07-30 10:02:11
+LastEditors  : noeru_desu
+LastEditTime : 2022-07-30 14:48:39
+Description  : 文件到包含它的位次的索引
+"""
+from bisect import insort
+from threading import RLock
+from typing import TYPE_CHECKING, Iterable, Optional
+
+if TYPE_CHECKING:
+    from os import PathLike
+
+
+class FileHolderIndex(object):
+    """
+    记录每个文件被哪些位次包含, 列表按位次的时间戳由新到旧排列
+    回档至某一位次时, 文件在该位次时的版本位于时间戳不大于该位次的第一个包含它的位次中
+    """
+    def __init__(self):
+        self.lock = RLock()
+        self.holders: dict[str, list[tuple[float, str]]] = {}    # 时间戳取负值以便由新到旧排序
+
+    def add_slot(self, slot_path: 'PathLike[str]', slot_info: dict):
+        with self.lock:
+            item = (-slot_info['time_stamp'], slot_path)
+            for file in slot_info['included_files']:
+                holders = self.holders.get(file)
+                if holders is None:
+                    self.holders[file] = [item]
+                else:
+                    insort(holders, item)
+
+    def remove_slot(self, slot_path: 'PathLike[str]', slot_info: dict):
+        with self.lock:
+            for file in slot_info['included_files']:
+                holders = self.holders.get(file)
+                if holders is None:
+                    continue
+                holders[:] = [i for i in holders if i[1] != slot_path]
+                if not holders:
+                    del self.holders[file]
+
+    def rebuild(self, slots: Iterable[tuple['PathLike[str]', dict]]):
+        with self.lock:
+            self.holders.clear()
+            for slot_path, slot_info in slots:
+                self.add_slot(slot_path, slot_info)
+
+    def get_holder(self, file: 'PathLike[str]', time_stamp: float) -> Optional[str]:
+        """返回在time_stamp时包含该文件最新版本的位次路径"""
+        with self.lock:
+            for t, slot_path in self.holders.get(file, ()):
+                if -t <= time_stamp:
+                    return slot_path
+        return None
+
+    def get_latest_holder(self, file: 'PathLike[str]') -> Optional[str]:
+        with self.lock:
+            holders = self.holders.get(file)
+            return holders[0][1] if holders else None
@@ -0,0 +1,226 @@
+"""
+Author       : noeru_desu
+Date         : 2022-07-29 13:37:52
+LastEditors  : noeru_desu
+LastEditTime : 2022-07-29 21:05:18
+Description  : 紧凑且按需加载的位次信息格式, 取代info.pickle
+"""
+from array import array
+from json import dumps, loads
+from os import remove, replace
+from os.path import exists, join
+from pickle import load
+from struct import Struct
+from sys import byteorder, intern
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+if TYPE_CHECKING:
+    from os import PathLike
+
+INFO_FILE = 'info.dab'
+LEGACY_INFO_FILE = 'info.pickle'
+MAGIC = b'DABI\x01'
+_header_length = Struct('<I')
+
+
+class _Encoder(object):
+    """将位次中的路径集合编码为路径表的下标数组, 路径表中前file_count项依次对应mtimes"""
+    def __init__(self, file_timestamps):
+        self.paths: list[str] = []
+        self.index: dict[str, int] = {}
+        self.mtimes = array('d')
+        for path, mtime in file_timestamps:
+            self.intern(path)
+            self.mtimes.append(mtime)
+        self.file_count = len(self.paths)
+
+    def intern(self, path: str) -> int:
+        i = self.index.get(path)
+        if i is None:
+            i = self.index[path] = len(self.paths)
+            self.paths.append(path)
+        return i
+
+    def indices(self, paths) -> array:
+        return array('I', (self.intern(i) for i in paths))
+
+
+def _to_bytes(a: array) -> bytes:
+    if byteorder == 'big':
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def _from_bytes(typecode: str, data: bytes) -> array:
+    a = array(typecode)
+    a.frombytes(data)
+    if byteorder == 'big':
+        a.byteswap()
+    return a
+
+
+def _encode_sections(info: dict) -> dict[str, bytes]:
+    encoder = _Encoder(info['file_timestamps'])
+    sections = {
+        'mtimes': _to_bytes(encoder.mtimes),
+        'included_files': _to_bytes(encoder.indices(info['included_files'])),
+        'region_deltas': _to_bytes(encoder.indices(info.get('region_deltas', ()))),
+        'compressed_files': _to_bytes(encoder.indices(info.get('compressed_files', ())))
+    }
+    objects = info.get('objects', {})
+    sections['object_paths'] = _to_bytes(encoder.indices(objects.keys()))
+    sections['object_digests'] = b''.join(bytes.fromhex(i) for i in objects.values())
+    checksums = info.get('checksums', {})
+    sections['checksum_paths'] = _to_bytes(encoder.indices(checksums.keys()))
+    sections['checksum_digests'] = b''.join(bytes.fromhex(i) for i in checksums.values())
+    sections['paths'] = '\0'.join(encoder.paths).encode('utf-8', 'surrogateescape')
+    return sections
+
+
+class _SectionReader(object):
+    def __init__(self, info: 'SlotInfo'):
+        self.info = info
+        self.paths: Optional[list[str]] = None
+        self.file = open(info.info_file, 'rb')
+
+    def read(self, name: str) -> bytes:
+        offset, length = self.info.sections[name]
+        self.file.seek(self.info.data_offset + offset)
+        return self.file.read(length)
+
+    def get_paths(self) -> list[str]:
+        if self.paths is None:
+            data = self.read('paths')
+            self.paths = [intern(i) for i in data.decode('utf-8', 'surrogateescape').split('\0')] if data else []
+        return self.paths
+
+    def get_path_set(self, section: str) -> set[str]:
+        paths = self.get_paths()
+        return {paths[i] for i in _from_bytes('I', self.read(section))}
+
+    def close(self):
+        self.file.close()
+
+
+def _load_file_timestamps(reader: _SectionReader):
+    paths = reader.get_paths()
+    return set(zip(paths, _from_bytes('d', reader.read('mtimes'))))
+
+
+def _load_digests(reader: _SectionReader, prefix: str):
+    """读取路径到sha256值的映射, 旧版本的位次信息中没有的段视为空"""
+    if f'{prefix}_paths' not in reader.info.sections:
+        return {}
+    paths = reader.get_paths()
+    digests = reader.read(f'{prefix}_digests')
+    return {paths[p]: digests[n * 32:n * 32 + 32].hex() for n, p in enumerate(_from_bytes('I', reader.read(f'{prefix}_paths')))}
+
+
+LAZY_LOADERS: dict[str, tuple[Callable[[_SectionReader], Any], Callable[[], Any]]] = {    # (读取函数, 文件不存在时的默认值)
+    'file_timestamps': (_load_file_timestamps, set),
+    'included_files': (lambda r: r.get_path_set('included_files'), set),
+    'region_deltas': (lambda r: r.get_path_set('region_deltas'), set),
+    'compressed_files': (lambda r: r.get_path_set('compressed_files') if 'compressed_files' in r.info.sections else set(), set),
+    'objects': (lambda r: _load_digests(r, 'object'), dict),
+    'checksums': (lambda r: _load_digests(r, 'checksum'), dict)    # 位次中储存的文件的sha256, 压缩文件为其原始内容的sha256
+}
+
+
+class SlotInfo(dict):
+    """
+    加载时仅读取time, backup_size等较小的字段, 文件级别的集合在首次访问时才从磁盘读取
+    可使用release释放已读取的集合以节省内存
+    """
+    def __init__(self, info_file: 'PathLike[str]', header: dict, data_offset: int):
+        super().__init__(header['fields'])
+        self.info_file = info_file
+        self.data_offset = data_offset
+        self.sections: dict[str, tuple[int, int]] = header['sections']
+
+    def __missing__(self, key):
+        if key not in LAZY_LOADERS:
+            raise KeyError(key)
+        loader, default = LAZY_LOADERS[key]
+        if not exists(self.info_file):
+            # 位次已被清空, 其信息将被替换
+            return default()
+        reader = _SectionReader(self)
+        try:
+            value = self[key] = loader(reader)
+        finally:
+            reader.close()
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def release(self, *keys: str):
+        for i in keys or LAZY_LOADERS:
+            if i in LAZY_LOADERS:
+                self.pop(i, None)
+
+
+def dump_slot_info(slot_path: 'PathLike[str]', info: dict):
+    sections = _encode_sections(info)
+    section_table = {}
+    offset = 0
+    for name, data in sections.items():
+        section_table[name] = (offset, len(data))
+        offset += len(data)
+    header = dumps({
+        'fields': {k: v for k, v in info.items() if k not in LAZY_LOADERS},
+        'file_count': len(info['file_timestamps']),
+        'sections': section_table
+    }).encode()
+    info_file = join(slot_path, INFO_FILE)
+    temp_file = f'{info_file}.tmp'
+    with open(temp_file, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_header_length.pack(len(header)))
+        f.write(header)
+        for data in sections.values():
+            f.write(data)
+    replace(temp_file, info_file)
+    if isinstance(info, SlotInfo) and info.info_file == info_file:
+        info.data_offset = len(MAGIC) + _header_length.size + len(header)
+        info.sections = section_table
+
+
+def load_slot_info(slot_path: 'PathLike[str]', legacy_world: Optional[str] = None) -> Optional[dict]:
+    """
+    读取位次信息, 不存在时返回None. 旧版info.pickle将被转换为新格式
+    旧版位次中的路径相对于存档文件夹, 指定legacy_world时将其转换为相对于服务端文件夹的路径并写回
+    """
+    info_file = join(slot_path, INFO_FILE)
+    if not exists(info_file):
+        legacy_info_file = join(slot_path, LEGACY_INFO_FILE)
+        if not exists(legacy_info_file):
+            return None
+        with open(legacy_info_file, 'rb') as f:
+            dump_slot_info(slot_path, load(f))
+        remove(legacy_info_file)
+    with open(info_file, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{info_file} is not a slot info file')
+        header_length = _header_length.unpack(f.read(_header_length.size))[0]
+        header = loads(f.read(header_length))
+    header['sections'] = {k: tuple(v) for k, v in header['sections'].items()}
+    info = SlotInfo(info_file, header, len(MAGIC) + _header_length.size + header_length)
+    if legacy_world is not None and 'worlds' not in info:
+        dump_slot_info(slot_path, _add_world_prefix(info, legacy_world))
+        return load_slot_info(slot_path)
+    return info
+
+
+def _add_world_prefix(info: 'SlotInfo', world: str) -> dict:
+    converted = dict(info)
+    converted['worlds'] = [world]
+    converted['file_timestamps'] = {(join(world, f), t) for f, t in info['file_timestamps']}
+    for key in ('included_files', 'region_deltas', 'compressed_files'):
+        converted[key] = {join(world, f) for f in info[key]}
+    converted['objects'] = {join(world, f): d for f, d in info['objects'].items()}
+    return converted
@@ -0,0 +1,118 @@
+"""
+Author       : noeru_desu
+Date         : 2022-08-03 09:20:14
+LastEditors  : noeru_desu
+LastEditTime : 2022-08-03 14:56:38
+Description  : 备份/回档/合并各阶段的耗时与吞吐量记录
+"""
+from collections import deque
+from contextlib import contextmanager
+from json import dumps, loads
+from os import makedirs
+from os.path import exists, split
+from threading import Lock
+from time import localtime, perf_counter, strftime, time
+from typing import TYPE_CHECKING, Any, Optional, Union
+
+if TYPE_CHECKING:
+    from os import PathLike
+
+
+class OperationRecord(object):
+    """单次操作的记录, phases为各阶段耗时(秒), values为文件数, 字节数等其余数值"""
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.time_stamp = time()
+        self.start = perf_counter()
+        self.phases: dict[str, float] = {}
+        self.values: dict[str, Union[int, float]] = {}
+        self.end: Optional[float] = None
+        self.success = False
+
+    @contextmanager
+    def phase(self, name: str):
+        """记录with块的耗时, 同名阶段多次出现时累加"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, perf_counter() - start)
+
+    def add_phase(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def stop(self):
+        """结束计时, 此后进行的收尾工作(如自动合并)不计入总耗时"""
+        self.end = perf_counter()
+
+    def __setitem__(self, key: str, value: Union[int, float]):
+        self.values[key] = value
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            'operation': self.operation,
+            'time': strftime("%Y/%m/%d %H:%M:%S", localtime(self.time_stamp)),
+            'time_stamp': self.time_stamp,
+            'success': self.success,
+            'duration': (self.end or perf_counter()) - self.start,
+            'phases': self.phases,
+            'values': self.values
+        }
+
+
+class MetricsRecorder(object):
+    """
+    最近history_size条记录保存于内存中, 全部记录以每行一个JSON对象的格式追加至history_file以便长期统计
+    """
+    def __init__(self, history_file: 'PathLike[str]', history_size: int):
+        self.history_file = history_file
+        self.lock = Lock()
+        self.records: deque[dict[str, Any]] = deque(maxlen=max(history_size, 1))
+        if exists(history_file):
+            with open(history_file, encoding='utf-8') as f:
+                for line in deque(f, maxlen=self.records.maxlen):
+                    try:
+                        self.records.append(loads(line))
+                    except ValueError:
+                        continue
+
+    def resize(self, history_size: int):
+        with self.lock:
+            if self.records.maxlen != max(history_size, 1):
+                self.records = deque(self.records, maxlen=max(history_size, 1))
+
+    @staticmethod
+    def begin(operation: str) -> OperationRecord:
+        return OperationRecord(operation)
+
+    def finish(self, record: OperationRecord, success: bool):
+        record.success = success
+        data = record.to_dict()
+        with self.lock:
+            self.records.append(data)
+            makedirs(split(self.history_file)[0] or '.', exist_ok=True)
+            with open(self.history_file, 'a', encoding='utf-8') as f:
+                f.write(dumps(data, ensure_ascii=False) + '\n')
+
+    def get_records(self, operation: Optional[str] = None) -> list[dict[str, Any]]:
+        with self.lock:
+            return [i for i in self.records if operation is None or i['operation'] == operation]
+
+    def summarize(self, operation: str) -> Optional[dict[str, Any]]:
+        """返回近期成功的操作中各项数值的平均值, 没有记录时返回None"""
+        records = [i for i in self.get_records(operation) if i['success']]
+        if not records:
+            return None
+        phases: dict[str, list[float]] = {}
+        values: dict[str, list[float]] = {}
+        for record in records:
+            for k, v in record['phases'].items():
+                phases.setdefault(k, []).append(v)
+            for k, v in record['values'].items():
+                values.setdefault(k, []).append(v)
+        return {
+            'count': len(records),
+            'duration': sum(i['duration'] for i in records) / len(records),
+            'phases': {k: sum(v) / len(v) for k, v in phases.items()},
+            'values': {k: sum(v) / len(v) for k, v in values.items()}
+        }
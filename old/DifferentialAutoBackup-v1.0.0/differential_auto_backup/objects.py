@@ -0,0 +1,117 @@
+"""
+Author       : noeru_desu
+Date         : 2022-07-23 09:41:18
+LastEditors  : noeru_desu
+LastEditTime : 2022-07-23 15:02:46
+Description  : 基于内容寻址的备份文件储存, 相同内容的文件在所有位次中只储存一次
+"""
+from hashlib import sha256
+from os import makedirs, remove, replace, scandir
+from os.path import exists, join
+from pickle import dump, load
+from threading import RLock
+from typing import TYPE_CHECKING, Iterable
+
+from .transfer import get_allocated_size, transfer_file
+
+if TYPE_CHECKING:
+    from os import PathLike
+
+BUFFER_SIZE = 2 ** 20
+REFS_FILE = 'refs.pickle'
+TEMP_FILE = 'writing.tmp'
+
+
+class ObjectStore(object):
+    """
+    对象以其sha256值命名, 储存于 <root>/<前两位>/<其余部分>
+    引用计数保存在refs.pickle中, 计数归零的对象在collect_garbage时被删除
+    """
+    def __init__(self, root: 'PathLike[str]'):
+        self.root = root
+        self.refs: dict[str, int] = {}
+        self.lock = RLock()
+        refs_file = join(root, REFS_FILE)
+        if exists(refs_file):
+            with open(refs_file, 'rb') as f:
+                self.refs = load(f)
+
+    def get_object_path(self, digest: str) -> str:
+        return join(self.root, digest[:2], digest[2:])
+
+    def put_file(self, src_file: 'PathLike[str]') -> tuple[str, int]:
+        """边读取边计算哈希并写入临时文件, 返回(哈希值, 新写入的字节数), 已存在的对象不会被重复写入"""
+        makedirs(self.root, exist_ok=True)
+        hasher = sha256()
+        temp_file = join(self.root, f'{id(hasher)}.{TEMP_FILE}')
+        transfer_file(src_file, temp_file, hasher=hasher)   # 稀疏文件的空洞保持为空洞
+        size = get_allocated_size(temp_file)
+        digest = hasher.hexdigest()
+        with self.lock:
+            object_path = self.get_object_path(digest)
+            if exists(object_path):
+                remove(temp_file)
+                size = 0
+            else:
+                makedirs(join(self.root, digest[:2]), exist_ok=True)
+                replace(temp_file, object_path)
+            self.refs[digest] = self.refs.get(digest, 0) + 1
+        return digest, size
+
+    def acquire(self, digests: Iterable[str]):
+        with self.lock:
+            for i in digests:
+                self.refs[i] = self.refs.get(i, 0) + 1
+
+    def release(self, digests: Iterable[str]):
+        with self.lock:
+            for i in digests:
+                if i in self.refs:
+                    self.refs[i] -= 1
+
+    def save(self):
+        with self.lock:
+            makedirs(self.root, exist_ok=True)
+            with open(join(self.root, REFS_FILE), 'wb') as f:
+                dump(self.refs, f)
+
+    def collect_garbage(self, manifests: Iterable[dict[str, str]] = None) -> int:
+        """
+        删除引用计数归零的对象并保存引用计数, 返回释放的字节数
+        指定manifests时根据全部位次的清单重新计算引用计数, 并清理未被记录的对象与临时文件
+        """
+        freed = 0
+        with self.lock:
+            if manifests is not None:
+                self.refs = {}
+                for manifest in manifests:
+                    self.acquire(manifest.values())
+            for digest in [k for k, v in self.refs.items() if v <= 0]:
+                object_path = self.get_object_path(digest)
+                if exists(object_path):
+                    freed += _remove_file(object_path)
+                del self.refs[digest]
+            if manifests is not None and exists(self.root):
+                for entry in scandir(self.root):
+                    if entry.is_file() and entry.name.endswith(TEMP_FILE):
+                        freed += _remove_file(entry.path)
+                    elif entry.is_dir():
+                        for obj in scandir(entry.path):
+                            if entry.name + obj.name not in self.refs:
+                                freed += _remove_file(obj.path)
+            self.save()
+        return freed
+
+
+def file_digest(path: 'PathLike[str]') -> str:
+    hasher = sha256()
+    with open(path, 'rb') as f:
+        while data := f.read(BUFFER_SIZE):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def _remove_file(path: 'PathLike[str]') -> int:
+    size = get_allocated_size(path)
+    remove(path)
+    return size
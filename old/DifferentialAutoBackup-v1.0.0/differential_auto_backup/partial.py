@@ -0,0 +1,324 @@
+"""
+Author       : noeru_desu
+Date         : 2022-08-07 13:26:40
+LastEditors  : noeru_desu
+LastEditTime : 2022-08-07 20:41:05
+Description  : 按路径通配符, 区域坐标或玩家进行的部分回档
+"""
+import re
+from fnmatch import fnmatchcase
+from json import load
+from math import inf
+from os.path import exists, getsize, join, sep, split
+from shutil import rmtree
+from threading import Event
+from time import perf_counter, time
+from typing import TYPE_CHECKING, Callable, Optional
+
+from . import stored
+from .core import command_run, empty_info, format_file_size, get_worlds, print_message
+
+from mcdreforged.api.all import RTextList, new_thread
+
+if TYPE_CHECKING:
+    from os import PathLike
+
+    from mcdreforged.api.types import CommandSource
+
+    from .core import DifferentialBackupper, SlotInfoDict
+
+    Matcher = Callable[[str], bool]
+
+PARTIAL_OVERWRITE_FOLDER = 'partial_overwrite'   # 位于backup_path中, 保存最近一次部分回档前被替换或删除的文件
+UUID_PATTERN = re.compile(r'^[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}$')
+DIMENSION_FOLDERS = {   # 维度的区域文件夹相对于存档文件夹的位置, Bukkit系服务端的world_nether/DIM-1同样适用
+    'overworld': (),
+    'the_nether': ('DIM-1',),
+    'the_end': ('DIM1',)
+}
+DIMENSION_ALIASES = {'world': 'overworld', 'nether': 'the_nether', 'end': 'the_end', '0': 'overworld', '-1': 'the_nether', '1': 'the_end'}
+REGION_FOLDERS = ('region', 'entities', 'poi')
+PLAYER_LEAVE_TIMEOUT = 10   # second
+
+
+def glob_matcher(pattern: str) -> 'Matcher':
+    """pattern为相对于服务端文件夹的路径, 以/分隔, 其中的*同样匹配/"""
+    pattern = pattern.replace('\\', '/')
+    return lambda file: fnmatchcase(file.replace(sep, '/'), pattern)
+
+
+def get_dimension(name: str) -> Optional[str]:
+    name = name.lower().removeprefix('minecraft:')
+    name = DIMENSION_ALIASES.get(name, name)
+    return name if name in DIMENSION_FOLDERS else None
+
+
+def region_matcher(x: int, z: int, dimension: str = 'overworld') -> 'Matcher':
+    """匹配全部存档文件夹中该维度的区域文件及对应的实体与POI文件"""
+    name = f'r.{x}.{z}.mca'
+    dimension_folder = DIMENSION_FOLDERS[dimension]
+
+    def match(file: str) -> bool:
+        parts = file.split(sep)
+        return parts[-1] == name and len(parts) >= 3 and parts[-2] in REGION_FOLDERS and tuple(parts[1:-2]) == dimension_folder
+    return match
+
+
+def is_player_file(file: 'PathLike[str]') -> bool:
+    return split(file)[0] in {join(stored.config.world_name, i) for i in stored.config.playerdata_folders}
+
+
+def get_player_uuid(file: 'PathLike[str]') -> str:
+    return split(file)[1].split('.', 1)[0]
+
+
+def player_matcher(uuid: str) -> 'Matcher':
+    return lambda file: is_player_file(file) and get_player_uuid(file) == uuid
+
+
+def load_user_cache() -> dict[str, str]:
+    """读取服务端的usercache.json, 返回UUID到玩家名的映射"""
+    try:
+        with open(join(stored.config.server_path, 'usercache.json'), encoding='utf-8') as f:
+            return {i['uuid']: i['name'] for i in load(f)}
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+
+def resolve_player_uuid(player: str) -> Optional[str]:
+    """player可以为UUID(可省略-)或曾进入过服务器的玩家名"""
+    player = player.lower()
+    if UUID_PATTERN.match(player):
+        player = player.replace('-', '')
+        return f'{player[:8]}-{player[8:12]}-{player[12:16]}-{player[16:20]}-{player[20:]}'
+    for uuid, name in load_user_cache().items():
+        if name.lower() == player:
+            return uuid
+    return None
+
+
+class PartialRestorePlan(object):
+    """
+    world_plan为需从存档备份恢复的文件到slot_chain下标的映射, playerdata_plan为需从玩家数据备份恢复的文件到其所在位次的映射
+    replaced_files为将被替换的现有文件, deleted_files为目标时间点不存在而需删除的文件
+    """
+    def __init__(self, slot_chain: list[tuple['PathLike[str]', 'SlotInfoDict']]):
+        self.slot_chain = slot_chain
+        self.world_plan: dict['PathLike[str]', int] = {}
+        self.playerdata_plan: dict['PathLike[str]', 'PathLike[str]'] = {}
+        self.replaced_files: set['PathLike[str]'] = set()
+        self.deleted_files: set['PathLike[str]'] = set()
+
+    @property
+    def restored_files(self) -> set['PathLike[str]']:
+        return self.world_plan.keys() | self.playerdata_plan.keys()
+
+    def is_empty(self) -> bool:
+        return not (self.world_plan or self.playerdata_plan or self.deleted_files)
+
+    def is_player_only(self) -> bool:
+        """仅涉及玩家数据时只需踢出相关玩家, 无需关闭服务器"""
+        return all(is_player_file(f) for f in self.restored_files | self.deleted_files)
+
+    def get_players(self) -> set[str]:
+        return {get_player_uuid(f) for f in self.restored_files | self.deleted_files}
+
+
+class PartialRestorer(object):
+    """
+    只恢复匹配的文件, 其版本取自不晚于目标位次的最新备份, 启用玩家数据备份时玩家文件也可来自更新的玩家数据位次
+    未指定位次时恢复至全部备份中的最新版本
+    """
+    def __init__(self, core: 'DifferentialBackupper'):
+        self.core = core
+        self.selected: Optional[tuple[Optional[int], 'Matcher', str]] = None    # (位次, 文件匹配函数, 描述)
+        self.left_players: set[str] = set()
+        self.player_left_event = Event()    # 由on_player_left设置
+
+    def get_plan(self, displayed_slot_id: Optional[int], matcher: 'Matcher') -> PartialRestorePlan:
+        slot_chain = self.core.slots.get_slot_chain(displayed_slot_id or 1)
+        plan = PartialRestorePlan(slot_chain)
+        world_info = slot_chain[0][1] if slot_chain else empty_info
+        time_stamp = inf if displayed_slot_id is None else world_info['time_stamp']
+        target = {f: t for f, t in world_info['file_timestamps'] if matcher(f)}
+        # 玩家数据位次比存档位次更新时, 玩家文件以其为准
+        playerdata_slot = next((i for i in stored.playerdata_inst.get_slot_chain() if i[1]['time_stamp'] <= time_stamp), None)
+        if playerdata_slot is not None and playerdata_slot[1]['time_stamp'] > world_info['time_stamp']:
+            target = {f: t for f, t in target.items() if not is_player_file(f)}
+            target.update((f, t) for f, t in playerdata_slot[1]['file_timestamps'] if matcher(f))
+        else:
+            playerdata_slot = None
+        current = {f: t for f, t in self.core.get_all_file_mod_times(world_info.get('worlds') or get_worlds()) if matcher(f)}
+
+        chain_index = {p: n for n, (p, _) in enumerate(slot_chain)}
+        holder_index = self.core.slots.get_holder_index()
+        for file, mtime in target.items():
+            if current.get(file) == mtime:
+                continue
+            if playerdata_slot is not None and is_player_file(file):
+                holder = stored.playerdata_inst.get_holder(file, time_stamp)
+                if holder is not None:
+                    plan.playerdata_plan[file] = holder[0]
+                    continue
+            else:
+                n = chain_index.get(holder_index.get_holder(file, world_info['time_stamp']))
+                if n is not None:
+                    plan.world_plan[file] = n
+                    continue
+            stored.server.logger.warning(f'{file} is not included in any backup, skipped')
+        plan.replaced_files = plan.restored_files & current.keys()
+        # 没有存档备份时仅能确定玩家文件在目标时间点是否存在
+        plan.deleted_files = {f for f in current.keys() - target.keys() if slot_chain or (playerdata_slot is not None and is_player_file(f))}
+        return plan
+
+    def get_restore_size(self, plan: PartialRestorePlan) -> int:
+        size = sum(self.core.get_restore_file_size(*plan.slot_chain[n], f) for f, n in plan.world_plan.items())
+        return size + sum(getsize(stored.playerdata_inst.get_backup_file(p, f)) for f, p in plan.playerdata_plan.items())
+
+    def request_files(self, source: 'CommandSource', displayed_slot_id: Optional[int], pattern: str):
+        self.request(source, displayed_slot_id, glob_matcher(pattern), f'匹配§6{pattern}§r的文件')
+
+    def request_region(self, source: 'CommandSource', displayed_slot_id: Optional[int], x: int, z: int, dimension: str = 'overworld'):
+        dimension_id = get_dimension(dimension)
+        if dimension_id is None:
+            print_message(source, f'未知的维度§6{dimension}§r, 可选overworld, the_nether或the_end', tell=False)
+            return
+        self.request(source, displayed_slot_id, region_matcher(x, z, dimension_id), f'{dimension_id}的区域文件§6r.{x}.{z}.mca§r')
+
+    def request_player(self, source: 'CommandSource', displayed_slot_id: Optional[int], player: str):
+        uuid = resolve_player_uuid(player)
+        if uuid is None:
+            print_message(source, f'找不到玩家§6{player}§r, 请使用UUID', tell=False)
+            return
+        self.request(source, displayed_slot_id, player_matcher(uuid), f'玩家§6{player}§r的数据')
+
+    @new_thread('DAB-Restore')
+    def request(self, source: 'CommandSource', displayed_slot_id: Optional[int], matcher: 'Matcher', description: str):
+        if displayed_slot_id == 0:
+            print_message(source, '部分回档不支持覆盖备份, 请使用back 0', tell=False)
+            return
+        if not self.core.check_restore_available(source, requesting=True):
+            return
+        try:
+            plan = self.get_plan(displayed_slot_id, matcher)
+            restore_size = self.get_restore_size(plan)
+        except Exception as e:
+            stored.server.logger.exception('Failed to calculate partial restore plan')
+            print_message(source, f'§4计算回档计划失败§r, 错误代码: {e}', tell=False)
+            return
+        if plan.is_empty():
+            print_message(source, f'{description}与备份相同, 无需回档', tell=False)
+            return
+        self.selected = (displayed_slot_id, matcher, description)
+        self.core.abort_restore_event.clear()
+        target = '最新的备份' if displayed_slot_id is None else f'位次§6{displayed_slot_id}§r({plan.slot_chain[0][1]["time"]})'
+        print_message(source, f'准备将{description}恢复至{target}', force_tell=True)
+        print_message(
+            source,
+            f'需要恢复§6{len(plan.restored_files)}§r个文件(§2{format_file_size(restore_size)}§r), 删除§6{len(plan.deleted_files)}§r个文件, '
+            + ('仅需踢出相关玩家' if plan.is_player_only() else '需要关闭服务器'),
+            force_tell=True
+        )
+        print_message(
+            source,
+            RTextList(
+                command_run(f'使用§7{stored.cmd_prefix} confirm§r 确认§c回档§r', '点击确认', f'{stored.cmd_prefix} confirm'),
+                ', ',
+                command_run(f'§7{stored.cmd_prefix} abort§r 取消', '点击取消', f'{stored.cmd_prefix} abort')
+            ), force_tell=True
+        )
+
+    def on_player_left(self, player: str):
+        self.left_players.add(player)
+        self.player_left_event.set()
+
+    def kick_players(self, uuids: set[str]):
+        """
+        踢出相关玩家并等待其退出, 玩家退出时服务端会写入其数据
+        离开的消息在写入玩家数据前输出, 故之后再执行save-all, 其完成时玩家数据已写入完毕
+        """
+        names = {name for uuid, name in load_user_cache().items() if uuid in uuids}
+        online_players = {i for i in stored.online_player_api.get_player_list() if i in names}
+        if not online_players:
+            return
+        self.left_players = set()
+        for i in online_players:
+            stored.server.execute(f'kick {i} 正在回档玩家数据')
+        deadline = time() + PLAYER_LEAVE_TIMEOUT
+        while True:
+            self.player_left_event.clear()
+            if online_players <= self.left_players:
+                break
+            if not self.player_left_event.wait(deadline - time()):
+                raise TimeoutError(f'Players {", ".join(online_players - self.left_players)} did not leave after being kicked')
+        if not self.core.save_game('save-all'):
+            raise TimeoutError('Saving the game timed out after kicking players')
+
+    def backup_replaced_files(self, plan: PartialRestorePlan) -> int:
+        """将被替换或删除的现有文件移入PARTIAL_OVERWRITE_FOLDER"""
+        overwrite_path = join(stored.config.backup_path, PARTIAL_OVERWRITE_FOLDER)
+        if exists(overwrite_path):
+            rmtree(overwrite_path)
+        files = list(plan.replaced_files | plan.deleted_files)
+        return self.core.move_files([join(stored.config.server_path, i) for i in files], [join(overwrite_path, i) for i in files])
+
+    def execute(self, source: 'CommandSource'):
+        """由confirm_restore在清除restoring_backup_event后调用"""
+        displayed_slot_id, matcher, description = self.selected
+        record = self.core.metrics.begin('partial_restore')
+        success = False
+        try:
+            plan = self.get_plan(displayed_slot_id, matcher)
+            running = stored.server.is_server_running()
+            stop_server = running and not plan.is_player_only()
+            if stop_server:
+                countdown_start = perf_counter()
+                print_message(source, f'10秒后将关闭服务器进行{description}的§c回档§r', force_tell=True)
+                aborted = not self.core.countdown(source)
+                record.add_phase('countdown', perf_counter() - countdown_start)
+                if aborted:
+                    print_message(source, '已中断§c回档§r', force_tell=True)
+                    return
+                downtime_start = perf_counter()
+                with record.phase('stop_server'):
+                    self.core.stop_server()
+            elif running:
+                with record.phase('kick'):
+                    self.kick_players(plan.get_players())
+            if running:
+                # 等待期间文件可能已被服务端写入
+                with record.phase('plan'):
+                    plan = self.get_plan(displayed_slot_id, matcher)
+
+            server_path = stored.config.server_path
+            with record.phase('overwrite_backup'):
+                backup_size = self.backup_replaced_files(plan)
+            with record.phase('restore'):
+                restore_size = self.core.restore_files(plan.slot_chain, plan.world_plan, server_path)
+                restore_size += self.core.copy_files(
+                    [stored.playerdata_inst.get_backup_file(p, f) for f, p in plan.playerdata_plan.items()],
+                    [join(server_path, f) for f in plan.playerdata_plan]
+                )
+            self.core.slots.release_file_timestamps()
+            stored.server.logger.info(
+                f'Partial restore done, restored {len(plan.restored_files)} files ({format_file_size(restore_size)}) and deleted {len(plan.deleted_files)} files, '
+                f'replaced files were moved to {PARTIAL_OVERWRITE_FOLDER}'
+            )
+            if stop_server:
+                source.get_server().start()
+                record['downtime_seconds'] = perf_counter() - downtime_start
+            record['restored_files'] = len(plan.restored_files)
+            record['deleted_files'] = len(plan.deleted_files)
+            record['restored_bytes'] = restore_size
+            record['overwrite_backup_bytes'] = backup_size
+            record.stop()
+            success = True
+            print_message(source, f'§a{description}已恢复§r, 被替换的文件位于§7{join(stored.config.backup_path, PARTIAL_OVERWRITE_FOLDER)}§r', force_tell=True)
+        except Exception:
+            stored.server.logger.exception(f'Fail to partially restore files, triggered by {source}')
+            print_message(source, f'§4{description}回档失败§r, 详情见控制台', force_tell=True)
+        finally:
+            self.core.metrics.finish(record, success)
+            self.core.abort_restore_event.clear()
+            self.selected = None
+            self.core.restoring_backup_event.set()
@@ -0,0 +1,154 @@
+"""
+Author       : noeru_desu
+Date         : 2022-08-06 10:05:33
+LastEditors  : noeru_desu
+LastEditTime : 2022-08-06 15:37:12
+Description  : 以独立计时器与位次进行的玩家数据差异备份
+"""
+from collections import deque
+from itertools import islice
+from math import inf
+from os import makedirs, mkdir
+from os.path import exists, join
+from shutil import rmtree
+from threading import Lock
+from time import localtime, strftime, time
+from typing import TYPE_CHECKING, Optional
+
+from . import stored
+from .core import empty_info
+from .metadata import SlotInfo, dump_slot_info, load_slot_info
+from .scanner import ScanIndex
+
+if TYPE_CHECKING:
+    from os import PathLike
+
+    from .core import DifferentialBackupper, SlotInfoDict, TimeSet
+    from .copier import CopyTask
+
+PLAYER_DATA_FOLDER = 'playerdata'   # 位于backup_path中
+
+
+class PlayerDataBackupper(object):
+    """
+    仅扫描并备份playerdata_folders中的文件, 位次结构与存档备份相同
+    玩家数据由服务端先写入临时文件再重命名, 故无需关闭自动保存, 也无需save-all flush
+    """
+    def __init__(self, core: 'DifferentialBackupper'):
+        self.core = core
+        self.root = join(stored.config.backup_path, PLAYER_DATA_FOLDER)
+        self.scan_index = ScanIndex(join(self.root, 'scan_index.pickle'))
+        self.lock = Lock()
+        self.slots_deque: deque[tuple['PathLike[str]', 'SlotInfoDict']] = deque()
+        self.load_slots_info()
+
+    def load_slots_info(self):
+        with self.lock:
+            slots_list = []
+            for i in range(1, max(stored.config.playerdata_slots, 2) + 1):
+                slot_path = join(self.root, f'slot{i}')
+                if not exists(slot_path):
+                    makedirs(slot_path)
+                    slots_list.append((slot_path, empty_info))
+                    continue
+                info = load_slot_info(slot_path, stored.config.world_name)
+                slots_list.append((slot_path, empty_info if info is None else info))
+            self.slots_deque = deque(sorted(slots_list, key=lambda v: v[1]['time_stamp']))
+
+    def get_slot_chain(self) -> list[tuple['PathLike[str]', 'SlotInfoDict']]:
+        """由新到旧返回全部已使用的位次"""
+        return [i for i in reversed(self.slots_deque) if i[1]['time_stamp'] != -inf]
+
+    def get_latest_slot(self) -> tuple['PathLike[str]', 'SlotInfoDict']:
+        return self.slots_deque[-1]
+
+    def scan(self) -> 'TimeSet':
+        """返回的路径与存档备份相同, 相对于服务端文件夹"""
+        result = set()
+        for folder in stored.config.playerdata_folders:
+            folder = join(stored.config.world_name, folder)
+            result.update((join(folder, f), t) for f, t in self.scan_index.scan(join(self.core.abs_server_path, folder), stored.config.ignored_files))
+        self.scan_index.save()
+        return result
+
+    def make_back_up(self) -> Optional['SlotInfoDict']:
+        """进行一次备份并返回新位次的信息, 玩家数据没有变化或备份失败时返回None"""
+        with self.lock:
+            slot_path = None
+            try:
+                if not self.core.save_game('save-all'):
+                    stored.server.logger.warning('Saving the game timed out, player data backup skipped')
+                    return None
+                file_timestamps = self.scan()
+                changed_file_set = file_timestamps - self.get_latest_slot()[1]['file_timestamps']
+                if not changed_file_set:
+                    return None
+                slot_path = self.recycle_oldest_slot()
+                info = {
+                    'time': strftime("%Y/%m/%d %H:%M:%S", localtime()),
+                    'time_stamp': time(),
+                    'backup_size': self.copy_files(slot_path, changed_file_set),
+                    'worlds': [stored.config.world_name],
+                    'included_files': {f for f, _ in changed_file_set},
+                    'file_timestamps': file_timestamps
+                }
+                dump_slot_info(slot_path, info)
+                self.slots_deque.append((slot_path, info))
+            except Exception:
+                stored.server.logger.exception('Failed to back up player data')
+                if slot_path is not None:
+                    self.slots_deque.appendleft((slot_path, empty_info))
+                return None
+            for _, slot_info in islice(self.slots_deque, len(self.slots_deque) - 1):
+                if isinstance(slot_info, SlotInfo):
+                    slot_info.release('file_timestamps')
+            return info
+
+    def copy_files(self, slot_path: 'PathLike[str]', file_list: 'TimeSet') -> int:
+        tasks: list['CopyTask'] = []
+        for file, _ in file_list:
+            try:
+                tasks.append(self.core.get_copy_task(join(stored.config.server_path, file), join(slot_path, file)))
+            except FileNotFoundError:
+                continue    # 扫描后被删除
+        return self.core.copy_engine.run(tasks, paced=True)
+
+    def recycle_oldest_slot(self) -> 'PathLike[str]':
+        """
+        清空最旧的位次并将其从队列中移除, 返回其路径
+        其中此后未被更改的文件将被移入较新的一个位次, 以免丢失
+        """
+        slot_path, slot_info = self.slots_deque.popleft()
+        if slot_info['time_stamp'] != -inf and self.slots_deque:
+            newer_path, newer_info = self.slots_deque[0]
+            if newer_info['time_stamp'] != -inf:
+                self.fold_slot(slot_path, slot_info, newer_path, newer_info)
+        rmtree(slot_path)
+        mkdir(slot_path)
+        return slot_path
+
+    def fold_slot(self, slot_path, slot_info: 'SlotInfoDict', newer_path, newer_info: 'SlotInfoDict'):
+        existing_files = {f for f, _ in newer_info['file_timestamps']}
+        moved_files = (slot_info['included_files'] - newer_info['included_files']) & existing_files
+        if not moved_files:
+            return
+        size = self.core.move_files(
+            [join(slot_path, f) for f in moved_files],
+            [join(newer_path, f) for f in moved_files]
+        )
+        newer_info['included_files'].update(moved_files)
+        newer_info['backup_size'] += size
+        dump_slot_info(newer_path, newer_info)
+
+    def get_backup_file(self, slot_path: 'PathLike[str]', file: 'PathLike[str]') -> 'PathLike[str]':
+        return join(slot_path, file)
+
+    def get_holder(self, file: 'PathLike[str]', time_stamp: float = inf) -> Optional[tuple['PathLike[str]', 'SlotInfoDict']]:
+        """返回在time_stamp时包含该文件最新版本的位次"""
+        for slot_path, slot_info in self.get_slot_chain():
+            if slot_info['time_stamp'] <= time_stamp and file in slot_info['included_files']:
+                return slot_path, slot_info
+        return None
+
+    def get_backup_size(self) -> int:
+        return sum(i['backup_size'] for _, i in self.get_slot_chain())
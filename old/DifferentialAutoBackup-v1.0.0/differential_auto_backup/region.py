@@ -0,0 +1,205 @@
+"""
+Author       : noeru_desu
+Date         : 2022-07-22 10:12:37
+LastEditors  : noeru_desu
+LastEditTime : 2022-07-22 16:40:03
+Description  : 区块级别的区域文件(.mca)差异备份
+"""
+from shutil import copystat
+from struct import Struct
+from typing import TYPE_CHECKING, BinaryIO, Iterable, Iterator, Optional, Union
+
+from .compression import read_head
+
+if TYPE_CHECKING:
+    from os import PathLike
+
+SECTOR_SIZE = 4096
+CHUNK_COUNT = 1024
+HEADER_SIZE = SECTOR_SIZE * 2
+REGION_SUFFIX = '.mca'
+DELTA_SUFFIX = '.dabr'
+DELTA_MAGIC = b'DABR\x01'
+
+_timestamps = Struct(f'>{CHUNK_COUNT}I')
+_locations = Struct(f'>{CHUNK_COUNT}I')
+_delta_table = Struct(f'>{CHUNK_COUNT * 2}I')
+DELTA_DATA_OFFSET = len(DELTA_MAGIC) + HEADER_SIZE + _delta_table.size
+
+
+class RegionHeader(object):
+    """区域文件头, locations中每项为(扇区偏移, 扇区数), 扇区数为0代表区块不存在"""
+    __slots__ = ('locations', 'timestamps')
+
+    def __init__(self, locations: list[tuple[int, int]], timestamps: Union[tuple[int, ...], list[int]]):
+        self.locations = locations
+        self.timestamps = timestamps
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'RegionHeader':
+        if len(data) < HEADER_SIZE:
+            # 空的或被截断的区域文件视为不含任何区块
+            return cls([(0, 0)] * CHUNK_COUNT, [0] * CHUNK_COUNT)
+        locations = [(i >> 8, i & 0xFF) for i in _locations.unpack_from(data, 0)]
+        return cls(locations, list(_timestamps.unpack_from(data, SECTOR_SIZE)))
+
+    def to_bytes(self) -> bytes:
+        return _locations.pack(*((o << 8) | c for o, c in self.locations)) + _timestamps.pack(*self.timestamps)
+
+    def is_present(self, index: int) -> bool:
+        return self.locations[index][1] != 0
+
+    def is_same_chunks(self, other: 'RegionHeader') -> bool:
+        """两者的每个区块均具有相同的时间戳与扇区数时视为内容相同"""
+        return self.timestamps == other.timestamps and all(a[1] == b[1] for a, b in zip(self.locations, other.locations))
+
+    def get_file_size(self) -> int:
+        """按此文件头重建的区域文件大小"""
+        return HEADER_SIZE + sum(c for _, c in self.locations) * SECTOR_SIZE
+
+
+def is_region_file(path: 'PathLike[str]') -> bool:
+    return str(path).endswith(REGION_SUFFIX)
+
+
+def delta_file_name(path: 'PathLike[str]') -> str:
+    return f'{path}{DELTA_SUFFIX}'
+
+
+def read_region_header(path: 'PathLike[str]') -> RegionHeader:
+    with open(path, 'rb') as f:
+        return RegionHeader.from_bytes(f.read(HEADER_SIZE))
+
+
+def get_changed_chunks(last_header: RegionHeader, latest_header: RegionHeader) -> list[int]:
+    """返回时间戳或占用扇区数发生变化且仍存在的区块下标"""
+    return [
+        i for i in range(CHUNK_COUNT)
+        if latest_header.is_present(i) and (
+            latest_header.timestamps[i] != last_header.timestamps[i] or
+            latest_header.locations[i][1] != last_header.locations[i][1]
+        )
+    ]
+
+
+class RegionDelta(object):
+    """
+    差异区域文件(.dabr)
+    结构: 魔数 | 原区域文件头(8KiB) | 区块表(1024 * (偏移, 长度)) | 已更改区块的原始扇区数据
+    区块表中长度为0的存在区块需从更早的版本中读取
+    """
+    def __init__(self, path: 'PathLike[str]'):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+                raise ValueError(f'{path} is not a region delta file')
+            self.header = RegionHeader.from_bytes(f.read(HEADER_SIZE))
+            table = _delta_table.unpack(f.read(_delta_table.size))
+        self.table = list(zip(table[0::2], table[1::2]))
+
+    def has_chunk(self, index: int) -> bool:
+        return self.table[index][1] != 0
+
+    def read_chunk(self, f: BinaryIO, index: int) -> bytes:
+        offset, length = self.table[index]
+        f.seek(offset)
+        return f.read(length)
+
+    @staticmethod
+    def write(src_file: 'PathLike[str]', dst_file: 'PathLike[str]', header: RegionHeader, chunks: Iterable[int], hasher=None) -> int:
+        """
+        将src_file中指定区块写入dst_file, 返回写入的字节数
+        区块表由文件头预先算出, 故文件可被顺序写入, hasher不为None时以写入的数据更新它
+        """
+        chunks = list(chunks)
+        table = [0] * (CHUNK_COUNT * 2)
+        offset = DELTA_DATA_OFFSET
+        for i in chunks:
+            table[i * 2] = offset
+            table[i * 2 + 1] = header.locations[i][1] * SECTOR_SIZE
+            offset += table[i * 2 + 1]
+        with open(src_file, 'rb') as src, open(dst_file, 'wb') as dst:
+            def write(data: bytes):
+                dst.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+
+            write(DELTA_MAGIC + header.to_bytes() + _delta_table.pack(*table))
+            for i in chunks:
+                sector_offset, sector_count = header.locations[i]
+                src.seek(sector_offset * SECTOR_SIZE)
+                write(src.read(sector_count * SECTOR_SIZE).ljust(sector_count * SECTOR_SIZE, b'\0'))
+        copystat(src_file, dst_file)
+        return offset
+
+
+class RegionVersion(object):
+    """区域文件在某一位次中的版本, 可能为完整文件, 压缩的完整文件或差异文件. 压缩的文件仅可读取文件头"""
+    def __init__(self, path: 'PathLike[str]', is_delta: bool, compressed=False):
+        self.path = path
+        self.is_delta = is_delta
+        self.compressed = compressed
+        if is_delta:
+            self.delta: Optional[RegionDelta] = RegionDelta(path)
+            self.header = self.delta.header
+        else:
+            self.delta = None
+            self.header = RegionHeader.from_bytes(read_head(path, HEADER_SIZE)) if compressed else read_region_header(path)
+
+    def has_chunk(self, index: int) -> bool:
+        if self.delta is not None:
+            return self.delta.has_chunk(index)
+        return self.header.is_present(index)
+
+    def read_chunk(self, f: BinaryIO, index: int) -> bytes:
+        if self.delta is not None:
+            return self.delta.read_chunk(f, index)
+        if self.compressed:
+            raise ValueError(f'{self.path} is compressed and cannot be used as the base of region deltas')
+        sector_offset, sector_count = self.header.locations[index]
+        f.seek(sector_offset * SECTOR_SIZE)
+        return f.read(sector_count * SECTOR_SIZE)
+
+
+def iter_region(chain: list[RegionVersion]) -> Iterator[bytes]:
+    """
+    chain[0]为目标版本, 其后依次为更早的版本, 且链尾须为完整文件
+    按目标版本的文件头从链中取得每个区块最新的数据并重新排列扇区, 逐个区块产出重建的区域文件
+    产出的总大小为chain[0].header.get_file_size(), 内存占用不超过单个区块
+    """
+    target = chain[0].header
+    locations = [(0, 0)] * CHUNK_COUNT
+    sector = HEADER_SIZE // SECTOR_SIZE
+    for i, (_, sector_count) in enumerate(target.locations):
+        if sector_count:
+            locations[i] = (sector, sector_count)
+            sector += sector_count
+    yield RegionHeader(locations, target.timestamps).to_bytes()
+    files = [open(v.path, 'rb') for v in chain]
+    try:
+        for i, (_, sector_count) in enumerate(target.locations):
+            if not sector_count:
+                continue
+            for version, f in zip(chain, files):
+                if version.has_chunk(i):
+                    data = version.read_chunk(f, i)
+                    break
+            else:
+                raise ValueError(f'chunk {i} of {chain[0].path} is missing from the backup chain')
+            yield data[:sector_count * SECTOR_SIZE].ljust(sector_count * SECTOR_SIZE, b'\0')
+    finally:
+        for f in files:
+            f.close()
+
+
+def rebuild_region(chain: list[RegionVersion], dst_file: 'PathLike[str]', hasher=None) -> int:
+    """将iter_region重建的区域文件写入dst_file, 返回写入的字节数. hasher不为None时以写入的数据更新它"""
+    size = 0
+    with open(dst_file, 'wb') as dst:
+        for data in iter_region(chain):
+            dst.write(data)
+            if hasher is not None:
+                hasher.update(data)
+            size += len(data)
+    copystat(chain[0].path, dst_file)
+    return size
@@ -0,0 +1,103 @@
+"""
+Author       : noeru_desu
+Date         : 2022-08-05 09:41:27
+LastEditors  : noeru_desu
+LastEditTime : 2022-08-05 16:12:50
+Description  : 按时间保留备份的周期计算与后台整理队列
+"""
+from collections import OrderedDict
+from os import scandir
+from threading import Condition, Thread
+from time import localtime
+from typing import TYPE_CHECKING, Callable, Hashable, Optional
+
+if TYPE_CHECKING:
+    from os import PathLike
+
+MONDAY_OFFSET = 3 * 86400   # 1970/01/01为周四, 使以周为单位的周期从周一开始
+
+
+def get_period_index(time_stamp: float, period_hours: float) -> Optional[int]:
+    """返回时间戳所在周期(以本地时间划分)的序号, period_hours不大于0时返回None"""
+    if period_hours <= 0:
+        return None
+    return int((time_stamp + localtime(time_stamp).tm_gmtoff + MONDAY_OFFSET) // (period_hours * 3600))
+
+
+def get_disk_usage(path: 'PathLike[str]') -> int:
+    """返回文件夹实际占用的磁盘空间, 硬链接至同一文件的多个路径仅计算一次"""
+    inodes = set()
+    usage = 0
+    stack = [path]
+    while stack:
+        try:
+            entries = scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if st.st_nlink > 1:
+                    if (st.st_dev, st.st_ino) in inodes:
+                        continue
+                    inodes.add((st.st_dev, st.st_ino))
+                usage += st.st_blocks * 512 if hasattr(st, 'st_blocks') else st.st_size
+    return usage
+
+
+class CompactionQueue(Thread):
+    """
+    在单个后台线程中依次执行合并/清理任务, 使其不占用备份线程
+    key相同且尚未开始的任务只保留一个
+    """
+    def __init__(self, on_error: Callable[[Hashable], None]):
+        super().__init__(name='DAB-Compaction', daemon=True)
+        self.on_error = on_error
+        self.condition = Condition()
+        self.jobs: OrderedDict[Hashable, Callable[[], None]] = OrderedDict()
+        self.running = False
+        self.stopped = False
+
+    def submit(self, key: Hashable, job: Callable[[], None]):
+        with self.condition:
+            if self.stopped:
+                return
+            self.jobs.setdefault(key, job)
+            self.condition.notify_all()
+
+    def is_busy(self) -> bool:
+        with self.condition:
+            return self.running or bool(self.jobs)
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: self.stopped or not (self.running or self.jobs), timeout)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopped or self.jobs)
+                if self.stopped:
+                    return
+                key, job = self.jobs.popitem(last=False)
+                self.running = True
+            try:
+                job()
+            except Exception:
+                self.on_error(key)
+            finally:
+                with self.condition:
+                    self.running = False
+                    self.condition.notify_all()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.jobs.clear()
+            self.condition.notify_all()
@@ -0,0 +1,129 @@
+"""
+Author       : noeru_desu
+Date         : 2022-07-25 19:20:44
+LastEditors  : noeru_desu
+LastEditTime : 2022-07-25 23:08:15
+Description  : 带持久化索引的存档文件扫描
+"""
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs, scandir, stat
+from os.path import exists, join, split
+from pickle import dump, load
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, Iterable, Optional
+
+if TYPE_CHECKING:
+    from os import PathLike
+
+    DirRecord = tuple[int, list[str], list[str]]  # (文件夹mtime_ns, 文件名, 子文件夹名)
+
+
+class ScanIndex(object):
+    """
+    记录每个文件夹的mtime与其中的文件/子文件夹列表, 文件夹mtime未变化时直接使用记录的列表而不再读取文件夹
+    文件被原地写入(如区域文件)时文件夹mtime不会改变, 故每个文件仍需stat以获得其mtime
+    """
+    def __init__(self, index_file: 'PathLike[str]'):
+        self.index_file = index_file
+        self.lock = Lock()
+        self.roots: dict[str, dict[str, 'DirRecord']] = {}
+        if exists(index_file):
+            try:
+                with open(index_file, 'rb') as f:
+                    self.roots = load(f)
+            except Exception:
+                self.roots = {}
+
+    def scan(self, root: 'PathLike[str]', ignored_files: Iterable[str] = (), workers: int = 1) -> set[tuple[str, float]]:
+        """返回root下全部文件的(相对路径, mtime), 第一层子文件夹(各维度等)将被并行扫描"""
+        root = str(root)
+        ignored_files = set(ignored_files)
+        last_dirs = self.roots.get(root, {})
+        dirs: dict[str, 'DirRecord'] = {}
+        result: list[tuple[str, float]] = []
+        subdirs = self._scan_dir(root, '', last_dirs, dirs, result, ignored_files)
+        if workers > 1 and len(subdirs) > 1:
+            with ThreadPoolExecutor(min(workers, len(subdirs)), thread_name_prefix='DAB-Scan') as executor:
+                futures = [executor.submit(self._scan_tree, root, i, last_dirs, ignored_files) for i in subdirs]
+                for future in futures:
+                    sub_dirs, sub_result = future.result()
+                    dirs.update(sub_dirs)
+                    result.extend(sub_result)
+        else:
+            for i in subdirs:
+                sub_dirs, sub_result = self._scan_tree(root, i, last_dirs, ignored_files)
+                dirs.update(sub_dirs)
+                result.extend(sub_result)
+        with self.lock:
+            self.roots[root] = dirs
+        return set(result)
+
+    def _scan_tree(self, root: str, rel: str, last_dirs: dict[str, 'DirRecord'], ignored_files: set[str]):
+        dirs: dict[str, 'DirRecord'] = {}
+        result: list[tuple[str, float]] = []
+        stack = [rel]
+        while stack:
+            stack.extend(self._scan_dir(root, stack.pop(), last_dirs, dirs, result, ignored_files))
+        return dirs, result
+
+    @staticmethod
+    def _scan_dir(root: str, rel: str, last_dirs: dict[str, 'DirRecord'], dirs: dict[str, 'DirRecord'], result: list, ignored_files: set[str]) -> list[str]:
+        """扫描单个文件夹, 将文件加入result并返回子文件夹的相对路径"""
+        path = join(root, rel) if rel else root
+        try:
+            dir_mtime = stat(path).st_mtime_ns     # 须在读取列表前获取, 扫描期间发生的变化将在下次扫描时被发现
+        except FileNotFoundError:
+            return []
+        record = last_dirs.get(rel)
+        if record is not None and record[0] == dir_mtime:
+            try:
+                files = [(join(rel, i), stat(join(path, i)).st_mtime) for i in record[1] if i not in ignored_files]
+            except FileNotFoundError:
+                pass
+            else:
+                dirs[rel] = record
+                result.extend(files)
+                return [join(rel, i) for i in record[2]]
+        file_names = []
+        subdir_names = []
+        with scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdir_names.append(entry.name)
+                elif entry.is_file():
+                    file_names.append(entry.name)
+                    if entry.name not in ignored_files:
+                        try:
+                            result.append((join(rel, entry.name), entry.stat().st_mtime))
+                        except FileNotFoundError:
+                            file_names.pop()
+        dirs[rel] = (dir_mtime, file_names, subdir_names)
+        return [join(rel, i) for i in subdir_names]
+
+    def list_files(self, root: 'PathLike[str]', predicate: Callable[[str], bool]) -> Optional[list[str]]:
+        """
+        由记录的文件夹列表返回root下文件名满足predicate的文件(相对路径), 不更新索引
+        仅重新读取mtime发生变化(有文件被创建或删除)的文件夹, 此后新建的子文件夹在下次扫描前不会被包含
+        root未被扫描过时返回None
+        """
+        with self.lock:
+            dirs = self.roots.get(str(root))
+        if not dirs:
+            return None
+        result = []
+        for rel, (dir_mtime, file_names, _) in dirs.items():
+            path = join(root, rel) if rel else str(root)
+            try:
+                if stat(path).st_mtime_ns != dir_mtime:
+                    with scandir(path) as it:
+                        file_names = [i.name for i in it if i.is_file()]
+            except FileNotFoundError:
+                continue
+            result.extend(join(rel, i) for i in file_names if predicate(i))
+        return result
+
+    def save(self):
+        with self.lock:
+            makedirs(split(self.index_file)[0] or '.', exist_ok=True)
+            with open(self.index_file, 'wb') as f:
+                dump(self.roots, f)
@@ -11,7 +11,11 @@ from typing import TYPE_CHECKING, Any
 if TYPE_CHECKING:
     from . import Config
     from .core import DifferentialBackupper
-    from .clock import DifferentialAutoBackupTimer
+    from .clock import DifferentialAutoBackupTimer, PlayerDataBackupTimer
+    from .playerdata import PlayerDataBackupper
+    from .partial import PartialRestorer
+    from .export import SlotExporter
+    from .verify import SlotVerifier
 
 online_player_api: Any
 config: 'Config'
@@ -19,4 +23,9 @@ metadata: Metadata
 server: PluginServerInterface
 core_inst: 'DifferentialBackupper'
 clock_inst: 'DifferentialAutoBackupTimer'
+playerdata_inst: 'PlayerDataBackupper'
+playerdata_clock_inst: 'PlayerDataBackupTimer'
+partial_restore_inst: 'PartialRestorer'
+export_inst: 'SlotExporter'
+verify_inst: 'SlotVerifier'
 cmd_prefix = '!!dab'
\ No newline at end of file
@@ -0,0 +1,112 @@
+"""
+Author       : noeru_desu
+Date         : 2022-08-01 10:31:26
+LastEditors  : noeru_desu
+LastEditTime : 2022-08-01 15:48:51
+Description  : 复制速度限制与服务器卡顿时的退避
+"""
+import ctypes
+import ctypes.util
+from math import inf
+from platform import machine
+from threading import Lock, get_native_id
+from time import monotonic, sleep
+from typing import Optional
+
+BURST_SECONDS = 1.0     # 允许突发的时长, 即令牌桶容量为rate * BURST_SECONDS
+MIN_FACTOR = 1 / 16     # 退避后的速度不低于设定值的1/16
+RECOVERY_INTERVAL = 30.0    # 未再出现卡顿时每隔这么多秒将速度加倍, 直至恢复设定值
+MAX_PAUSE = 10.0
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_IDLE = 3
+_SYSCALL_NUMBERS = {   # (ioprio_set, ioprio_get)
+    'x86_64': (251, 252),
+    'amd64': (251, 252),
+    'aarch64': (30, 31),
+    'arm64': (30, 31),
+    'i386': (289, 290),
+    'i686': (289, 290)
+}
+
+
+def _load_ioprio():
+    numbers = _SYSCALL_NUMBERS.get(machine().lower())
+    if numbers is None:
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.syscall
+    except (OSError, AttributeError, TypeError):
+        return None
+    return libc, numbers
+
+
+_ioprio = _load_ioprio()
+
+
+def get_io_priority() -> Optional[int]:
+    """返回当前线程的I/O优先级, 不支持时返回None"""
+    if _ioprio is None:
+        return None
+    libc, (_, get_nr) = _ioprio
+    value = libc.syscall(get_nr, IOPRIO_WHO_PROCESS, get_native_id())
+    return None if value < 0 else value
+
+
+def set_io_priority(value: int) -> bool:
+    """设置当前线程的I/O优先级, 仅对CFQ/BFQ调度器有效"""
+    if _ioprio is None:
+        return False
+    libc, (set_nr, _) = _ioprio
+    return libc.syscall(set_nr, IOPRIO_WHO_PROCESS, get_native_id(), value) == 0
+
+
+IDLE_IO_PRIORITY = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+
+
+class Pacer(object):
+    """
+    以GCRA实现的令牌桶, 限制全部复制线程每秒读写的字节数总和
+    服务器出现卡顿时速度减半并暂停复制一段时间, 此后若未再卡顿则逐渐恢复
+    """
+    def __init__(self, rate: float = 0, idle_io=False):
+        self.lock = Lock()
+        self.rate = rate    # 字节每秒, 0代表不限制
+        self.idle_io = idle_io
+        self.factor = 1.0
+        self.tat = 0.0      # 理论到达时间, 早于它的请求须等待
+        self.paused_until = 0.0
+        self.last_lag = -inf
+
+    def configure(self, rate: float, idle_io: bool):
+        with self.lock:
+            self.rate = rate
+            self.idle_io = idle_io
+
+    def get_rate(self) -> float:
+        return self.rate * self.factor
+
+    def acquire(self, size: int):
+        """取得复制size字节所需的令牌, 不足时阻塞. 令牌可预支, 故单个大文件不会永久阻塞"""
+        with self.lock:
+            now = monotonic()
+            while self.factor < 1 and now - self.last_lag > RECOVERY_INTERVAL:
+                self.factor = min(self.factor * 2, 1.0)
+                self.last_lag += RECOVERY_INTERVAL
+            allowed = max(now, self.paused_until)
+            if self.rate > 0:
+                rate = self.get_rate()
+                allowed = max(allowed, self.tat - BURST_SECONDS)
+                self.tat = max(self.tat, allowed) + size / rate
+        if allowed > now:
+            sleep(allowed - now)
+
+    def on_lag(self, behind_ms: float = 0):
+        """服务器报告卡顿(Can't keep up)时调用"""
+        with self.lock:
+            now = monotonic()
+            self.factor = max(self.factor / 2, MIN_FACTOR)
+            self.last_lag = now
+            self.paused_until = max(self.paused_until, now + min(behind_ms / 1000, MAX_PAUSE))
@@ -0,0 +1,194 @@
+"""
+Author       : noeru_desu
+Date         : 2022-07-24 14:06:52
+LastEditors  : noeru_desu
+LastEditTime : 2022-07-24 17:31:20
+Description  : 尽可能由内核完成的文件复制
+"""
+import os
+from errno import EBADF, EINVAL, ENOSYS, ENOTSUP, ENOTTY, ENXIO, EOPNOTSUPP, EXDEV, EPERM
+from shutil import copyfileobj, copystat
+from typing import TYPE_CHECKING, BinaryIO
+
+try:
+    from fcntl import ioctl
+except ImportError:     # Windows
+    ioctl = None
+
+if TYPE_CHECKING:
+    from os import PathLike
+
+FICLONE = 0x40049409
+BUFFER_SIZE = 2 ** 20
+MAX_CHUNK = 2 ** 30
+BLOCK_SIZE = 512    # st_blocks的单位
+SPARSE_SUPPORTED = hasattr(os, 'SEEK_DATA') and hasattr(os, 'SEEK_HOLE')
+_ZEROS = memoryview(bytes(BUFFER_SIZE))
+
+# 不支持某种方式时返回的错误码, 出现后不再对相同的(源设备, 目标设备)尝试该方式
+_UNSUPPORTED_ERRNO = {EBADF, EINVAL, ENOSYS, ENOTSUP, ENOTTY, EOPNOTSUPP, EXDEV, EPERM}
+_unsupported: dict[str, set[tuple[int, int]]] = {
+    'reflink': set(),
+    'sparse': set(),
+    'copy_file_range': set(),
+    'sendfile': set()
+}
+
+
+def transfer_file(src: 'PathLike[str]', dst: 'PathLike[str]', hardlink=False, hasher=None) -> str:
+    """
+    与shutil.copy2相同, 但依次尝试硬链接(仅hardlink为True时), reflink, 稀疏复制(仅源文件含有空洞时), copy_file_range, sendfile, 最后回退至用户态缓冲复制
+    硬链接与源文件共享数据, 仅可用于此后不会被原地修改的文件. 返回所使用的方式
+    hasher不为None时数据须经过用户态, 故直接进行缓冲复制并同时以复制的数据更新hasher, 无需再次读取
+    """
+    if hasher is not None:
+        _hashed_copy(src, dst, hasher)
+        copystat(src, dst)
+        return 'hashed'
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            pass
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        devices = (os.fstat(fsrc.fileno()).st_dev, os.fstat(fdst.fileno()).st_dev)
+        for method, func in _METHODS:
+            if devices in _unsupported[method] or (method == 'sparse' and not is_sparse(fsrc)):
+                continue
+            try:
+                func(fsrc, fdst)
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_ERRNO:
+                    raise
+                _unsupported[method].add(devices)
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+            else:
+                break
+        else:
+            method = 'buffered'
+            copyfileobj(fsrc, fdst, BUFFER_SIZE)
+    copystat(src, dst)
+    return method
+
+
+def get_allocated_size(path: 'PathLike[str]') -> int:
+    """返回文件实际分配的字节数, 稀疏文件的空洞不被计算. 不超过文件大小, 以免小文件因块对齐而显得比原始大小更大"""
+    st = os.stat(path)
+    if not hasattr(st, 'st_blocks'):     # Windows
+        return st.st_size
+    return min(st.st_size, st.st_blocks * BLOCK_SIZE)
+
+
+def is_sparse(f: BinaryIO) -> bool:
+    """文件分配的块少于其大小时可能含有空洞(如删除区块后被裁剪的区域文件)"""
+    if not SPARSE_SUPPORTED:
+        return False
+    st = os.fstat(f.fileno())
+    return st.st_blocks * BLOCK_SIZE < st.st_size
+
+
+def iter_data_ranges(fd: int, size: int):
+    """以SEEK_DATA/SEEK_HOLE产出文件中含有数据的(起始偏移, 长度), 不支持的文件系统将整个文件视为数据"""
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == ENXIO:    # 其后只有空洞
+                return
+            raise
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), size)
+        yield data, hole - data
+        offset = hole
+
+
+def _hashed_copy(src: 'PathLike[str]', dst: 'PathLike[str]', hasher):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if is_sparse(fsrc):
+            _sparse(fsrc, fdst, hasher)
+            return
+        buffer = bytearray(BUFFER_SIZE)
+        view = memoryview(buffer)
+        while size := fsrc.readinto(buffer):
+            hasher.update(view[:size])
+            fdst.write(view[:size])
+
+
+def _sparse(fsrc: BinaryIO, fdst: BinaryIO, hasher=None):
+    """
+    仅复制含有数据的范围, 空洞在目标文件中同样保持为空洞, 不被读取也不被写入
+    hasher不为None时空洞以等长的零字节计入, 结果与读取完整文件相同
+    """
+    fd_in, fd_out = fsrc.fileno(), fdst.fileno()
+    size = os.fstat(fd_in).st_size
+    end = 0
+    for offset, length in iter_data_ranges(fd_in, size):
+        if hasher is not None:
+            _update_zeros(hasher, offset - end)
+        _copy_range(fd_in, fd_out, offset, length, hasher)
+        end = offset + length
+    if hasher is not None:
+        _update_zeros(hasher, size - end)
+    os.ftruncate(fd_out, size)
+
+
+def _copy_range(fd_in: int, fd_out: int, offset: int, length: int, hasher=None):
+    if hasher is None and hasattr(os, 'copy_file_range'):
+        try:
+            while length > 0:
+                copied = os.copy_file_range(fd_in, fd_out, min(length, MAX_CHUNK), offset, offset)
+                if copied == 0:
+                    return
+                offset += copied
+                length -= copied
+            return
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNO:
+                raise
+    while length > 0:
+        data = os.pread(fd_in, min(length, BUFFER_SIZE), offset)
+        if not data:
+            return
+        if hasher is not None:
+            hasher.update(data)
+        os.pwrite(fd_out, data, offset)
+        offset += len(data)
+        length -= len(data)
+
+
+def _update_zeros(hasher, length: int):
+    while length > 0:
+        hasher.update(_ZEROS[:min(length, BUFFER_SIZE)])
+        length -= BUFFER_SIZE
+
+
+def _reflink(fsrc: BinaryIO, fdst: BinaryIO):
+    if ioctl is None:
+        raise OSError(ENOSYS, 'ioctl is not available')
+    ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _copy_file_range(fsrc: BinaryIO, fdst: BinaryIO):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(ENOSYS, 'copy_file_range is not available')
+    while os.copy_file_range(fsrc.fileno(), fdst.fileno(), MAX_CHUNK) > 0:
+        pass
+
+
+def _sendfile(fsrc: BinaryIO, fdst: BinaryIO):
+    if not hasattr(os, 'sendfile'):
+        raise OSError(ENOSYS, 'sendfile is not available')
+    offset = 0
+    while (sent := os.sendfile(fdst.fileno(), fsrc.fileno(), offset, MAX_CHUNK)) > 0:
+        offset += sent
+
+
+_METHODS = (
+    ('reflink', _reflink),
+    ('sparse', _sparse),
+    ('copy_file_range', _copy_file_range),
+    ('sendfile', _sendfile)
+)
@@ -0,0 +1,165 @@
+"""
+Author       : noeru_desu
+Date         : 2022-08-09 10:21:46
+LastEditors  : noeru_desu
+LastEditTime : 2022-08-09 15:48:03
+Description  : 以备份时记录的sha256校验位次中的备份文件
+"""
+from functools import partial
+from math import inf
+from os.path import exists, getsize, join
+from threading import Lock
+from time import time
+from typing import TYPE_CHECKING, Optional
+
+from . import stored
+from .compression import COMPRESSED_SUFFIX, compressed_digest
+from .core import format_file_size, print_message
+from .objects import file_digest
+from .region import delta_file_name
+
+from mcdreforged.api.all import new_thread
+
+if TYPE_CHECKING:
+    from os import PathLike
+
+    from mcdreforged.api.types import CommandSource
+
+    from .copier import CopyTask
+    from .core import DifferentialBackupper, SlotInfoDict
+
+MAX_LISTED_FILES = 10   # 聊天栏中最多列出的问题文件数, 全部问题文件均会写入日志
+
+
+class SlotVerifier(object):
+    """
+    存入对象储存的文件以其哈希值校验, 其余文件以位次信息中的checksums校验(需启用backup_checksums)
+    没有校验值的文件仅检查是否存在, 压缩文件总是被完整解压以检查其能否被读取
+    校验期间位次可被正常覆盖或合并, 出现问题的文件会在slots_lock内重新校验, 以排除校验期间被替换的文件
+    """
+    def __init__(self, core: 'DifferentialBackupper'):
+        self.core = core
+        self.lock = Lock()
+
+    def get_targets(self, displayed_slot_id: Optional[int]) -> list[tuple[int, 'PathLike[str]', 'SlotInfoDict']]:
+        """返回需要校验的(位次, 位次路径, 位次信息), 位次0为覆盖备份"""
+        slots = self.core.slots
+        if displayed_slot_id == 0:
+            return [(0, join(stored.config.backup_path, stored.config.overwrite_backup_folder), slots.overwrite_backup_info)]
+        if displayed_slot_id is not None:
+            return [(displayed_slot_id, *slots.get_slot_data(displayed_slot_id))]
+        return [(slots.get_displayed_slot_id(p), p, i) for p, i in slots.all_slot_generator if i['time_stamp'] != -inf]
+
+    def locate(self, slot_path: 'PathLike[str]', slot_info: 'SlotInfoDict', file: 'PathLike[str]') -> tuple['PathLike[str]', Optional[str], bool]:
+        """返回(储存该文件的路径, 期望的sha256, 是否被压缩)"""
+        digest = slot_info.get('objects', {}).get(file)
+        if digest is not None:
+            return self.core.object_store.get_object_path(digest), digest, False
+        checksum = slot_info.get('checksums', {}).get(file)
+        if file in slot_info.get('region_deltas', ()):
+            return join(slot_path, delta_file_name(file)), checksum, False
+        if file in slot_info.get('compressed_files', ()):
+            return join(slot_path, file + COMPRESSED_SUFFIX), checksum, True
+        return join(slot_path, file), checksum, False
+
+    def check_file(self, slot_path: 'PathLike[str]', slot_info: 'SlotInfoDict', file: 'PathLike[str]') -> tuple[str, int]:
+        """返回(ok, unchecked, missing或corrupt, 读取的字节数)"""
+        path, expected, compressed = self.locate(slot_path, slot_info, file)
+        if not exists(path):
+            return 'missing', 0
+        if expected is None and not compressed:
+            return 'unchecked', 0
+        try:
+            actual = compressed_digest(path) if compressed else file_digest(path)
+        except Exception:
+            return 'corrupt', getsize(path)
+        if expected is None:
+            return 'unchecked', getsize(path)
+        return ('ok' if actual == expected else 'corrupt'), getsize(path)
+
+    def recheck_file(self, slot_path: 'PathLike[str]', slot_info: 'SlotInfoDict', file: 'PathLike[str]') -> Optional[str]:
+        """在slots_lock内重新校验, 位次已被覆盖或合并时返回None"""
+        with self.core.slots_lock:
+            if slot_info is not self.core.slots.overwrite_backup_info:
+                try:
+                    if self.core.slots.get_slot_by_path(slot_path) is not slot_info:
+                        return None
+                except ValueError:
+                    return None
+            return self.check_file(slot_path, slot_info, file)[0]
+
+    def get_tasks(self, targets: list[tuple[int, 'PathLike[str]', 'SlotInfoDict']], results: dict[str, list]) -> list['CopyTask']:
+        def verify_file(displayed_slot_id, slot_path, slot_info, file) -> int:
+            status, size = self.check_file(slot_path, slot_info, file)
+            if status in ('missing', 'corrupt'):
+                status = self.recheck_file(slot_path, slot_info, file)
+                if status is None:
+                    return size
+            results[status].append((displayed_slot_id, file))
+            return size
+
+        tasks: list['CopyTask'] = []
+        for displayed_slot_id, slot_path, slot_info in targets:
+            for file in slot_info['included_files']:
+                path = self.locate(slot_path, slot_info, file)[0]
+                tasks.append((getsize(path) if exists(path) else 0, partial(verify_file, displayed_slot_id, slot_path, slot_info, file)))
+        return tasks
+
+    @new_thread('DAB-Verify')
+    def verify(self, source: 'CommandSource', displayed_slot_id: Optional[int] = None):
+        if not self.lock.acquire(blocking=False):
+            print_message(source, '正在§a校验§r中, 请等待其完成', tell=False)
+            return
+        record = self.core.metrics.begin('verify')
+        success = False
+        try:
+            start_time = time()
+            results: dict[str, list[tuple[int, str]]] = {'ok': [], 'unchecked': [], 'missing': [], 'corrupt': []}
+            with record.phase('plan'), self.core.slots_lock:
+                targets = self.get_targets(displayed_slot_id)
+                tasks = self.get_tasks(targets, results)
+            if not tasks:
+                print_message(source, '没有需要§a校验§r的文件', tell=False)
+                return
+            print_message(source, f'正在§a校验§r{len(targets)}个位次中的§6{len(tasks)}§r个文件...', tell=False)
+            with record.phase('verify'):
+                read_size = self.core.copy_engine.run(tasks, paced=True)
+            record['verified_files'] = len(results['ok'])
+            record['unchecked_files'] = len(results['unchecked'])
+            record['missing_files'] = len(results['missing'])
+            record['corrupt_files'] = len(results['corrupt'])
+            record['read_bytes'] = read_size
+            record['verify_mb_per_second'] = read_size / 2 ** 20 / record.phases['verify'] if record.phases['verify'] > 0 else 0.0
+            record.stop()
+            success = True
+            self.report(source, results, read_size, time() - start_time)
+        except Exception as e:
+            stored.server.logger.exception('Failed to verify backups')
+            print_message(source, f'§a校验§r失败, 错误代码: {e}', tell=False)
+        finally:
+            self.core.metrics.finish(record, success)
+            self.lock.release()
+
+    @staticmethod
+    def report(source: 'CommandSource', results: dict[str, list[tuple[int, str]]], read_size: int, duration: float):
+        speed = format_file_size(int(read_size / duration)) if duration > 0 else format_file_size(read_size)
+        print_message(
+            source,
+            f'校验完成, 用时{round(duration, 2)}秒, 读取§a{format_file_size(read_size)}§r({speed}/s), '
+            f'通过§a{len(results["ok"])}§r个文件',
+            tell=False
+        )
+        if results['unchecked']:
+            print_message(source, f'其中§6{len(results["unchecked"])}§r个文件没有校验值, 仅检查了是否存在, 可启用backup_checksums后重新备份', tell=False)
+        problems = [('§c损坏§r', i) for i in sorted(results['corrupt'])] + [('§c缺失§r', i) for i in sorted(results['missing'])]
+        if not problems:
+            print_message(source, '§a未发现损坏或缺失的文件§r', tell=False)
+            return
+        print_message(source, f'§c发现{len(results["corrupt"])}个损坏与{len(results["missing"])}个缺失的文件§r:', tell=False)
+        for status, (displayed_slot_id, file) in problems[:MAX_LISTED_FILES]:
+            print_message(source, f'  位次§6{displayed_slot_id}§r {status} §7{file}§r', prefix='', tell=False)
+        if len(problems) > MAX_LISTED_FILES:
+            print_message(source, f'  ...等共{len(problems)}个文件, 完整列表见日志', prefix='', tell=False)
+        for status, files in (('corrupt', results['corrupt']), ('missing', results['missing'])):
+            for displayed_slot_id, file in files:
+                stored.server.logger.warning(f'Verification failed: {file} in slot {displayed_slot_id} is {status}')
@@ -0,0 +1,183 @@
+"""
+Author       : noeru_desu
+Date         : 2022-07-26 20:14:09
+LastEditors  : noeru_desu
+LastEditTime : 2022-07-27 00:52:36
+Description  : 基于inotify的存档文件变化记录
+"""
+import ctypes
+import ctypes.util
+from os import close, fsencode, read, scandir
+from os.path import join
+from select import select
+from struct import Struct
+from threading import Event, Lock, Thread
+from typing import TYPE_CHECKING, Iterable, Optional
+
+if TYPE_CHECKING:
+    from os import PathLike
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+_event = Struct('iIII')
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError, TypeError):
+        return None
+    return libc
+
+
+class WorldWatcher(Thread):
+    """
+    持续记录root中folders(各存档文件夹)内被更改的文件(相对于root的路径)
+    队列溢出或文件夹被删除/移动时无法得知具体文件, 此时置overflowed, 下次备份须完整扫描
+    """
+    libc = _load_libc()
+
+    def __init__(self, root: 'PathLike[str]', folders: Iterable[str] = ('',)):
+        super().__init__(name='DAB-Watcher', daemon=True)
+        self.root = str(root)
+        self.folders = set(folders)
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.dirty: set[str] = set()
+        self.overflowed = False
+        self.baseline: Optional[float] = None    # 以之为基础应用变化的位次的时间戳
+        self.watches: dict[int, str] = {}
+        self.fd = -1
+
+    @classmethod
+    def is_supported(cls) -> bool:
+        return cls.libc is not None
+
+    def start(self):
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        for folder in self.folders:
+            self._add_tree(folder)
+        super().start()
+
+    def _add_watch(self, rel: str) -> bool:
+        wd = self.libc.inotify_add_watch(self.fd, fsencode(join(self.root, rel) if rel else self.root), WATCH_MASK)
+        if wd < 0:
+            if rel in self.folders:
+                raise OSError(ctypes.get_errno(), f'Failed to watch {join(self.root, rel)}')
+            self.overflowed = True
+            return False
+        self.watches[wd] = rel
+        return True
+
+    def _add_tree(self, rel: str, mark_dirty=False):
+        """监视文件夹及其全部子文件夹, mark_dirty为True时将其中的文件加入变化记录(用于新建/移入的文件夹)"""
+        stack = [rel]
+        while stack:
+            rel = stack.pop()
+            if not self._add_watch(rel):
+                continue
+            try:
+                with scandir(join(self.root, rel) if rel else self.root) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(join(rel, entry.name))
+                        elif mark_dirty:
+                            self.dirty.add(join(rel, entry.name))
+            except FileNotFoundError:
+                pass
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                if select([self.fd], [], [], 1)[0]:
+                    with self.lock:
+                        self._read_events()
+        except OSError:
+            with self.lock:
+                self.overflowed = True
+        finally:
+            close(self.fd)
+
+    def _read_events(self):
+        while True:
+            try:
+                data = read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _event.unpack_from(data, offset)
+                name = data[offset + _event.size:offset + _event.size + length].rstrip(b'\0').decode(errors='surrogateescape')
+                offset += _event.size + length
+                self._handle_event(wd, mask, name)
+
+    def _handle_event(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        rel = self.watches.get(wd)
+        if rel is None:
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            # 子文件夹的删除/移出已由其中文件的事件及父文件夹的IN_MOVED_FROM记录
+            if rel in self.folders:
+                self.overflowed = True
+            return
+        path = join(rel, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path, mark_dirty=True)
+            elif mask & IN_MOVED_FROM:
+                self.overflowed = True
+            return
+        self.dirty.add(path)
+
+    def take_dirty(self, baseline: float) -> Optional[set[str]]:
+        """
+        读取全部未处理的事件后返回自基础位次被创建以来被更改的文件并清空记录
+        baseline与set_baseline设置的不同或发生过溢出时返回None, 此时须完整扫描
+        调用后基础位次被清除, 直到备份成功后再次调用set_baseline
+        """
+        with self.lock:
+            self._read_events()
+            dirty = None if self.overflowed or self.baseline != baseline else self.dirty
+            self.dirty = set()
+            self.overflowed = False
+            self.baseline = None
+            return dirty
+
+    def peek_dirty(self, baseline: float) -> Optional[set[str]]:
+        """与take_dirty相同但不清空记录也不清除基础位次, 用于在两次备份之间估计更改量"""
+        with self.lock:
+            self._read_events()
+            if self.overflowed or self.baseline != baseline:
+                return None
+            return set(self.dirty)
+
+    def set_baseline(self, baseline: Optional[float]):
+        with self.lock:
+            self.baseline = baseline
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,111 @@
+"""
+Author       : noeru_desu
+Date         : 2022-08-10 09:12:30
+LastEditors  : noeru_desu
+LastEditTime : 2022-08-10 11:40:05
+Description  : 玩家数据备份的save-all与存档备份的save-all flush交错时, 保存完成的消息不能被错误的一方使用
+               用法: python -m unittest discover tests
+"""
+import sys
+import unittest
+from os import makedirs
+from os.path import abspath, dirname, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock, Thread, Timer
+from time import sleep
+from types import SimpleNamespace
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import benchmark  # noqa: E402
+from differential_auto_backup import Config, stored  # noqa: E402
+from differential_auto_backup.core import DifferentialBackupper  # noqa: E402
+from differential_auto_backup.playerdata import PlayerDataBackupper  # noqa: E402
+
+SAVE_DELAY = 0.3
+
+
+class RecordingServer(benchmark.FakeServer):
+    """记录尚未完成的保存指令, 每条保存指令在SAVE_DELAY秒后各自报告完成"""
+    def __init__(self):
+        super().__init__(SAVE_DELAY)
+        self.lock = Lock()
+        self.pending: list[str] = []
+        self.killed = False
+
+    def execute(self, command: str):
+        if command.startswith('save-all'):
+            with self.lock:
+                self.pending.append(command)
+            Timer(self.save_delay, self.finish_save, (command,)).start()
+
+    def finish_save(self, command: str):
+        with self.lock:
+            self.pending.remove(command)
+        stored.core_inst.saved_game()
+
+    def kill(self):
+        self.killed = True
+
+
+class SaveInterleaveTest(unittest.TestCase):
+    def setUp(self):
+        self.work = mkdtemp()
+        config = Config()
+        config.server_path = join(self.work, 'server')
+        config.backup_path = join(self.work, 'backup')
+        config.playerdata_backup = True
+        config.saving_timeout = 2
+        stored.config = config
+        stored.server = self.server = RecordingServer()
+        stored.clock_inst = benchmark.FakeClock()
+        stored.online_player_api = SimpleNamespace(get_player_list=list, have_player=lambda: True)
+        self.world = benchmark.SyntheticWorld(join(config.server_path, config.world_name), 2, 8, 2, 1024, 1)
+        self.world.generate()
+        makedirs(join(self.world.root, 'stats'), exist_ok=True)
+        stored.core_inst = self.core = DifferentialBackupper()
+        stored.playerdata_inst = self.playerdata = PlayerDataBackupper(self.core)
+        # 扫描存档时save-all flush必须已经完成
+        self.unfinished_flush_seen = False
+        scan = self.core.get_world_file_mod_times
+
+        def checked_scan(*args):
+            with self.server.lock:
+                self.unfinished_flush_seen |= 'save-all flush' in self.server.pending
+            return scan(*args)
+
+        self.core.get_world_file_mod_times = checked_scan
+
+    def tearDown(self):
+        self.core.unload()
+        rmtree(self.work, ignore_errors=True)
+
+    def run_interleaved(self, playerdata_first: bool):
+        self.world.write_file(self.world.player_name(0), 1024)
+        playerdata_thread = Thread(target=self.playerdata.make_back_up)
+        if playerdata_first:
+            playerdata_thread.start()
+            sleep(SAVE_DELAY / 3)
+            backup_thread = self.core.make_back_up(self.server.get_plugin_command_source())
+        else:
+            backup_thread = self.core.make_back_up(self.server.get_plugin_command_source())
+            sleep(SAVE_DELAY / 3)
+            playerdata_thread.start()
+        backup_thread.join()
+        playerdata_thread.join()
+        record = self.core.metrics.get_records('backup')[-1]
+        self.assertTrue(record['success'])
+        self.assertFalse(self.unfinished_flush_seen)
+        self.assertFalse(self.server.killed)
+        self.assertEqual(len(self.playerdata.get_slot_chain()), 1)
+
+    def test_playerdata_save_before_world_backup(self):
+        self.run_interleaved(playerdata_first=True)
+
+    def test_playerdata_save_during_world_backup(self):
+        self.run_interleaved(playerdata_first=False)
+
+
+if __name__ == '__main__':
+    unittest.main()